@@ -0,0 +1,142 @@
+import asyncio
+from itertools import product
+import os
+import typing
+
+from openai import AsyncOpenAI
+from tqdm import tqdm
+
+from checkpoint_store import CheckpointStore
+from llm_model import IterativeGPTSolver, OneShotGPTSolver
+from profiling import report
+from rate_limit import AsyncRateLimiter
+from response_cache import ResponseCache
+from results_io import ResultsWriter, open_results_writer
+from utils import get_openai_key, make_openai_client, solve_puzzle_async, solve_puzzle_samples_async
+
+SOLVER_CHOICES = [IterativeGPTSolver, OneShotGPTSolver]
+LLM_CHOICES = ["gpt-4-1106-preview", "gpt-3.5-turbo", ]
+CHAIN_OF_THOUGHT = [False, True]
+SEEDS = [0, 1, 2]
+PUZZLE_IDS = list(range(1, 251))
+
+NUM_GUESSES = 5
+INVALID_LIMIT = 5
+DATA_DIR = 'data'
+SAVE_DIR = 'results'
+
+# Send IterativeGPTSolver a fixed-size prompt with the puzzle state each turn, instead of the whole history
+COMPACT_STATE = False
+
+# Cover the seeds of a puzzle with one first-turn request asking for a sample per seed (see llm_experiment.py)
+MULTI_SAMPLE_SEEDS = False
+
+# Each conversation is saved after every turn, so that an interrupted run resumes its in-progress
+# puzzles from their last turn (None to disable)
+CHECKPOINT_PATH = os.path.join(DATA_DIR, 'checkpoints.sqlite')
+
+# Number of puzzle conversations in flight at once
+MAX_CONCURRENCY = 256
+
+# Provider limits for each model, so requests are paced to stay just under them
+REQUESTS_PER_MINUTE = {"gpt-4-1106-preview": 500, "gpt-3.5-turbo": 3500}
+TOKENS_PER_MINUTE = {"gpt-4-1106-preview": 150_000, "gpt-3.5-turbo": 160_000}
+
+# Responses are cached by request (see llm_experiment.py); with REPLAY_ONLY the API is never called
+RESPONSE_CACHE_PATH = os.path.join(DATA_DIR, 'response_cache.sqlite')
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+REPLAY_ONLY = False
+
+async def run_config(openai_client: AsyncOpenAI,
+                     solver_type: type,
+                     llm_name: str,
+                     chain_of_thought: bool,
+                     writer: ResultsWriter,
+                     puzzles_and_seeds: list,
+                     rate_limiter: AsyncRateLimiter,
+                     response_cache: typing.Optional[ResponseCache],
+                     description: str,
+                     compact_state: bool = False,
+                     checkpoint_store: typing.Optional[CheckpointStore] = None):
+    '''
+    Solve every (puzzle, seed) pair of a config with a fixed number of concurrent conversations,
+    writing each result as soon as it finishes
+    '''
+    jobs = puzzles_and_seeds
+    if MULTI_SAMPLE_SEEDS:
+        # One job per puzzle, covering all of its missing seeds
+        seeds_by_puzzle = {}
+        for puzzle_id, seed in puzzles_and_seeds:
+            seeds_by_puzzle.setdefault(puzzle_id, []).append(seed)
+        jobs = [(puzzle_id, tuple(seeds)) for puzzle_id, seeds in seeds_by_puzzle.items()]
+
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    pbar = tqdm(desc=description, total=len(puzzles_and_seeds))
+
+    async def worker():
+        while not queue.empty():
+            job = queue.get_nowait()
+            solve_kwargs = dict(chain_of_thought=chain_of_thought, num_guesses=NUM_GUESSES, invalid_limit=INVALID_LIMIT,
+                                rate_limiter=rate_limiter, response_cache=response_cache, compact_state=compact_state)
+
+            if MULTI_SAMPLE_SEEDS:
+                results = await solve_puzzle_samples_async(job, solver_type, openai_client, llm_name, **solve_kwargs)
+            else:
+                results = [await solve_puzzle_async(job, solver_type, openai_client, llm_name,
+                                                    checkpoint_store=checkpoint_store, **solve_kwargs)]
+
+            for result in results:
+                writer.write(result)
+                pbar.update(1)
+
+    await asyncio.gather(*[worker() for _ in range(min(MAX_CONCURRENCY, queue.qsize()))])
+    pbar.close()
+
+async def main():
+    # One connection per conversation in flight, kept alive between the turns of each conversation
+    openai_client = make_openai_client(get_openai_key(required=not REPLAY_ONLY), max_connections=MAX_CONCURRENCY,
+                                       keepalive_expiry=60.0, timeout=120.0, connect_timeout=10.0, async_client=True)
+
+    response_cache = None
+    if RESPONSE_CACHE_PATH is not None:
+        response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, read_only=REPLAY_ONLY)
+
+    checkpoint_store = None
+    if CHECKPOINT_PATH is not None:
+        checkpoint_store = CheckpointStore(CHECKPOINT_PATH)
+
+    for llm_name in LLM_CHOICES:
+        # The budget is per model, so one limiter is shared by every config that uses the model
+        rate_limiter = AsyncRateLimiter(REQUESTS_PER_MINUTE.get(llm_name), TOKENS_PER_MINUTE.get(llm_name))
+
+        for solver_type in SOLVER_CHOICES:
+            for chain_of_thought in CHAIN_OF_THOUGHT:
+                description = f"Running {solver_type.__name__}({llm_name}, chain_of_though={chain_of_thought})"
+
+                compact_state = COMPACT_STATE and solver_type == IterativeGPTSolver
+                compact_suffix = "_compact" if compact_state else ""
+
+                samples_suffix = "_samples" if MULTI_SAMPLE_SEEDS else ""
+
+                filename = f"{solver_type.__name__}_{llm_name}_cot-{chain_of_thought}{compact_suffix}{samples_suffix}_results.json"
+
+                with open_results_writer(SAVE_DIR, filename, key_fields=("puzzle_id", "seed")) as writer:
+                    puzzles_and_seeds = [(puzzle_id, seed) for puzzle_id, seed in product(PUZZLE_IDS, SEEDS)
+                                         if (puzzle_id, seed) not in writer]
+
+                    print(f"\n{description}: {writer.num_results} results already exist, {len(puzzles_and_seeds)} to run")
+
+                    await run_config(openai_client, solver_type, llm_name, chain_of_thought, writer,
+                                     puzzles_and_seeds, rate_limiter, response_cache, description, compact_state,
+                                     checkpoint_store)
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+    # With CONNECTIONS_PROFILE set, summarize where the time went
+    run_report = report()
+    if run_report is not None:
+        print(f"\n{run_report}")
@@ -0,0 +1,168 @@
+import typing
+
+import numpy as np
+
+def _center_distances(gram: np.ndarray, one_hot: np.ndarray) -> np.ndarray:
+    '''
+    Squared distance from every point to the mean of every cluster, computed from the (B, N, N)
+    Gram matrix of the points and the (B, R, N, K) one-hot labels of every restart, so that the
+    embedding dimension only enters once (in the Gram matrix). Returns (B, R, N, K) distances
+    '''
+    sizes = np.maximum(one_hot.sum(-2), 1)
+    point_dots = gram[:, None] @ one_hot
+    center_norms = (one_hot * point_dots).sum(-2) / sizes ** 2
+
+    distances = np.diagonal(gram, axis1=1, axis2=2)[:, None, :, None] - 2 * point_dots / sizes[..., None, :] + center_norms[..., None, :]
+    return np.maximum(distances, 0)
+
+def _init_centers(gram: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+    '''
+    k-means++ initialization of every restart of every problem at once, from the (B, N, N) Gram
+    matrix of the points and (B, R, K) uniform draws, one per center of each restart. Returns the
+    (B, R, K) indices of the points chosen as centers
+    '''
+    num_problems, num_points, _ = gram.shape
+    _, num_restarts, num_clusters = uniforms.shape
+
+    norms = np.diagonal(gram, axis1=1, axis2=2)
+    batch_idxs = np.arange(num_problems)[:, None]
+
+    def distances_to(center_idxs):
+        # (B, R, N) squared distances from every point to the given (B, R) points
+        return np.maximum(norms[:, None, :] - 2 * gram[batch_idxs, center_idxs] + norms[batch_idxs, center_idxs][..., None], 0)
+
+    center_idxs = np.empty((num_problems, num_restarts, num_clusters), dtype=np.int64)
+    center_idxs[:, :, 0] = np.minimum((uniforms[:, :, 0] * num_points).astype(np.int64), num_points - 1)
+
+    min_distances = distances_to(center_idxs[:, :, 0])
+    for k in range(1, num_clusters):
+        # Sample the next center with probability proportional to its squared distance to the
+        # closest center so far (uniformly if every point is already a center)
+        cumulative = np.cumsum(min_distances, axis=-1)
+        total = cumulative[..., -1]
+        threshold = uniforms[:, :, k] * total
+
+        sampled_idxs = np.minimum((cumulative <= threshold[..., None]).sum(-1), num_points - 1)
+        uniform_idxs = np.minimum((uniforms[:, :, k] * num_points).astype(np.int64), num_points - 1)
+        center_idxs[:, :, k] = np.where(total > 0, sampled_idxs, uniform_idxs)
+
+        min_distances = np.minimum(min_distances, distances_to(center_idxs[:, :, k]))
+
+    return center_idxs
+
+def balanced_assignment(distances: np.ndarray, max_swaps: typing.Optional[int] = None) -> np.ndarray:
+    '''
+    Assign the N points of every problem to K clusters of exactly N / K points each, given their
+    (M, N, K) distances to the cluster centers. Points are assigned greedily (closest free
+    point-cluster pair first), then pairs of points in different clusters are swapped while
+    that lowers the total distance, all problems at once. Returns (M, N) labels
+    '''
+    num_problems, num_points, num_clusters = distances.shape
+    capacity = num_points // num_clusters
+    rows = np.arange(num_problems)
+
+    labels = np.empty((num_problems, num_points), dtype=np.int64)
+    counts = np.zeros((num_problems, num_clusters), dtype=np.int64)
+    costs = distances.copy()
+
+    for _ in range(num_points):
+        point_idxs, cluster_idxs = np.divmod(costs.reshape(num_problems, -1).argmin(1), num_clusters)
+        labels[rows, point_idxs] = cluster_idxs
+        counts[rows, cluster_idxs] += 1
+
+        costs[rows, point_idxs, :] = np.inf
+        full = counts[rows, cluster_idxs] >= capacity
+        costs[rows[full], :, cluster_idxs[full]] = np.inf
+
+    for _ in range(max_swaps if max_swaps is not None else num_points * num_clusters):
+        # cross[m, i, j] is the distance from point i to the cluster of point j
+        cross = np.take_along_axis(distances, np.broadcast_to(labels[:, None, :], (num_problems, num_points, num_points)), axis=2)
+        assigned = np.diagonal(cross, axis1=1, axis2=2)
+
+        gains = assigned[:, :, None] + assigned[:, None, :] - cross - np.swapaxes(cross, 1, 2)
+        gains[labels[:, :, None] == labels[:, None, :]] = 0
+
+        best_swaps = gains.reshape(num_problems, -1).argmax(1)
+        improving = gains.reshape(num_problems, -1)[rows, best_swaps] > 1e-9
+        if not improving.any():
+            break
+
+        first, second = np.divmod(best_swaps[improving], num_points)
+        swap_rows = rows[improving]
+        labels[swap_rows, first], labels[swap_rows, second] = labels[swap_rows, second], labels[swap_rows, first]
+
+    return labels
+
+def partition_inertia(gram: np.ndarray, labels: np.ndarray, num_clusters: int = 4) -> np.ndarray:
+    '''
+    Sum of squared distances from each point to the mean of its cluster, for the (B, N, N) Gram
+    matrix of the points and the (B, C, N) labels of C candidate partitions of each problem.
+    Returns (B, C) inertias
+    '''
+    one_hot = (labels[..., None] == np.arange(num_clusters)).astype(gram.dtype)
+    sizes = np.maximum(one_hot.sum(-2), 1)
+    cluster_dots = (one_hot * (gram[:, None] @ one_hot)).sum(-2)
+
+    return np.trace(gram, axis1=1, axis2=2)[:, None] - (cluster_dots / sizes).sum(-1)
+
+def canonical_labels(labels: np.ndarray, num_clusters: int = 4) -> np.ndarray:
+    '''
+    Relabel the clusters of each (..., N) partition in order of their first point, so that equal
+    partitions have equal labels
+    '''
+    first_points = np.argmax(labels[..., None] == np.arange(num_clusters), axis=-2)
+    relabel = np.argsort(np.argsort(first_points, axis=-1), axis=-1)
+    return np.take_along_axis(relabel, labels, axis=-1)
+
+def balanced_kmeans(points: np.ndarray,
+                    num_clusters: int = 4,
+                    num_restarts: int = 32,
+                    num_iters: int = 20,
+                    seeds: typing.Union[int, typing.Sequence] = 0) -> typing.Tuple[np.ndarray, np.ndarray]:
+    '''
+    Balanced k-means (every cluster has N / K points) of a batch of problems, with every restart
+    of every problem run at once: k-means++ initialization, then alternating balanced assignment
+    and center updates until no labels change. Each problem draws its initializations from its own
+    seed, so its result does not depend on the other problems in the batch
+
+    Args:
+        points (np.ndarray): The (B, N, D) points of B problems
+        num_clusters (int): The number of clusters K, which must divide N
+        num_restarts (int): The number of restarts R of each problem
+        num_iters (int): The maximum number of iterations
+        seeds (int or list): The seed of every problem (anything np.random.default_rng accepts), or
+            a single seed for all of them
+
+    Returns:
+        labels (np.ndarray): The (B, R, N) cluster of each point in every restart
+        inertia (np.ndarray): The (B, R) sum of squared distances to the cluster means of every restart
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    num_problems, num_points, _ = points.shape
+    assert num_points % num_clusters == 0, f"{num_points} points cannot be split into {num_clusters} equal clusters"
+
+    if isinstance(seeds, (int, np.integer)):
+        seeds = [seeds] * num_problems
+    uniforms = np.stack([np.random.default_rng(seed).random((num_restarts, num_clusters)) for seed in seeds])
+
+    # Every distance is computed from the Gram matrix, so iterations don't depend on the dimension
+    gram = points @ np.swapaxes(points, 1, 2)
+    norms = np.diagonal(gram, axis1=1, axis2=2)
+
+    # Distances to the initial centers, which are points themselves
+    center_idxs = _init_centers(gram, uniforms)
+    batch_idxs = np.arange(num_problems)[:, None, None]
+    distances = np.maximum(norms[:, None, :, None] - 2 * np.swapaxes(gram[batch_idxs, center_idxs], -1, -2)
+                           + norms[batch_idxs, center_idxs][..., None, :], 0)
+
+    labels = None
+    for _ in range(num_iters):
+        new_labels = balanced_assignment(distances.reshape(-1, num_points, num_clusters)).reshape(num_problems, num_restarts, num_points)
+
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+        distances = _center_distances(gram, (labels[..., None] == np.arange(num_clusters)).astype(gram.dtype))
+
+    return labels, partition_inertia(gram, labels, num_clusters)
@@ -1,21 +1,45 @@
 from functools import partial
-import json
-from itertools import product
 import multiprocessing as mp
 import os
 import typing
 
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
-from baselines import SentenceTransformerBaseline, ClustersBaseline
+from baselines import SentenceTransformerBaseline, ClustersBaseline, KMeansBaseline
+from profiling import report, span
 from puzzle import ConnectionsPuzzle
+from results_io import RESULTS_SCHEMA_VERSION, open_results_writer
+
+# Solver held by each worker process, so the model is loaded once per worker rather than once per puzzle
+_worker_solver = None
+
+def init_worker(solver_type: typing.Union[SentenceTransformerBaseline, ClustersBaseline],
+                model_name: str = "all-MiniLM-L6-v2", num_threads: typing.Optional[int] = None):
+    '''
+    Pool initializer that limits torch's intra-op threads for this worker and loads its solver
+    '''
+    global _worker_solver
+
+    if num_threads is not None:
+        import torch
+        torch.set_num_threads(num_threads)
+
+    _worker_solver = solver_type(model_name=model_name)
+
+def solve_puzzle_with_worker_solver(puzzle_id: int, num_guesses: int = 5):
+    '''
+    Solve a puzzle with the warm solver created by `init_worker`
+    '''
+    return solve_puzzle(puzzle_id, type(_worker_solver), num_guesses=num_guesses, solver=_worker_solver)
 
 def solve_puzzle(puzzle_id: int, solver_type: typing.Union[SentenceTransformerBaseline, ClustersBaseline],
-                 model_name: str = "all-MiniLM-L6-v2", num_guesses: int = 5):
+                 model_name: str = "all-MiniLM-L6-v2", num_guesses: int = 5,
+                 solver: typing.Optional[typing.Union[SentenceTransformerBaseline, ClustersBaseline]] = None):
     
-    solver = solver_type(model_name=model_name)
-    all_in_one = isinstance(solver, ClustersBaseline)
+    if solver is None:
+        solver = solver_type(model_name=model_name)
+
+    all_in_one = isinstance(solver, (ClustersBaseline, KMeansBaseline))
     puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one)
 
     observation, done, reward = puzzle.reset()
@@ -25,7 +49,8 @@ def solve_puzzle(puzzle_id: int, solver_type: typing.Union[SentenceTransformerBa
 
     with tqdm(range(num_guesses), desc=f"Solving puzzle {puzzle_id}", leave=False) as pbar:
         while not done:
-            guess = solver.get_action(observation)
+            with span("baseline.get_action"):
+                guess = solver.get_action(observation)
             observation, done, reward = puzzle.step(guess)
 
             for color in puzzle.revealed_colors:
@@ -50,8 +75,9 @@ def solve_puzzle(puzzle_id: int, solver_type: typing.Union[SentenceTransformerBa
     purple_solved_at = category_solved_at['purple'] if solved_purple else None
     
     results_dict = {
+        'schema_version': RESULTS_SCHEMA_VERSION,
         'puzzle_id': puzzle_id,
-        'puzzle_data': puzzle.data,
+        'dataset_hash': puzzle.store.content_hash,
         'solved_overall': solved_overall,
 
         'solved_yellow': solved_yellow,
@@ -77,43 +103,57 @@ NUM_GUESSES = 500
 DATA_DIR = 'data'
 SAVE_DIR = 'results'
 
-NUM_PROCS = 1
+# Torch intra-op threads per worker, and as many workers as that leaves cores for, so that the
+# workers together use each core once
+NUM_THREADS_PER_PROC = 2
+NUM_PROCS = max(1, (os.cpu_count() or 1) // NUM_THREADS_PER_PROC)
+
+if __name__ == "__main__":
+    for solver_type in SOLVER_CHOICES:
+        for model_name in MODEL_NAMES:
+            filename = f"{solver_type.__name__}_model-{model_name}_results.json"
+
+            # Results are appended one per line, and the writer indexes the puzzles already done
+            writer = open_results_writer(SAVE_DIR, filename, key_fields=("puzzle_id",))
 
-for solver_type in SOLVER_CHOICES:
-    for model_name in MODEL_NAMES:
-        results = []
-        filename = f"{solver_type.__name__}_model-{model_name}_results.json"
+            if writer.num_results > 0:
+                print(f"\nLogs for {solver_type.__name__} already exist, checking for missing puzzles...")
+            else:
+                print(f"\nLogs for {solver_type.__name__} do not exist, running all puzzles / seeds")
 
-        if os.path.exists(os.path.join(SAVE_DIR, filename)):
-            print(f"\nLogs for {solver_type.__name__} already exist, checking for missing puzzles...")
-            results = json.load(open(os.path.join(SAVE_DIR, filename), "r"))
-            seen_ids = [result['puzzle_id'] for result in results]
-            puzzle_ids = [puzzle_id for puzzle_id in PUZZLE_IDS if puzzle_id not in seen_ids]
+            puzzle_ids = [puzzle_id for puzzle_id in PUZZLE_IDS if (puzzle_id,) not in writer]
             total = len(puzzle_ids)
 
-        else:
-            print(f"\nLogs for {solver_type.__name__} do not exist, running all puzzles / seeds")
-            puzzle_ids = PUZZLE_IDS
-            total = len(PUZZLE_IDS)
-            results = []
+            if total == 0:
+                writer.close()
+                continue
 
-        if NUM_PROCS == 1:
-            for puzzle_id in tqdm(puzzle_ids, desc=f"Running {solver_type.__name__}-{model_name}", total=total):
-                result = solve_puzzle(puzzle_id, solver_type, model_name, num_guesses=NUM_GUESSES)
-                results.append(result)
+            with writer:
+                if NUM_PROCS == 1:
+                    # Load the model once and reuse the solver for every puzzle
+                    solver = solver_type(model_name=model_name)
 
-                with open(os.path.join(SAVE_DIR, filename), "w") as f:
-                    json.dump(results, f)
-        
-        else:
-            _solve_puzzle = partial(solve_puzzle, solver_type=solver_type, model_name=model_name, num_guesses=NUM_GUESSES)
-            with mp.Pool(NUM_PROCS) as pool:
-                iterator = pool.imap(_solve_puzzle, puzzle_ids)
-                pbar = tqdm(iterator, desc=f"Running {solver_type.__name__}", total=total)
+                    for puzzle_id in tqdm(puzzle_ids, desc=f"Running {solver_type.__name__}-{model_name}", total=total):
+                        result = solve_puzzle(puzzle_id, solver_type, model_name, num_guesses=NUM_GUESSES, solver=solver)
+                        writer.write(result)
                 
-                for result in pbar:
-                    results.append(result)
-                    pbar.update(1)
-
-                with open(os.path.join(SAVE_DIR, filename), "w") as f:
-                    json.dump(results, f)
\ No newline at end of file
+                else:
+                    # Each worker loads its model once in the initializer, and puzzles are streamed to the
+                    # warm workers one at a time as they free up
+                    _solve_puzzle = partial(solve_puzzle_with_worker_solver, num_guesses=NUM_GUESSES)
+                    with mp.Pool(NUM_PROCS, initializer=init_worker,
+                                 initargs=(solver_type, model_name, NUM_THREADS_PER_PROC)) as pool:
+                        iterator = pool.imap_unordered(_solve_puzzle, puzzle_ids, chunksize=1)
+                        pbar = tqdm(iterator, desc=f"Running {solver_type.__name__}-{model_name}", total=total)
+                        
+                        for result in pbar:
+                            writer.write(result)
+
+                        # Let the workers exit normally, so that they write their profiles
+                        pool.close()
+                        pool.join()
+
+    # With CONNECTIONS_PROFILE set, summarize where the time went in every process of the run
+    run_report = report()
+    if run_report is not None:
+        print(f"\n{run_report}")
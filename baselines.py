@@ -1,26 +1,48 @@
+from collections import OrderedDict
+import heapq
 from itertools import combinations, product
 import math
 import multiprocessing as mp
 import os
-import pickle
 import typing
+import zlib
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
 import numpy as np
-from scipy.spatial.distance import cdist
-from scipy.optimize import linear_sum_assignment
-from sentence_transformers import SentenceTransformer, util
-from sklearn.cluster import KMeans
 from tqdm import tqdm
 
+from balanced_kmeans import balanced_kmeans, canonical_labels, partition_inertia
+from embedding_cache import EmbeddingCache, encode_with_cache
+from partitions import PartitionScorer, PartitionSearch, enumerate_groups, group_masks, score_groups
+
+def load_sentence_transformer(model_name: str):
+    '''
+    Load a sentence transformer model. sentence_transformers (and torch) are only imported here, so
+    the baselines can run with another encoder where the model stack is not installed
+    '''
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def cosine_scores(embeddings: np.ndarray) -> np.ndarray:
+    '''
+    Cosine similarity between every pair of embeddings
+    '''
+    embeddings = np.asarray(embeddings)
+    normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    return normalized @ normalized.T
+
 class SentenceTransformerBaseline():
     def __init__(self,
                  model_name: str = "all-MiniLM-L6-v2",
-                 aggregation_fn: typing.Callable = np.mean):
+                 aggregation_fn: typing.Callable = np.mean,
+                 max_cached_states: int = 16,
+                 embedding_cache_dir: typing.Optional[str] = "./data/embedding_cache"):
         
-        self.model = SentenceTransformer(model_name)
+        self.model = load_sentence_transformer(model_name)
+        self.embedding_cache = EmbeddingCache(model_name, embedding_cache_dir) if embedding_cache_dir else None
         self.aggregation_fn = aggregation_fn
+        self.max_cached_states = max_cached_states
 
         self.guesses = []
         self.embeddings = None
@@ -28,6 +50,12 @@ class SentenceTransformerBaseline():
         self.words_to_idx = None
         self.initial_words = None
 
+        self.group_idxs = None
+        self.group_masks = None
+        self.ranked_group_ids = None
+        self.guessed_group_ids = set()
+        self.state_to_candidates = OrderedDict()
+
     def reset(self):
         '''
         Reset for a new puzzle
@@ -38,7 +66,32 @@ class SentenceTransformerBaseline():
         self.words_to_idx = None
         self.initial_words = None
 
-        self.available_indices_to_ranked_guesses = {}
+        self.group_idxs = None
+        self.group_masks = None
+        self.ranked_group_ids = None
+        self.guessed_group_ids = set()
+        self.state_to_candidates = OrderedDict()
+
+    def _get_candidates(self, available_mask: int) -> typing.List[int]:
+        '''
+        Return the heap of candidate groups for the given board state. Candidates are encoded as
+        their rank in the global ordering of groups by score, so the heap only holds integers.
+        Heaps are kept for the most recently used board states only
+        '''
+        if available_mask in self.state_to_candidates:
+            self.state_to_candidates.move_to_end(available_mask)
+            return self.state_to_candidates[available_mask]
+
+        # Every group that does not use a removed word is still available, and filtering the global
+        # ranking keeps the candidates sorted (and therefore already a valid heap)
+        removed_mask = ~available_mask
+        candidates = np.flatnonzero((self.group_masks[self.ranked_group_ids] & removed_mask) == 0).tolist()
+
+        self.state_to_candidates[available_mask] = candidates
+        if len(self.state_to_candidates) > self.max_cached_states:
+            self.state_to_candidates.popitem(last=False)
+
+        return candidates
 
     def get_action(self, observation: dict) -> typing.List[str]:
         '''
@@ -47,39 +100,33 @@ class SentenceTransformerBaseline():
 
         words = observation["words"]
         
-        # Cache embeddings and cosine similarties
+        # Cache embeddings and cosine similarties, and rank every possible group once
         if self.embeddings is None:
 
-            self.embeddings = self.model.encode(words, convert_to_tensor=True)
-            self.cosine_scores = util.cos_sim(self.embeddings, self.embeddings).cpu()
+            self.embeddings = encode_with_cache(self.model, words, self.embedding_cache)
+            self.cosine_scores = cosine_scores(self.embeddings)
             self.words_to_idx = {word: idx for idx, word in enumerate(words)}
             self.initial_words = words[:]
 
-        indices = tuple(sorted([self.words_to_idx[word] for word in words]))
+            self.group_idxs = enumerate_groups(len(words), 4)
+            self.group_masks = group_masks(len(words), 4)
 
-        if indices in self.available_indices_to_ranked_guesses:
-            ranked_guesses = self.available_indices_to_ranked_guesses[indices]
-        else:
-            def score_group(group):
-                idx_group = [self.words_to_idx[word] for word in group]
-                scores = []
-                for i, j in product(idx_group, repeat=2):
-                    scores.append(self.cosine_scores[i, j])
-
-                return self.aggregation_fn(scores)
-
-            groups = []
-            for idx_group in tqdm(combinations(indices, 4), desc="Generating guesses", total=math.comb(len(indices), 4), leave=False):
-                group = list(sorted([self.initial_words[idx] for idx in idx_group]))
-                groups.append(group)
-            
-            ranked_guesses = sorted(groups, key=score_group, reverse=True)
-            self.available_indices_to_ranked_guesses[indices] = ranked_guesses
-
-        guess = ranked_guesses.pop(0)
-        while guess in self.guesses:
-            guess = ranked_guesses.pop(0)
+            group_scores = score_groups(self.cosine_scores, self.aggregation_fn)
+            self.ranked_group_ids = np.argsort(-group_scores, kind="stable")
+
+        available_mask = 0
+        for word in words:
+            available_mask |= 1 << self.words_to_idx[word]
+
+        candidates = self._get_candidates(available_mask)
 
+        group_id = int(self.ranked_group_ids[heapq.heappop(candidates)])
+        while group_id in self.guessed_group_ids:
+            group_id = int(self.ranked_group_ids[heapq.heappop(candidates)])
+
+        self.guessed_group_ids.add(group_id)
+
+        guess = list(sorted([self.initial_words[idx] for idx in self.group_idxs[group_id]]))
         self.guesses.append(guess)
 
         return guess
@@ -94,8 +141,8 @@ class SentenceTransformerBaseline():
         # Cache embeddings and cosine similarties
         if self.embeddings is None:
 
-            self.embeddings = self.model.encode(words, convert_to_tensor=True)
-            self.cosine_scores = util.cos_sim(self.embeddings, self.embeddings).cpu()
+            self.embeddings = encode_with_cache(self.model, words, self.embedding_cache)
+            self.cosine_scores = cosine_scores(self.embeddings)
             self.words_to_idx = {word: idx for idx, word in enumerate(words)}
             self.initial_words = words[:]
 
@@ -126,10 +173,23 @@ class SentenceTransformerBaseline():
 class ClustersBaseline():
     def __init__(self,
                  model_name: str = "all-MiniLM-L6-v2",
-                 aggregation_fn: typing.Callable = np.mean):
+                 aggregation_fn: typing.Callable = np.mean,
+                 initial_top_k: int = 1024,
+                 best_first: bool = False,
+                 group_size: int = 4,
+                 time_budget: typing.Optional[float] = None,
+                 embedding_cache_dir: typing.Optional[str] = "./data/embedding_cache"):
         
-        self.model = SentenceTransformer(model_name)
+        self.model = load_sentence_transformer(model_name)
+        self.embedding_cache = EmbeddingCache(model_name, embedding_cache_dir) if embedding_cache_dir else None
         self.aggregation_fn = aggregation_fn
+        self.initial_top_k = initial_top_k
+
+        # If best_first is set, partitions are generated lazily by a branch-and-bound search instead
+        # of scoring every partition of the board (useful for larger boards)
+        self.best_first = best_first
+        self.group_size = group_size
+        self.time_budget = time_budget
 
         self.guesses = []
         self.embeddings = None
@@ -137,8 +197,12 @@ class ClustersBaseline():
         self.words_to_idx = None
         self.initial_words = None
 
-        self.all_group_idxs = pickle.load(open("./data/all_guess_idxs.pkl", "rb"))
-        self.group_to_score = {}
+        self.partition_scorer = None
+        self.partition_search = None
+        self.partition_iterator = None
+        self.group_scores = None
+        self.ranked_partitions = None
+        self.rank_position = 0
 
     def reset(self):
         '''
@@ -150,95 +214,229 @@ class ClustersBaseline():
         self.words_to_idx = None
         self.initial_words = None
 
-        self.group_to_score = {}
+        self.partition_search = None
+        self.partition_iterator = None
+        self.group_scores = None
+        self.ranked_partitions = None
+        self.rank_position = 0
 
-    def _score_group(self, group: typing.Tuple[int]) -> float:
+    def _rank_partitions(self, k: int):
         '''
-        Determine the aggregate cosine similarity between all pairs of words in a group
+        Rank the k best partitions of the board according to the summed group scores
         '''
+        self.ranked_partitions = self.partition_scorer.top_k(self.group_scores, k)
 
-        if group not in self.group_to_score:
+    def get_action(self, observation: dict) -> typing.List[str]:
+        '''
+        Determine an action for the current observation
+        '''
 
-            scores = []
-            for i, j in product(group, repeat=2):
-                scores.append(self.cosine_scores[i, j])
+        self.words = observation["words"]
+        
+        # Cache embeddings and cosine similarties, and score every possible group once
+        if self.embeddings is None:
 
-            score = self.aggregation_fn(scores)
+            self.embeddings = encode_with_cache(self.model, self.words, self.embedding_cache)
+            self.cosine_scores = cosine_scores(self.embeddings)
+            self.group_scores = score_groups(self.cosine_scores, self.aggregation_fn, self.group_size)
 
-            self.group_to_score[group] = score
+            if self.best_first:
+                self.partition_search = PartitionSearch(self.group_scores, len(self.words), self.group_size)
+                self.partition_iterator = self.partition_search.search(self.time_budget)
 
-        return self.group_to_score[group]
+            else:
+                if self.partition_scorer is None or self.partition_scorer.board_size != len(self.words):
+                    self.partition_scorer = PartitionScorer(len(self.words), self.group_size)
 
+                self.rank_position = 0
+                self._rank_partitions(self.initial_top_k)
 
-    def _score_guess(self, guess_idxs: typing.Tuple[typing.Tuple[int]]) -> typing.Tuple[float, typing.List[typing.List[str]]]:
-        
-        score = sum([self._score_group(group) for group in guess_idxs])
-        guess = [[self.words[idx] for idx in group] for group in guess_idxs]
+        if self.best_first:
+            try:
+                _, group_ids = next(self.partition_iterator)
+            except StopIteration:
+                raise ValueError("No more guesses available")
 
-        return score, guess
+            guess = self.partition_search.to_words(group_ids, self.words)
 
-    def get_action(self, observation: dict) -> typing.List[str]:
-        '''
-        Determine an action for the current observation
-        '''
+        else:
+            # Only the top of the ranking is materialized, so extend it if we run past the end
+            if self.rank_position >= len(self.ranked_partitions):
+                if len(self.ranked_partitions) >= len(self.partition_scorer.partitions):
+                    raise ValueError("No more guesses available")
 
-        self.words = observation["words"]
-        
-        # Cache embeddings and cosine similarties
-        if self.embeddings is None:
+                self._rank_partitions(2 * len(self.ranked_partitions))
 
-            self.embeddings = self.model.encode(self.words, convert_to_tensor=True)
-            self.cosine_scores = util.cos_sim(self.embeddings, self.embeddings)
-            self.guesses_by_score = []
+            partition_idx = self.ranked_partitions[self.rank_position]
+            self.rank_position += 1
 
-            for guess_idxs in tqdm(self.all_group_idxs, desc="Generating guesses", total=len(self.all_group_idxs)):
-                score, guess = self._score_guess(guess_idxs)
-                self.guesses_by_score.append((score, guess))
+            guess = self.partition_scorer.to_words(partition_idx, self.words)
 
-            self.guesses_by_score = sorted(self.guesses_by_score, key=lambda x: x[0], reverse=True)
+        self.guesses.append(guess)
 
-        for score, guess in self.guesses_by_score:
-            if guess not in self.guesses:
-                self.guesses.append(guess)
-                return guess
-            
-        raise ValueError("No more guesses available")
+        return guess
 
 
 class KMeansBaseline():
+    '''
+    Guesses all four groups at once by clustering the word embeddings into four groups of four
+    with balanced k-means. The restarts of a board are run together, seeded from `seed` and the
+    board, so the guesses are reproducible. Each guess is the next best distinct partition (by
+    k-means inertia) among the restarts' solutions and the single swaps of the best one. Once those
+    have all been guessed, the guesses continue down every partition of the board (from the
+    partition index) in order of inertia. Boards can be clustered many at a time with
+    `cluster_boards`, and the embeddings and ranked partitions of the most recent boards are cached.
+
+    Args:
+        model_name (str): The sentence transformer model used to embed the words
+        seed (int): The seed of the k-means initializations
+        num_restarts (int): The number of k-means restarts of each board
+        num_iters (int): The maximum number of k-means iterations
+        max_cached_boards (int): The number of boards whose embeddings and partitions are kept
+        initial_top_k (int): The number of partitions of the index ranked at first, once the
+            clustering's candidates run out
+        embedding_cache_dir (str): The directory of the persistent embedding cache (None to disable)
+    '''
     def __init__(self,
                  model_name: str = "all-MiniLM-L6-v2",
-                 seed: int = 0):
+                 seed: int = 0,
+                 num_restarts: int = 32,
+                 num_iters: int = 20,
+                 max_cached_boards: int = 1024,
+                 initial_top_k: int = 1024,
+                 embedding_cache_dir: typing.Optional[str] = "./data/embedding_cache"):
         
-        self.model = SentenceTransformer(model_name)
+        self.model = load_sentence_transformer(model_name)
+        self.embedding_cache = EmbeddingCache(model_name, embedding_cache_dir) if embedding_cache_dir else None
         self.seed = seed
+        self.num_restarts = num_restarts
+        self.num_iters = num_iters
+        self.max_cached_boards = max_cached_boards
+        self.initial_top_k = initial_top_k
+
+        # Board (tuple of words) -> (embeddings, ranked partitions as label arrays)
+        self.boards = OrderedDict()
+        self.rank_positions = {}
+
+        # Board -> ranking of the whole partition index, for boards whose candidates ran out
+        self.partition_scorer = None
+        self.index_rankings = {}
 
     def reset(self):
         '''
         Reset for a new puzzle
         '''
-        pass
+        self.rank_positions = {}
+        self.index_rankings = {}
+
+    def _rank_partitions(self, embeddings: np.ndarray, labels: np.ndarray, inertia: np.ndarray) -> np.ndarray:
+        '''
+        Rank the distinct partitions among the restarts' solutions and the single swaps of the best
+        solution by their inertia, best first
+        '''
+        best = labels[np.argmin(inertia)]
+
+        # Swap every pair of words that are in different groups of the best partition
+        first, second = np.triu_indices(len(best), k=1)
+        keep = best[first] != best[second]
+        swaps = np.repeat(best[None], keep.sum(), axis=0)
+        swap_rows = np.arange(len(swaps))
+        swaps[swap_rows, first[keep]], swaps[swap_rows, second[keep]] = best[second[keep]], best[first[keep]]
+
+        candidates = canonical_labels(np.concatenate([labels, swaps]))
+        _, first_idxs = np.unique(candidates, axis=0, return_index=True)
+        candidates = candidates[np.sort(first_idxs)]
+
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        candidate_inertia = partition_inertia((embeddings @ embeddings.T)[None], candidates[None])[0]
+
+        return candidates[np.argsort(candidate_inertia, kind="stable")]
+
+    def cluster_boards(self, boards: typing.List[typing.List[str]]) -> typing.List[np.ndarray]:
+        '''
+        Return the ranked partitions (as arrays of group labels) of each board. Boards that are not
+        cached are encoded and clustered in one batch, with every restart of every board at once
+        '''
+        boards = [tuple(board) for board in boards]
+        missing = [board for board in dict.fromkeys(boards) if board not in self.boards]
+
+        if missing:
+            embeddings = encode_with_cache(self.model, [word for board in missing for word in board], self.embedding_cache)
+            embeddings = np.asarray(embeddings).reshape(len(missing), len(missing[0]), -1)
+
+            # Each board is seeded from its words, so its clustering does not depend on the batch
+            seeds = [[self.seed, zlib.crc32("\0".join(board).encode("utf-8"))] for board in missing]
+            labels, inertia = balanced_kmeans(embeddings, num_clusters=4, num_restarts=self.num_restarts,
+                                              num_iters=self.num_iters, seeds=seeds)
+
+            for board, board_embeddings, board_labels, board_inertia in zip(missing, embeddings, labels, inertia):
+                self.boards[board] = (board_embeddings, self._rank_partitions(board_embeddings, board_labels, board_inertia))
+                if len(self.boards) > self.max_cached_boards:
+                    self.boards.popitem(last=False)
+
+        ranked_partitions = []
+        for board in boards:
+            self.boards.move_to_end(board)
+            ranked_partitions.append(self.boards[board][1])
+
+        return ranked_partitions
+
+    def _next_index_partition(self, board: typing.Tuple[str, ...], ranked_partitions: np.ndarray) -> np.ndarray:
+        '''
+        Return the next best partition of the whole partition index by inertia, skipping the
+        clustering's candidates (which have already been guessed)
+        '''
+        if self.partition_scorer is None or self.partition_scorer.board_size != len(board):
+            self.partition_scorer = PartitionScorer(len(board), 4)
+
+        ranking = self.index_rankings.get(board)
+        if ranking is None:
+            # The inertia of a partition is the sum of squared norms minus, for every group, the
+            # squared norm of its sum over its size, so ranking by the summed group scores below
+            # ranks by inertia
+            embeddings = np.asarray(self.boards[board][0], dtype=np.float64)
+            group_scores = score_groups(embeddings @ embeddings.T, np.sum) / 4
+
+            ranking = self.index_rankings[board] = {
+                "group_scores": group_scores,
+                "ranked": self.partition_scorer.top_k(group_scores, self.initial_top_k),
+                "position": 0,
+                "guessed": set(map(tuple, ranked_partitions.tolist())),
+            }
+
+        while True:
+            # Only the top of the ranking is materialized, so extend it if we run past the end
+            if ranking["position"] >= len(ranking["ranked"]):
+                if len(ranking["ranked"]) >= len(self.partition_scorer.partitions):
+                    raise ValueError("No more guesses available")
+
+                ranking["ranked"] = self.partition_scorer.top_k(ranking["group_scores"], 2 * len(ranking["ranked"]))
+
+            partition_idx = ranking["ranked"][ranking["position"]]
+            ranking["position"] += 1
+
+            labels = np.empty(len(board), dtype=np.int64)
+            for label, group_id in enumerate(self.partition_scorer.partitions[partition_idx]):
+                labels[self.partition_scorer.groups[group_id]] = label
+            labels = canonical_labels(labels)
+
+            if tuple(labels.tolist()) not in ranking["guessed"]:
+                return labels
 
     def get_action(self, observation: dict) -> typing.List[typing.List[str]]:
         '''
         Determine an action for the current observation
         '''
         words = observation["words"]
-        embeddings = self.model.encode(words, convert_to_numpy=True)
-        word_to_embedding = {word: embedding for word, embedding in zip(words, embeddings)}
-
-        kmeans = KMeans(n_clusters=4, n_init="auto").fit(embeddings)
-        # labels = kmeans.labels_
+        ranked_partitions = self.cluster_boards([words])[0]
 
-        # Code from https://stackoverflow.com/questions/5452576/k-means-algorithm-variation-with-equal-cluster-size
-        # for ensuring equal cluster size
-        centers = kmeans.cluster_centers_
-        centers = centers.reshape(-1, 1, embeddings.shape[-1]).repeat(4, 1).reshape(-1, embeddings.shape[-1])
-        distance_matrix = cdist(embeddings, centers)
-        labels = linear_sum_assignment(distance_matrix)[1] // 4
+        board = tuple(words)
+        rank_position = self.rank_positions.get(board, 0)
+        self.rank_positions[board] = rank_position + 1
 
-        action = []
-        for label in range(4):
-            action.append([word for word, word_label in zip(words, labels) if word_label == label])
+        if rank_position < len(ranked_partitions):
+            labels = ranked_partitions[rank_position]
+        else:
+            labels = self._next_index_partition(board, ranked_partitions)
 
-        return action
\ No newline at end of file
+        return [[word for word, word_label in zip(words, labels) if word_label == label] for label in range(4)]
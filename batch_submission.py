@@ -0,0 +1,274 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+import typing
+
+from openai import OpenAI
+
+from llm_model import IterativeGPTSolver, OneShotGPTSolver
+from puzzle import ConnectionsPuzzle
+from response_cache import ResponseCache
+
+class BatchBackend(ABC):
+    '''
+    Runs batch files of chat completion requests (in the provider's batch input format) and writes
+    the responses to output files (in the provider's batch output format). Batches are submitted
+    first and polled afterwards, so that several batches can run at the same time
+    '''
+    poll_interval = 0.0
+
+    @abstractmethod
+    def submit(self, input_path: str, output_path: str) -> typing.Any:
+        '''
+        Start running a batch, and return a handle to poll it with
+        '''
+
+    @abstractmethod
+    def poll(self, handle: typing.Any) -> bool:
+        '''
+        Return whether a batch has finished, writing its output file once it has
+        '''
+
+    def wait(self, handles: typing.List[typing.Any]):
+        '''
+        Wait until every one of the given batches has finished
+        '''
+        pending = list(handles)
+        while True:
+            pending = [handle for handle in pending if not self.poll(handle)]
+            if not pending:
+                return
+
+            time.sleep(self.poll_interval)
+
+class OpenAIBatchBackend(BatchBackend):
+    '''
+    Submits batches to the OpenAI batch endpoint and polls them until they have finished. Batched
+    requests are billed at a discount, in exchange for results within the completion window
+
+    Args:
+        openai_client (OpenAI): The client to upload and submit the batches with
+        completion_window (str): How long the provider may take to run a batch
+        poll_interval (float): Seconds between checks of the batch statuses
+    '''
+    def __init__(self,
+                 openai_client: OpenAI,
+                 completion_window: str = "24h",
+                 poll_interval: float = 60.0):
+
+        self.client = openai_client
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+
+    def submit(self, input_path: str, output_path: str) -> typing.Tuple[str, str]:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                           completion_window=self.completion_window)
+        print(f"Submitted batch {batch.id} ({input_path})")
+
+        return batch.id, output_path
+
+    def poll(self, handle: typing.Tuple[str, str]) -> bool:
+        batch_id, output_path = handle
+
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            return False
+
+        if batch.status != "completed" and batch.output_file_id is None:
+            raise RuntimeError(f"Batch {batch.id} finished with status {batch.status}")
+
+        # An expired batch still returns the requests that did finish; the rest are retried interactively
+        with open(output_path, "w") as f:
+            if batch.output_file_id is not None:
+                f.write(self.client.files.content(batch.output_file_id).text)
+
+        return True
+
+class LocalBatchBackend(BatchBackend):
+    '''
+    Stand-in for a provider batch endpoint that sends each request of the batch file through an
+    ordinary client (e.g. one pointed at the mock server), for testing the batch path locally.
+    Batches run as soon as they are submitted
+
+    Args:
+        openai_client (OpenAI): The client to send the requests with
+        num_threads (int): The number of requests sent at once
+    '''
+    def __init__(self, openai_client: OpenAI, num_threads: int = 16):
+        self.client = openai_client
+        self.num_threads = num_threads
+
+    def _run(self, request: dict) -> dict:
+        try:
+            completion = self.client.chat.completions.create(**request["body"])
+            response = {"status_code": 200, "body": completion.model_dump()}
+            error = None
+        except Exception as e:
+            response = None
+            error = {"message": str(e)}
+
+        return {"id": f"batch_req_{request['custom_id']}", "custom_id": request["custom_id"], "response": response, "error": error}
+
+    def submit(self, input_path: str, output_path: str) -> str:
+        with open(input_path, "r") as f:
+            requests = [json.loads(line) for line in f]
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            outputs = list(executor.map(self._run, requests))
+
+        with open(output_path, "w") as f:
+            for output in outputs:
+                f.write(json.dumps(output) + "\n")
+
+        return output_path
+
+    def poll(self, handle: str) -> bool:
+        return True
+
+def build_first_turn_requests(puzzles_and_seeds: typing.List[typing.Tuple[int, typing.Union[int, typing.Tuple[int, ...]]]],
+                              solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                              llm_name: str,
+                              chain_of_thought: bool = False,
+                              num_guesses: int = 5,
+                              multi_sample_seeds: bool = False,
+                              shuffle_seed: int = 0) -> typing.Dict[str, dict]:
+    '''
+    Build the first request of each (puzzle, seed) conversation, exactly as the solver would send
+    it, keyed by a "{puzzle_id}-{seed}" custom ID. With `multi_sample_seeds`, each entry is a
+    (puzzle, seeds) pair instead, and its request is the one `solve_samples` sends: one sample
+    per seed, on the board shuffled with `shuffle_seed`
+    '''
+    solver = solver_type(None, llm_name, chain_of_thought=chain_of_thought)
+    all_in_one = solver_type == OneShotGPTSolver
+
+    requests = {}
+    for puzzle_id, seeds in puzzles_and_seeds:
+        if multi_sample_seeds:
+            puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=shuffle_seed)
+
+            # The shared request is sent with the first seed
+            llm_messages = next(solver._solve_steps(puzzle, seed=seeds[0]))
+            requests[f"{puzzle_id}-{'_'.join(map(str, seeds))}"] = solver._request_kwargs(llm_messages, len(seeds))
+
+        else:
+            puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=seeds)
+
+            llm_messages = next(solver._solve_steps(puzzle, seed=seeds))
+            requests[f"{puzzle_id}-{seeds}"] = solver._request_kwargs(llm_messages)
+
+    return requests
+
+def write_batch_file(path: str, requests: typing.Dict[str, dict]):
+    '''
+    Write requests in the batch input format: one JSON request per line, with its custom ID
+    '''
+    with open(path, "w") as f:
+        for custom_id, body in requests.items():
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + "\n")
+
+def read_batch_output(path: str) -> typing.Dict[str, dict]:
+    '''
+    Return the response body (the chat completion) for each custom ID of a batch output file,
+    skipping failed requests
+    '''
+    responses = {}
+    with open(path, "r") as f:
+        for line in f:
+            output = json.loads(line)
+            response = output.get("response")
+
+            if output.get("error") is None and response is not None and response["status_code"] == 200:
+                responses[output["custom_id"]] = response["body"]
+
+    return responses
+
+def _cached_content(completion: dict, samples: bool = False) -> typing.Optional[str]:
+    '''
+    The response cache entry of a completion, as the solver stores it: the content of the response,
+    or the JSON list of the samples' contents for a multi-sample request
+    '''
+    choices = sorted(completion["choices"], key=lambda choice: choice["index"])
+    if samples:
+        return json.dumps([choice["message"]["content"] for choice in choices])
+
+    return choices[0]["message"]["content"]
+
+def submit_first_turns(puzzles_and_seeds: typing.List[typing.Tuple[int, typing.Union[int, typing.Tuple[int, ...]]]],
+                       solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                       llm_name: str,
+                       chain_of_thought: bool,
+                       backend: BatchBackend,
+                       response_cache: ResponseCache,
+                       batch_dir: str,
+                       num_guesses: int = 5,
+                       multi_sample_seeds: bool = False) -> typing.Optional[dict]:
+    '''
+    Submit the first turn of every conversation of a config as one batch, leaving out the requests
+    that are already cached. Returns the pending batch, to be finished with `collect_first_turns`
+    once the backend has run it (or None if there is nothing to submit)
+    '''
+    requests = build_first_turn_requests(puzzles_and_seeds, solver_type, llm_name, chain_of_thought, num_guesses,
+                                         multi_sample_seeds=multi_sample_seeds)
+    requests = {custom_id: body for custom_id, body in requests.items()
+                if response_cache.get(response_cache.key(body)) is None}
+
+    if not requests:
+        return None
+
+    os.makedirs(batch_dir, exist_ok=True)
+    name = f"{solver_type.__name__}_{llm_name}_cot-{chain_of_thought}{'_samples' if multi_sample_seeds else ''}"
+    input_path = os.path.join(batch_dir, f"{name}_batch_input.jsonl")
+    output_path = os.path.join(batch_dir, f"{name}_batch_output.jsonl")
+
+    write_batch_file(input_path, requests)
+    handle = backend.submit(input_path, output_path)
+
+    return {"name": name, "requests": requests, "output_path": output_path, "handle": handle, "multi_sample_seeds": multi_sample_seeds}
+
+def collect_first_turns(batch: dict, response_cache: ResponseCache) -> dict:
+    '''
+    Store the responses of a finished batch in the response cache, and return the number of
+    requests and responses
+    '''
+    summary = {"num_requests": len(batch["requests"]), "num_responses": 0}
+
+    for custom_id, completion in read_batch_output(batch["output_path"]).items():
+        request = batch["requests"][custom_id]
+
+        content = _cached_content(completion, batch["multi_sample_seeds"])
+        if content is not None:
+            # The usage is kept with the response, so the conversation that uses it is billed for it
+            usage = completion.get("usage") or {}
+            batch_usage = {"prompt_tokens": usage.get("prompt_tokens"), "completion_tokens": usage.get("completion_tokens")}
+
+            response_cache.put(response_cache.key(request), content, batch_usage=batch_usage)
+            summary["num_responses"] += 1
+
+    return summary
+
+def prefetch_first_turns(configs: typing.List[dict],
+                         backend: BatchBackend,
+                         response_cache: ResponseCache,
+                         batch_dir: str,
+                         num_guesses: int = 5) -> typing.Dict[str, dict]:
+    '''
+    Run the first turn of every conversation as one batch per config and store the responses in
+    the response cache. Solving the puzzles afterwards then scores the batched first turns without
+    calling the API, and only the turns after a failed or invalid first answer are sent
+    interactively. Every batch is submitted before any is waited on, so the batches of all the
+    configs run at the same time. Each config is a dict of `submit_first_turns` arguments
+    (puzzles_and_seeds, solver_type, llm_name, chain_of_thought and optionally
+    multi_sample_seeds). Returns the summary of each submitted batch, by name
+    '''
+    batches = [submit_first_turns(backend=backend, response_cache=response_cache, batch_dir=batch_dir,
+                                  num_guesses=num_guesses, **config) for config in configs]
+    batches = [batch for batch in batches if batch is not None]
+
+    backend.wait([batch["handle"] for batch in batches])
+
+    return {batch["name"]: collect_first_turns(batch, response_cache) for batch in batches}
@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+import numpy as np
+
+from llm_model import GPTSolver, IterativeGPTSolver, OneShotGPTSolver
+from mock_server import MockChatCompletions, MockChatServer
+import profiling
+from puzzle import ConnectionsPuzzle
+from utils import make_openai_client
+
+SOLVERS = {"iterative": IterativeGPTSolver, "oneshot": OneShotGPTSolver}
+
+def _solve_timed(solver: GPTSolver, puzzle: ConnectionsPuzzle, seed: int, step_latencies: list):
+    '''
+    Solve a puzzle like GPTSolver.solve, recording the latency of each call to the model
+    '''
+    steps = solver._solve_steps(puzzle, seed=seed)
+
+    try:
+        llm_messages = next(steps)
+        while True:
+            start = time.perf_counter()
+            llm_response = solver._query_openai(llm_messages)
+            step_latencies.append(time.perf_counter() - start)
+
+            llm_messages = steps.send(llm_response)
+
+    except StopIteration as stop:
+        return stop.value
+
+async def _solve_timed_async(solver: GPTSolver, puzzle: ConnectionsPuzzle, seed: int, step_latencies: list):
+    '''
+    Asynchronous version of _solve_timed
+    '''
+    steps = solver._solve_steps(puzzle, seed=seed)
+
+    try:
+        llm_messages = next(steps)
+        while True:
+            start = time.perf_counter()
+            llm_response = await solver._query_openai_async(llm_messages)
+            step_latencies.append(time.perf_counter() - start)
+
+            llm_messages = steps.send(llm_response)
+
+    except StopIteration as stop:
+        return stop.value
+
+def run_sync(base_url: str, solver_type: type, jobs: list, concurrency: int, step_latencies: list) -> list:
+    '''
+    Solve the (puzzle, seed) jobs on a thread pool sharing one OpenAI client
+    '''
+    client = make_openai_client("mock", max_connections=concurrency, base_url=base_url, max_retries=0)
+
+    def solve(job):
+        puzzle_id, seed = job
+        solver = solver_type(client, "mock-model")
+        puzzle = ConnectionsPuzzle(puzzle_id, num_guesses=5, all_in_one=(solver_type == OneShotGPTSolver), shuffle_seed=seed)
+        return _solve_timed(solver, puzzle, seed, step_latencies)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(solve, jobs))
+
+async def run_async(base_url: str, solver_type: type, jobs: list, concurrency: int, step_latencies: list) -> list:
+    '''
+    Solve the (puzzle, seed) jobs on an event loop, with at most `concurrency` conversations at once
+    '''
+    client = make_openai_client("mock", max_connections=concurrency, base_url=base_url, max_retries=0, async_client=True)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def solve(job):
+        puzzle_id, seed = job
+        async with semaphore:
+            solver = solver_type(client, "mock-model")
+            puzzle = ConnectionsPuzzle(puzzle_id, num_guesses=5, all_in_one=(solver_type == OneShotGPTSolver), shuffle_seed=seed)
+            return await _solve_timed_async(solver, puzzle, seed, step_latencies)
+
+    results = await asyncio.gather(*[solve(job) for job in jobs])
+    await client.close()
+
+    return results
+
+def benchmark(behaviour: MockChatCompletions,
+              solver_name: str = "iterative",
+              mode: str = "async",
+              num_puzzles: int = 100,
+              num_seeds: int = 1,
+              concurrency: int = 32) -> dict:
+    '''
+    Run the LLM solvers against the mock server and measure the harness throughput: puzzles and
+    requests per second, and the median / tail latency of each step (one model call)
+    '''
+    jobs = [(puzzle_id, seed) for puzzle_id in range(1, num_puzzles + 1) for seed in range(num_seeds)]
+    solver_type = SOLVERS[solver_name]
+    step_latencies = []
+
+    with MockChatServer(behaviour) as server:
+        start = time.perf_counter()
+
+        if mode == "sync":
+            results = run_sync(server.base_url, solver_type, jobs, concurrency, step_latencies)
+        else:
+            results = asyncio.run(run_async(server.base_url, solver_type, jobs, concurrency, step_latencies))
+
+        elapsed = time.perf_counter() - start
+
+    step_latencies = np.array(step_latencies) * 1000
+
+    return {
+        "solver": solver_name,
+        "mode": mode,
+        "concurrency": concurrency,
+        "num_puzzles": len(jobs),
+        "solve_rate": float(np.mean([solved for solved, *_ in results])),
+        "elapsed_s": elapsed,
+        "puzzles_per_s": len(jobs) / elapsed,
+        "requests_per_s": behaviour.num_requests / elapsed,
+        "num_requests": behaviour.num_requests,
+        "num_rate_limited": behaviour.num_rate_limited,
+        "step_latency_p50_ms": float(np.percentile(step_latencies, 50)),
+        "step_latency_p99_ms": float(np.percentile(step_latencies, 99)),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the LLM experiment harness against a local mock of the chat-completions API")
+    parser.add_argument("--solver", choices=list(SOLVERS), default="iterative")
+    parser.add_argument("--mode", choices=["sync", "async"], default="async")
+    parser.add_argument("--num-puzzles", type=int, default=100)
+    parser.add_argument("--num-seeds", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--script", type=str, default=None, help="JSON file with a list of responses to cycle through")
+    parser.add_argument("--accuracy", type=float, default=0.5, help="Probability that a puzzle-aware response is correct")
+    parser.add_argument("--latency-distribution", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--latency-mean", type=float, default=0.0, help="Mean server latency in seconds")
+    parser.add_argument("--latency-spread", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="Server rate limit, above which it returns 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a spurious 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", action="store_true", help="Record timing spans (see profiling.py) and print their summary")
+    parser.add_argument("--cprofile", action="store_true", help="Also write cProfile stats to the profile directory")
+    args = parser.parse_args()
+
+    if args.profile or args.cprofile:
+        profiling.enable(cprofile=args.cprofile)
+
+    script = json.load(open(args.script, "r")) if args.script else None
+    behaviour = MockChatCompletions(script=script, accuracy=args.accuracy, latency_distribution=args.latency_distribution,
+                                    latency_mean=args.latency_mean, latency_spread=args.latency_spread,
+                                    requests_per_minute=args.requests_per_minute, error_rate=args.error_rate,
+                                    seed=args.seed)
+
+    summary = benchmark(behaviour, solver_name=args.solver, mode=args.mode, num_puzzles=args.num_puzzles,
+                        num_seeds=args.num_seeds, concurrency=args.concurrency)
+
+    print(json.dumps(summary, indent=2))
+
+    run_report = profiling.report()
+    if run_report is not None:
+        print(f"\n{run_report}")
@@ -0,0 +1,355 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import numpy as np
+from tabulate import tabulate
+
+import baselines
+from baselines import ClustersBaseline, KMeansBaseline, SentenceTransformerBaseline
+from partitions import enumerate_partitions, load_partitions, partition_index_path, write_partition_index
+import profiling
+from puzzle import ConnectionsPuzzle, get_puzzle_store
+from results_io import RESULTS_SCHEMA_VERSION, ResultsWriter, load_results
+
+BENCHMARKS = ["env", "sentence_transformer_baseline", "clusters_baseline", "kmeans_baseline", "partition_index", "results_io"]
+
+class StandInEncoder():
+    '''
+    Offline stand-in for a SentenceTransformer model, so the baselines can be benchmarked without
+    downloading or running a model. Each word is embedded as a pseudo-random unit vector seeded
+    by a hash of the model name and the word, so the embeddings (and therefore the baselines'
+    guesses) are the same in every run
+
+    Args:
+        model_name (str): The name of the model being stood in for
+        dim (int): The embedding dimension
+    '''
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", dim: int = 384):
+        self.model_name = model_name
+        self.dim = dim
+
+    def encode(self, sentences: typing.List[str], convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        embeddings = np.empty((len(sentences), self.dim), dtype=np.float32)
+        for idx, sentence in enumerate(sentences):
+            seed = int.from_bytes(hashlib.sha256(f"{self.model_name}\0{sentence}".encode("utf-8")).digest()[:8], "little")
+            embedding = np.random.default_rng(seed).standard_normal(self.dim)
+            embeddings[idx] = embedding / np.linalg.norm(embedding)
+
+        return embeddings
+
+@contextlib.contextmanager
+def stand_in_encoder(dim: int = 384):
+    '''
+    Make the baselines load a StandInEncoder instead of a SentenceTransformer model
+    '''
+    load_sentence_transformer = baselines.load_sentence_transformer
+    baselines.load_sentence_transformer = lambda model_name: StandInEncoder(model_name, dim)
+    try:
+        yield
+    finally:
+        baselines.load_sentence_transformer = load_sentence_transformer
+
+def _summarize_times(times: typing.List[float], prefix: str) -> dict:
+    '''
+    Mean, median and tail of a list of durations (in seconds), in milliseconds
+    '''
+    times_ms = np.array(times) * 1000
+    return {
+        f"{prefix}_mean_ms": float(times_ms.mean()),
+        f"{prefix}_p50_ms": float(np.percentile(times_ms, 50)),
+        f"{prefix}_p99_ms": float(np.percentile(times_ms, 99)),
+    }
+
+def benchmark_env(puzzle_ids: typing.List[int], num_episodes: int = 2000, seed: int = 0) -> dict:
+    '''
+    Throughput of ConnectionsPuzzle.reset and step, playing random (but seeded) four-word guesses
+    until each puzzle ends
+    '''
+    rng = random.Random(seed)
+    puzzles = [ConnectionsPuzzle(id=puzzle_id, num_guesses=4, shuffle_seed=puzzle_id) for puzzle_id in puzzle_ids]
+
+    reset_time, step_time, num_steps = 0.0, 0.0, 0
+    for episode in range(num_episodes):
+        puzzle = puzzles[episode % len(puzzles)]
+
+        start = time.perf_counter()
+        observation, done, reward = puzzle.reset()
+        reset_time += time.perf_counter() - start
+
+        while not done:
+            guess = rng.sample(observation["words"], 4)
+
+            start = time.perf_counter()
+            observation, done, reward = puzzle.step(guess)
+            step_time += time.perf_counter() - start
+            num_steps += 1
+
+    return {
+        "num_episodes": num_episodes,
+        "num_steps": num_steps,
+        "resets_per_s": num_episodes / reset_time,
+        "steps_per_s": num_steps / step_time,
+    }
+
+def benchmark_baseline(solver_type: typing.Union[SentenceTransformerBaseline, ClustersBaseline],
+                       puzzle_ids: typing.List[int],
+                       num_guesses: int = 5,
+                       encoder_dim: int = 384) -> dict:
+    '''
+    Latency of a baseline's get_action, per action and per puzzle (every action until the puzzle
+    ends), with a warm solver and the stand-in encoder
+    '''
+    all_in_one = solver_type in (ClustersBaseline, KMeansBaseline)
+
+    with stand_in_encoder(encoder_dim):
+        solver = solver_type(embedding_cache_dir=None)
+
+    # Warm up (e.g. load the partition index) before timing
+    puzzle = ConnectionsPuzzle(id=puzzle_ids[0], num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=0)
+    observation, done, reward = puzzle.reset()
+    solver.reset()
+    solver.get_action(observation)
+
+    action_times, puzzle_times, num_solved = [], [], 0
+    for puzzle_id in puzzle_ids:
+        puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=puzzle_id)
+        observation, done, reward = puzzle.reset()
+        solver.reset()
+
+        puzzle_time = 0.0
+        while not done:
+            start = time.perf_counter()
+            guess = solver.get_action(observation)
+            action_time = time.perf_counter() - start
+
+            action_times.append(action_time)
+            puzzle_time += action_time
+
+            observation, done, reward = puzzle.step(guess)
+
+        puzzle_times.append(puzzle_time)
+        num_solved += int(reward == 1)
+
+    return dict(num_puzzles=len(puzzle_ids), num_actions=len(action_times), num_solved=num_solved,
+                **_summarize_times(action_times, "action"), **_summarize_times(puzzle_times, "puzzle"))
+
+def benchmark_partition_index(board_size: int = 16, group_size: int = 4) -> dict:
+    '''
+    Time and memory to build, write and load the partition index. The load is timed both for
+    opening the memory map and for a first full pass over it
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    partitions = enumerate_partitions(board_size, group_size)
+    enumerate_time = time.perf_counter() - start
+    _, enumerate_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        write_partition_index(data_dir, board_size, group_size)
+        write_time = time.perf_counter() - start
+
+        load_partitions.cache_clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        loaded = load_partitions(data_dir, board_size, group_size)
+        load_time = time.perf_counter() - start
+        _, load_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        checksum = int(np.asarray(loaded, dtype=np.int64).sum())
+        scan_time = time.perf_counter() - start
+
+        file_bytes = os.path.getsize(partition_index_path(data_dir, board_size, group_size))
+
+        del loaded
+        load_partitions.cache_clear()
+
+    return {
+        "num_partitions": len(partitions),
+        "enumerate_s": enumerate_time,
+        "enumerate_peak_bytes": enumerate_peak,
+        "write_s": write_time,
+        "load_s": load_time,
+        "load_peak_bytes": load_peak,
+        "first_scan_s": scan_time,
+        "file_bytes": file_bytes,
+        "array_bytes": partitions.nbytes,
+        "checksum": checksum,
+    }
+
+def _synthetic_result(puzzle_id: int, seed: int, dataset_hash: str) -> dict:
+    '''
+    A version 2 LLM result of a typical size, with a few guesses and calls
+    '''
+    call = {"timestamp": 0.0, "latency_s": 1.0, "prompt_tokens": 600, "completion_tokens": 40, "retries": 0,
+            "backoff_s": 0.0, "ratelimit_remaining_requests": 499, "ratelimit_remaining_tokens": 149_000,
+            "cached": False, "num_samples": 1, "shared": False}
+
+    return {
+        "solver": "IterativeGPTSolver", "llm_name": "gpt-4-1106-preview", "chain_of_thought": False,
+        "schema_version": RESULTS_SCHEMA_VERSION, "puzzle_id": puzzle_id, "dataset_hash": dataset_hash, "seed": seed,
+        "solved_overall": False, "solved_yellow": True, "solved_green": True, "solved_blue": False, "solved_purple": False,
+        "num_steps": 6, "num_invalid": 0,
+        "guesses": [["WORD1", "WORD2", "WORD3", "WORD4"]] * 6,
+        "compact_state": False,
+        "turn_tokens": [{"prompt_tokens": 600, "completion_tokens": 40}] * 6,
+        "llm_calls": [call] * 6,
+    }
+
+def benchmark_results_io(num_results: int = 3000) -> dict:
+    '''
+    Cost of appending results with ResultsWriter (each one fsynced), of reopening the file to
+    resume (which indexes every result already written), and of loading it
+    '''
+    dataset_hash = get_puzzle_store().content_hash
+    results = [_synthetic_result(1 + idx // 3, idx % 3, dataset_hash) for idx in range(num_results)]
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        path = os.path.join(save_dir, "results.jsonl")
+
+        start = time.perf_counter()
+        with ResultsWriter(path, key_fields=("puzzle_id", "seed")) as writer:
+            for result in results:
+                writer.write(result)
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ResultsWriter(path, key_fields=("puzzle_id", "seed")) as writer:
+            resumed = writer.num_results
+        resume_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = load_results(path)
+        load_time = time.perf_counter() - start
+
+        file_bytes = os.path.getsize(path)
+
+    assert resumed == len(loaded) == num_results
+
+    return {
+        "num_results": num_results,
+        "file_bytes": file_bytes,
+        "writes_per_s": num_results / write_time,
+        "write_ms_per_result": write_time / num_results * 1000,
+        "resume_s": resume_time,
+        "load_s": load_time,
+    }
+
+def _git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names: typing.List[str] = BENCHMARKS,
+                   num_puzzles: int = 50,
+                   num_episodes: int = 2000,
+                   num_results: int = 3000,
+                   encoder_dim: int = 384,
+                   seed: int = 0) -> dict:
+    '''
+    Run the selected benchmarks, and return their measurements along with the commit and
+    environment they were measured in
+    '''
+    puzzle_ids = list(range(1, min(num_puzzles, len(get_puzzle_store())) + 1))
+
+    benchmarks = {
+        "env": lambda: benchmark_env(puzzle_ids, num_episodes, seed),
+        "sentence_transformer_baseline": lambda: benchmark_baseline(SentenceTransformerBaseline, puzzle_ids, encoder_dim=encoder_dim),
+        "clusters_baseline": lambda: benchmark_baseline(ClustersBaseline, puzzle_ids, encoder_dim=encoder_dim),
+        "kmeans_baseline": lambda: benchmark_baseline(KMeansBaseline, puzzle_ids, encoder_dim=encoder_dim),
+        "partition_index": benchmark_partition_index,
+        "results_io": lambda: benchmark_results_io(num_results),
+    }
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "num_puzzles": len(puzzle_ids),
+            "num_episodes": num_episodes,
+            "num_results": num_results,
+            "encoder_dim": encoder_dim,
+            "seed": seed,
+        },
+        "benchmarks": {},
+    }
+
+    for name in names:
+        start = time.perf_counter()
+        report["benchmarks"][name] = benchmarks[name]()
+        print(f"{name}: {time.perf_counter() - start:.2f}s")
+
+    return report
+
+def compare_reports(old: dict, new: dict) -> typing.List[list]:
+    '''
+    Return a row (benchmark, metric, old value, new value, new / old) for every numeric metric
+    that both reports measured
+    '''
+    rows = []
+    for name, metrics in new["benchmarks"].items():
+        old_metrics = old["benchmarks"].get(name, {})
+        for metric, value in metrics.items():
+            old_value = old_metrics.get(metric)
+            if isinstance(value, (int, float)) and isinstance(old_value, (int, float)):
+                rows.append([name, metric, old_value, value, value / old_value if old_value else None])
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the puzzle environment, baselines, partition index and results I/O offline")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--num-puzzles", type=int, default=50, help="Puzzles to run the environment and baselines on")
+    parser.add_argument("--num-episodes", type=int, default=2000, help="Episodes of the environment benchmark")
+    parser.add_argument("--num-results", type=int, default=3000, help="Results to write in the results I/O benchmark")
+    parser.add_argument("--encoder-dim", type=int, default=384, help="Embedding dimension of the stand-in encoder")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Path of the JSON report (default: benchmarks/<commit>.json)")
+    parser.add_argument("--compare", type=str, default=None, help="A previous JSON report to compare against")
+    parser.add_argument("--profile", action="store_true", help="Record timing spans (see profiling.py) and print their summary")
+    parser.add_argument("--cprofile", action="store_true", help="Also write cProfile stats to the profile directory")
+    args = parser.parse_args()
+
+    if args.profile or args.cprofile:
+        profiling.enable(cprofile=args.cprofile)
+
+    report = run_benchmarks(args.benchmarks, num_puzzles=args.num_puzzles, num_episodes=args.num_episodes,
+                            num_results=args.num_results, encoder_dim=args.encoder_dim, seed=args.seed)
+
+    output = args.output or os.path.join("benchmarks", f"{report['meta']['commit'] or 'report'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report["benchmarks"], indent=2))
+    print(f"\nSaved the report to {output}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            old_report = json.load(f)
+
+        print(f"\nCompared to {args.compare} (commit {old_report['meta'].get('commit')}):")
+        print(tabulate(compare_reports(old_report, report), headers=["benchmark", "metric", "old", "new", "new / old"],
+                       floatfmt=".4g"))
+
+    run_report = profiling.report()
+    if run_report is not None:
+        print(f"\n{run_report}")
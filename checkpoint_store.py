@@ -0,0 +1,84 @@
+from functools import lru_cache
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+import zlib
+
+from profiling import span
+
+class CheckpointStore():
+    '''
+    A store of in-progress LLM conversations in SQLite, so that a conversation interrupted by a
+    killed worker or a preempted job continues from its last finished turn instead of starting
+    over. Each conversation is saved under a key identifying its config, puzzle and seed, as a
+    zlib-compressed JSON state that is replaced after every turn and deleted once the
+    conversation finishes.
+
+    The state holds the model's responses so far, from which the solver replays the conversation
+    (rebuilding the puzzle state and message history without calling the API), along with the
+    call telemetry and a snapshot of the puzzle and messages to check the replay against.
+
+    Args:
+        path (str): The path of the SQLite database
+    '''
+    def __init__(self, path: str = "./data/checkpoints.sqlite"):
+        self.path = path
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, state BLOB, updated REAL)")
+        self.connection.commit()
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(job: dict) -> str:
+        '''
+        Return the content hash of a job description (solver, model, puzzle, seed, ...)
+        '''
+        return hashlib.sha256(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        '''
+        Return the saved state of a conversation, or None if there is no checkpoint for it
+        '''
+        with self._lock:
+            row = self.connection.execute("SELECT state FROM checkpoints WHERE key = ?", (key,)).fetchone()
+
+        return json.loads(zlib.decompress(row[0])) if row is not None else None
+
+    def put(self, key: str, state: dict):
+        '''
+        Save (or replace) the state of a conversation
+        '''
+        with span("checkpoint.json_dumps"):
+            blob = zlib.compress(json.dumps(state).encode("utf-8"))
+
+        with span("checkpoint.put"), self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (key, blob, time.time()))
+            self.connection.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self.connection.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+@lru_cache(maxsize=None)
+def get_checkpoint_store(path: str = "./data/checkpoints.sqlite") -> CheckpointStore:
+    '''
+    Return the checkpoint store for the given database, shared by every solver in this process
+    (each worker process opens its own connection)
+    '''
+    return CheckpointStore(path)
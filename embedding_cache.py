@@ -0,0 +1,172 @@
+import fcntl
+import json
+import os
+import typing
+import unicodedata
+
+import numpy as np
+
+from profiling import count, span
+
+class EmbeddingCache():
+    '''
+    A persistent on-disk store of word embeddings for a single model, shared across puzzles, runs
+    and processes. Embeddings are appended as float32 rows to a flat file that readers access
+    through a memory map, and an append-only index file maps each normalized word to its row.
+
+    Writers serialize on an exclusive file lock and always write (and fsync) the embedding rows
+    before the index lines that point at them, so readers never need a lock: any complete line
+    in the index refers to data that is already on disk.
+
+    Args:
+        model_name (str): The name of the model the embeddings come from
+        cache_dir (str): The directory where the caches for all models are stored
+    '''
+    def __init__(self,
+                 model_name: str,
+                 cache_dir: str = "./data/embedding_cache"):
+
+        self.model_name = model_name
+        self.model_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        os.makedirs(self.model_dir, exist_ok=True)
+
+        self.data_path = os.path.join(self.model_dir, "embeddings.f32")
+        self.index_path = os.path.join(self.model_dir, "index.jsonl")
+        self.meta_path = os.path.join(self.model_dir, "meta.json")
+        self.lock_path = os.path.join(self.model_dir, "lock")
+
+        self.dim = None
+        self.word_to_row = {}
+        self._index_offset = 0
+        self._embeddings = None
+
+        self._refresh()
+
+    @staticmethod
+    def normalize(word: str) -> str:
+        '''
+        Normalize a word before it is used as a key (and passed to the model). Case is preserved,
+        since sentence transformer models are case sensitive
+        '''
+        return unicodedata.normalize("NFC", word).strip()
+
+    def _refresh(self):
+        '''
+        Read any index lines appended (by this or another process) since the last refresh
+        '''
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                self.dim = json.load(f)["dim"]
+
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_offset)
+            new_data = f.read()
+
+        # A line without its newline is still being written, so it is picked up next time
+        complete = new_data[:new_data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            word, row = json.loads(line)
+            self.word_to_row[word] = row
+
+        self._index_offset += len(complete)
+
+    def _get_embeddings(self, max_row: int) -> np.ndarray:
+        '''
+        Return a memory map over the embedding file that covers at least `max_row`
+        '''
+        if self._embeddings is None or max_row >= len(self._embeddings):
+            num_rows = os.path.getsize(self.data_path) // (self.dim * 4)
+            self._embeddings = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+
+        return self._embeddings
+
+    def lookup(self, words: typing.List[str]) -> typing.Tuple[typing.Dict[str, np.ndarray], typing.List[str]]:
+        '''
+        Return the cached embeddings for the given (normalized) words, along with the words that
+        are not in the cache
+        '''
+        if any(word not in self.word_to_row for word in words):
+            self._refresh()
+
+        found = {word: self.word_to_row[word] for word in words if word in self.word_to_row}
+        missing = [word for word in words if word not in self.word_to_row]
+
+        if found:
+            embeddings = self._get_embeddings(max(found.values()))
+            found = {word: np.array(embeddings[row]) for word, row in found.items()}
+
+        return found, missing
+
+    def add(self, words: typing.List[str], embeddings: np.ndarray):
+        '''
+        Append the embeddings of the given (normalized) words to the cache
+        '''
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+
+                if self.dim is None:
+                    self.dim = embeddings.shape[1]
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+
+                # Another process may have added some of the words while we were encoding them
+                new_idxs = {}
+                for idx, word in enumerate(words):
+                    if word not in self.word_to_row:
+                        new_idxs.setdefault(word, idx)
+
+                if not new_idxs:
+                    return
+
+                row_bytes = self.dim * 4
+                with open(self.data_path, "ab") as f:
+                    # Drop any partial row left behind by a writer that was killed mid-write
+                    num_rows = f.tell() // row_bytes
+                    f.truncate(num_rows * row_bytes)
+                    f.seek(num_rows * row_bytes)
+
+                    f.write(embeddings[list(new_idxs.values())].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                with open(self.index_path, "a") as f:
+                    for row, word in enumerate(new_idxs, start=num_rows):
+                        f.write(json.dumps([word, row]) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self._refresh()
+
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def encode_with_cache(model, words: typing.List[str], cache: typing.Optional[EmbeddingCache] = None) -> np.ndarray:
+    '''
+    Encode the given words with the sentence transformer model as a NumPy array, only running the
+    model on words that are not already in the cache (if one is provided)
+    '''
+    if cache is None:
+        count("encode.words", len(words))
+        with span("encode"):
+            return model.encode(words, convert_to_numpy=True)
+
+    words = [cache.normalize(word) for word in words]
+    found, missing = cache.lookup(words)
+
+    if missing:
+        missing = list(dict.fromkeys(missing))
+        count("encode.words", len(missing))
+        with span("encode"):
+            missing_embeddings = model.encode(missing, convert_to_numpy=True)
+        cache.add(missing, missing_embeddings)
+
+        found.update(zip(missing, np.asarray(missing_embeddings, dtype=np.float32)))
+
+    return np.stack([found[word] for word in words])
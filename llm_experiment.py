@@ -1,13 +1,16 @@
-from functools import partial
-import json
 from itertools import product
 import multiprocessing as mp
 import os
 
 from tqdm import tqdm
 
+from batch_submission import OpenAIBatchBackend, prefetch_first_turns
 from llm_model import IterativeGPTSolver, OneShotGPTSolver
-from utils import solve_puzzle
+from profiling import report
+from response_cache import ResponseCache
+from results_io import open_results_writer
+from scheduler import StepEstimator, longest_first
+from utils import get_openai_key, init_worker, make_openai_client, solve_puzzle, solve_puzzle_samples
 
 SOLVER_CHOICES = [IterativeGPTSolver, OneShotGPTSolver]
 LLM_CHOICES = ["gpt-4-1106-preview", "gpt-3.5-turbo", ]
@@ -22,51 +25,155 @@ SAVE_DIR = 'results'
 
 NUM_PROCS = 8
 
+# Responses are cached by request, so reruns and resumed runs don't pay for the same request twice.
+# With REPLAY_ONLY, every request must come from the cache (for re-running experiments offline)
+RESPONSE_CACHE_PATH = os.path.join(DATA_DIR, 'response_cache.sqlite')
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+REPLAY_ONLY = False
+
+# Each conversation is saved after every turn, so that an interrupted run resumes its in-progress
+# puzzles from their last turn (None to disable)
+CHECKPOINT_PATH = os.path.join(DATA_DIR, 'checkpoints.sqlite')
+
+# Send IterativeGPTSolver a fixed-size prompt with the puzzle state each turn, instead of the whole history
+COMPACT_STATE = False
+
+# Send the (single) request of every OneShotGPTSolver conversation through the discounted batch API
+# first. The batched responses go into the response cache, so only the conversations whose first
+# answer was wrong or invalid make interactive calls. Requires the response cache
+BATCH_FIRST_TURNS = False
+BATCH_DIR = os.path.join(DATA_DIR, 'batches')
+
+# Cover the seeds of a puzzle with one first-turn request that asks for a sample per seed (the API's
+# `n` parameter). Each sample then continues as its own conversation. Every seed of a puzzle sees
+# the same board, so these results are written to separate files
+MULTI_SAMPLE_SEEDS = False
+
+# HTTP connection pool of each worker's OpenAI client, which is reused for all of the worker's puzzles
+OPENAI_CLIENT_KWARGS = {
+    "max_connections": 4,
+    "keepalive_expiry": 60.0,
+    "timeout": 120.0,
+    "connect_timeout": 10.0,
+}
+
 EXP_VARS = [SOLVER_CHOICES, LLM_CHOICES, CHAIN_OF_THOUGHT, SEEDS, PUZZLE_IDS]
 
-for llm_name in LLM_CHOICES:
-    for solver_type in SOLVER_CHOICES:
-        for chain_of_thought in CHAIN_OF_THOUGHT:
-            description = f"Running {solver_type.__name__}({llm_name}, chain_of_though={chain_of_thought})"
-
-            filename = f"{solver_type.__name__}_{llm_name}_cot-{chain_of_thought}_results.json"
-
-            if os.path.exists(os.path.join(SAVE_DIR, filename)):
-                print(f"\nLogs for {description} already exist, checking for missing puzzles / seeds")
-                results = json.load(open(os.path.join(SAVE_DIR, filename), "r"))
-                seen_puzzles_and_seeds = [(result['puzzle_id'], result['seed']) for result in results]
-                
-                puzzles_and_seeds = [(puzzle_id, seed) for puzzle_id, seed in product(PUZZLE_IDS, SEEDS) 
-                                     if (puzzle_id, seed) not in seen_puzzles_and_seeds]
-                total = len(puzzles_and_seeds)
-
-            else:
-                print(f"\nLogs for {description} do not exist, running all puzzles / seeds")
-                puzzles_and_seeds = list(product(PUZZLE_IDS, SEEDS))
-                total = len(PUZZLE_IDS) * len(SEEDS)
-                results = []
-
-            if NUM_PROCS == 1:
-                for puzzle_id_and_seed in tqdm(puzzles_and_seeds, desc=description, total=total):
-                    result = solve_puzzle(puzzle_id_and_seed, solver_type, llm_name, chain_of_thought=chain_of_thought,
-                                          num_guesses=NUM_GUESSES, invalid_limit=INVALID_LIMIT)
-                    
-                    results.append(result)
-
-                    with open(os.path.join(SAVE_DIR, filename), "w") as f:
-                        json.dump(results, f)
-
-            else:
-                _solve_puzzle = partial(solve_puzzle, solver_type=solver_type, llm_name=llm_name,  chain_of_thought=chain_of_thought,
-                                        num_guesses=NUM_GUESSES, invalid_limit=INVALID_LIMIT)
-                
-                with mp.Pool(NUM_PROCS) as pool:
-                    iterator = pool.imap(_solve_puzzle, puzzles_and_seeds)
-                    pbar = tqdm(iterator, desc=description, total=total)
-
-                    for result in iterator:
-                        results.append(result)
+def run_job(job):
+    '''
+    Solve one job of the sweep in a worker, and return its config with its results (one result,
+    or one per seed with MULTI_SAMPLE_SEEDS)
+    '''
+    config, puzzle_job = job
+    solver_type, llm_name, chain_of_thought, compact_state = config
+
+    solve_kwargs = dict(chain_of_thought=chain_of_thought, num_guesses=NUM_GUESSES, invalid_limit=INVALID_LIMIT,
+                        response_cache_path=RESPONSE_CACHE_PATH, response_cache_max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                        replay_only=REPLAY_ONLY, compact_state=compact_state)
+
+    if MULTI_SAMPLE_SEEDS:
+        return config, solve_puzzle_samples(puzzle_job, solver_type, llm_name, **solve_kwargs)
+
+    return config, [solve_puzzle(puzzle_job, solver_type, llm_name, checkpoint_path=CHECKPOINT_PATH, **solve_kwargs)]
+
+def main():
+    # Expand the whole grid into the missing (puzzle, seed) pairs of each config
+    writers = {}
+    missing = {}
+    for solver_type, llm_name, chain_of_thought, seed, puzzle_id in product(*EXP_VARS):
+        compact_state = COMPACT_STATE and solver_type == IterativeGPTSolver
+        config = (solver_type, llm_name, chain_of_thought, compact_state)
+
+        if config not in writers:
+            compact_suffix = "_compact" if compact_state else ""
+            samples_suffix = "_samples" if MULTI_SAMPLE_SEEDS else ""
+            filename = f"{solver_type.__name__}_{llm_name}_cot-{chain_of_thought}{compact_suffix}{samples_suffix}_results.json"
+
+            # Results are appended one per line, and the writer indexes the (puzzle, seed) pairs already done
+            writers[config] = open_results_writer(SAVE_DIR, filename, key_fields=("puzzle_id", "seed"))
+            missing[config] = []
+
+        if (puzzle_id, seed) not in writers[config]:
+            missing[config].append((puzzle_id, seed))
+
+    jobs = []
+    batch_configs = []
+    for config, puzzles_and_seeds in missing.items():
+        solver_type, llm_name, chain_of_thought, compact_state = config
+        print(f"{solver_type.__name__}({llm_name}, chain_of_though={chain_of_thought}): "
+              f"{writers[config].num_results} results already exist, {len(puzzles_and_seeds)} to run")
+
+        if MULTI_SAMPLE_SEEDS:
+            # One job per puzzle, covering all of its missing seeds
+            seeds_by_puzzle = {}
+            for puzzle_id, seed in puzzles_and_seeds:
+                seeds_by_puzzle.setdefault(puzzle_id, []).append(seed)
+            config_jobs = [(puzzle_id, tuple(seeds)) for puzzle_id, seeds in seeds_by_puzzle.items()]
+        else:
+            config_jobs = puzzles_and_seeds
+
+        jobs.extend((config, config_job) for config_job in config_jobs)
+
+        if BATCH_FIRST_TURNS and solver_type == OneShotGPTSolver and RESPONSE_CACHE_PATH is not None and config_jobs:
+            # The batched requests are the ones the jobs will send: per seed, or one per puzzle asking
+            # for a sample per seed
+            batch_configs.append(dict(puzzles_and_seeds=config_jobs, solver_type=solver_type, llm_name=llm_name,
+                                      chain_of_thought=chain_of_thought, multi_sample_seeds=MULTI_SAMPLE_SEEDS))
+
+    if batch_configs:
+        # The batches of every config are submitted before any is waited on, so they run at the same
+        # time. A separate cache connection, so that the pool's workers don't inherit it
+        response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES)
+        backend = OpenAIBatchBackend(make_openai_client(get_openai_key(), **OPENAI_CLIENT_KWARGS))
+
+        batch_summaries = prefetch_first_turns(batch_configs, backend, response_cache, BATCH_DIR, num_guesses=NUM_GUESSES)
+        response_cache.close()
+
+        for name, batch_summary in batch_summaries.items():
+            print(f"{name}: batched {batch_summary['num_requests']} first turns, {batch_summary['num_responses']} responses received")
+
+    # One queue for the whole sweep, longest expected conversations first, so that the workers stay
+    # busy until the very end instead of waiting for the slowest puzzle of each config in turn
+    estimator = StepEstimator.from_results(SAVE_DIR, default=NUM_GUESSES)
+
+    def expected_cost(job):
+        (solver_type, llm_name, chain_of_thought, _), (puzzle_id, seeds) = job
+        num_seeds = len(seeds) if MULTI_SAMPLE_SEEDS else 1
+        return num_seeds * estimator.estimate(solver_type.__name__, llm_name, chain_of_thought, puzzle_id)
+
+    jobs = longest_first(jobs, expected_cost)
+    total = sum([len(missing_seeds) for missing_seeds in missing.values()])
+
+    pbar = tqdm(desc=f"Running {len(writers)} configs", total=total)
+    try:
+        if NUM_PROCS == 1:
+            init_worker(REPLAY_ONLY, OPENAI_CLIENT_KWARGS)
+            for config, results in map(run_job, jobs):
+                for result in results:
+                    writers[config].write(result)
+                    pbar.update(1)
+
+        else:
+            # Workers take the next job from the shared queue as soon as they finish one
+            with mp.Pool(NUM_PROCS, initializer=init_worker, initargs=(REPLAY_ONLY, OPENAI_CLIENT_KWARGS)) as pool:
+                for config, results in pool.imap_unordered(run_job, jobs, chunksize=1):
+                    for result in results:
+                        writers[config].write(result)
                         pbar.update(1)
 
-                        with open(os.path.join(SAVE_DIR, filename), "w") as f:
-                            json.dump(results, f)
\ No newline at end of file
+                # Let the workers exit normally, so that they write their profiles
+                pool.close()
+                pool.join()
+
+    finally:
+        pbar.close()
+        for writer in writers.values():
+            writer.close()
+
+    # With CONNECTIONS_PROFILE set, summarize where the time went in every process of the run
+    run_report = report()
+    if run_report is not None:
+        print(f"\n{run_report}")
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,470 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
 import os
 import re
+import time
 import typing
 
 import backoff
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
-from puzzle import ConnectionsPuzzle, PuzzleReponse
+from puzzle import ConnectionsPuzzle, PuzzleReponse, format_word
+from checkpoint_store import CheckpointStore
+from profiling import count, span
 from prompts import *
+from rate_limit import AsyncRateLimiter, estimate_tokens
+from response_cache import ResponseCache
 
-class GPTSolver():
+def _record_backoff(details: dict):
+    '''
+    Backoff handler that counts the retries and the time spent waiting in the current API call
+    '''
+    solver = details["args"][0]
+    solver._call["retries"] += 1
+    solver._call["backoff_s"] += details["wait"]
+
+def _header_int(headers, name: str) -> typing.Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+class GPTSolver(ABC):
     def __init__(self,
-                 openai_client: OpenAI,
+                 openai_client: typing.Union[OpenAI, AsyncOpenAI],
                  openai_model_str: str,
                  max_openai_tokens: int = 1024,
-                 openai_temperature: float = 0.0):
+                 openai_temperature: float = 0.0,
+                 rate_limiter: typing.Optional[AsyncRateLimiter] = None,
+                 response_cache: typing.Optional[ResponseCache] = None):
 
-        # Instantiate the client
+        # Instantiate the client (an AsyncOpenAI client is needed for solve_async)
         self.client = openai_client
 
         self.openai_model_str = openai_model_str
         self.max_openai_tokens = max_openai_tokens
         self.openai_temperature = openai_temperature
 
-    @backoff.on_exception(backoff.expo, openai.RateLimitError)
+        # Optional requests / tokens per minute budget, used by the async path
+        self.rate_limiter = rate_limiter
+
+        # Optional cache of responses to identical requests (for temperature 0)
+        self.response_cache = response_cache
+
+        # Prompt / completion tokens of each turn of the last solve
+        self.turn_tokens = []
+
+        # Telemetry of each call to the model in the last solve (see _start_call)
+        self.call_log = []
+        self._call = None
+
+        # The model's response at each turn of the last solve, which a checkpoint replays on resume
+        self.responses = []
+
+    def _request_kwargs(self, messages, n: typing.Optional[int] = None) -> dict:
+        '''
+        The arguments of the chat completion request for the given messages, asking for `n` samples
+        if `n` is given. A request for samples always carries `n` (even `n=1`), so that its cache
+        entry (a list of responses) never shares a key with a single response
+        '''
+        request_kwargs = dict(model=self.openai_model_str,
+                              max_tokens=self.max_openai_tokens,
+                              temperature=self.openai_temperature,
+                              messages=messages,
+                              seed=self.seed)
+        if n is not None:
+            request_kwargs["n"] = n
+
+        return request_kwargs
+
+    def _start_call(self):
+        '''
+        Start recording the telemetry of a call to the model. A call that is answered from the
+        response cache keeps `cached` set and has no token usage, unless its response was paid for
+        through the batch API, in which case it is marked `batched` with the batch's token usage
+        '''
+        self._call = {
+            "timestamp": time.time(),
+            "latency_s": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "retries": 0,
+            "backoff_s": 0.0,
+            "ratelimit_remaining_requests": None,
+            "ratelimit_remaining_tokens": None,
+            "cached": True,
+            "batched": False,
+            "num_samples": 1,
+            "shared": False,
+        }
+        return time.perf_counter()
+
+    def _finish_call(self, start: float):
+        self._call["latency_s"] = time.perf_counter() - start
+        self.call_log.append(self._call)
+
+        count("llm.calls")
+        if self._call["cached"]:
+            count("llm.cached")
+        if self._call["batched"]:
+            count("llm.batched")
+
+    def _share_call(self, call: dict):
+        '''
+        Record a call made by another solver whose samples included this solver's response. The
+        usage is counted in the other solver's log, so it is not repeated here
+        '''
+        self.call_log.append(dict(call, prompt_tokens=None, completion_tokens=None, batched=False, shared=True))
+
+    def _record_response(self, response, completion):
+        '''
+        Record the token usage and rate limit headers of an API response in the current call
+        '''
+        self._call["cached"] = False
+        if completion.usage is not None:
+            self._call["prompt_tokens"] = completion.usage.prompt_tokens
+            self._call["completion_tokens"] = completion.usage.completion_tokens
+
+        self._call["ratelimit_remaining_requests"] = _header_int(response.headers, "x-ratelimit-remaining-requests")
+        self._call["ratelimit_remaining_tokens"] = _header_int(response.headers, "x-ratelimit-remaining-tokens")
+
+    def _record_batch_usage(self, usage: typing.Optional[dict]):
+        '''
+        Record the token usage of a cached response that was paid for through the batch API
+        '''
+        if usage is None:
+            return
+
+        self._call["cached"] = False
+        self._call["batched"] = True
+        self._call["prompt_tokens"] = usage["prompt_tokens"]
+        self._call["completion_tokens"] = usage["completion_tokens"]
+
     def _query_openai(self, messages):
         '''
         Query the specified openai model with the given prompt, and return the response. Assumes
-        that the API key has already been set. Retries with exponentially-increasing delays in
-        case of rate limit errors
+        that the API key has already been set. Responses are looked up in (and added to) the
+        response cache, if the solver has one. The telemetry of the call is added to `call_log`
         '''
+        start = self._start_call()
+
+        with span("llm.query"):
+            if self.response_cache is None:
+                response = self._send_request(messages)
+            else:
+                request = self._request_kwargs(messages)
+                response = self.response_cache.get_or_query(request, lambda: self._send_request(messages))
+                if self._call["cached"]:
+                    self._record_batch_usage(self.response_cache.get_batch_usage(self.response_cache.key(request)))
+
+        self._finish_call(start)
+        return response
 
+    async def _query_openai_async(self, messages):
+        '''
+        Asynchronous version of _query_openai, for use with an AsyncOpenAI client
+        '''
+        start = self._start_call()
 
-        response = self.client.chat.completions.with_raw_response.create(
-                    model=self.openai_model_str,
-                    max_tokens=self.max_openai_tokens,
-                    temperature=self.openai_temperature,
-                    messages=messages,
-                    seed=self.seed
-            )
+        with span("llm.query"):
+            if self.response_cache is None:
+                response = await self._send_request_async(messages)
+            else:
+                request = self._request_kwargs(messages)
+                response = await self.response_cache.get_or_query_async(request, lambda: self._send_request_async(messages))
+                if self._call["cached"]:
+                    self._record_batch_usage(await asyncio.to_thread(self.response_cache.get_batch_usage, self.response_cache.key(request)))
+
+        self._finish_call(start)
+        return response
+
+    def _query_openai_samples(self, messages, n: int):
+        '''
+        Query the model for `n` samples of the response to the same messages in a single request,
+        and return the list of responses. Cached like _query_openai
+        '''
+        start = self._start_call()
+        self._call["num_samples"] = n
+
+        with span("llm.query_samples"):
+            if self.response_cache is None:
+                responses = self._send_request(messages, n)
+            else:
+                request = self._request_kwargs(messages, n)
+                responses = json.loads(self.response_cache.get_or_query(request, lambda: json.dumps(self._send_request(messages, n))))
+                if self._call["cached"]:
+                    self._record_batch_usage(self.response_cache.get_batch_usage(self.response_cache.key(request)))
+
+        self._finish_call(start)
+        return responses
+
+    async def _query_openai_samples_async(self, messages, n: int):
+        '''
+        Asynchronous version of _query_openai_samples
+        '''
+        start = self._start_call()
+        self._call["num_samples"] = n
+
+        with span("llm.query_samples"):
+            if self.response_cache is None:
+                responses = await self._send_request_async(messages, n)
+            else:
+                async def query_fn():
+                    return json.dumps(await self._send_request_async(messages, n))
+
+                request = self._request_kwargs(messages, n)
+                responses = json.loads(await self.response_cache.get_or_query_async(request, query_fn))
+                if self._call["cached"]:
+                    self._record_batch_usage(await asyncio.to_thread(self.response_cache.get_batch_usage, self.response_cache.key(request)))
+
+        self._finish_call(start)
+        return responses
+
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, on_backoff=_record_backoff)
+    def _send_request(self, messages, n: typing.Optional[int] = None):
+        '''
+        Send a chat completion request to the API and return the response (or the list of `n`
+        responses, if samples are requested). Retries with exponentially-increasing
+        delays in case of rate limit errors
+        '''
+
+
+        response = self.client.chat.completions.with_raw_response.create(**self._request_kwargs(messages, n))
+        completion = response.parse()
+        self._record_response(response, completion)
+
+        if n is not None:
+            return [choice.message.content for choice in sorted(completion.choices, key=lambda choice: choice.index)]
+
+        reponse_content = completion.choices[0].message.content
+
+        return reponse_content
+
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, on_backoff=_record_backoff)
+    async def _send_request_async(self, messages, n: typing.Optional[int] = None):
+        '''
+        Asynchronous version of _send_request. If the solver has a rate limiter, waits for room in
+        the budget before sending the request
+        '''
+        estimated_tokens = estimate_tokens(messages, self.max_openai_tokens * (n or 1))
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(estimated_tokens)
+
+        response = await self.client.chat.completions.with_raw_response.create(**self._request_kwargs(messages, n))
         completion = response.parse()
+        self._record_response(response, completion)
+
+        if self.rate_limiter is not None and completion.usage is not None:
+            self.rate_limiter.settle(estimated_tokens, completion.usage.total_tokens)
+
+        if n is not None:
+            return [choice.message.content for choice in sorted(completion.choices, key=lambda choice: choice.index)]
 
         reponse_content = completion.choices[0].message.content
 
         return reponse_content
+
+    @abstractmethod
+    def _solve_steps(self, puzzle: ConnectionsPuzzle, invalid_limit: int = 5, seed: int = 0):
+        '''
+        Generator implementing the conversation with the language model: it yields the messages to
+        send, receives the model's response, and returns the solve results when it finishes
+        '''
+
+    def _record_turn(self, messages, response):
+        '''
+        Record the number of tokens sent and received in one turn of the conversation, as reported
+        by the API (or estimated, for responses from the cache)
+        '''
+        call = self.call_log[-1]
+        self.responses.append(response)
+        self.turn_tokens.append({
+            "prompt_tokens": call["prompt_tokens"] if call["prompt_tokens"] is not None else estimate_tokens(messages),
+            "completion_tokens": call["completion_tokens"] if call["completion_tokens"] is not None else len(response or "") // 4,
+        })
+
+    def _snapshot(self, puzzle: ConnectionsPuzzle, messages) -> dict:
+        '''
+        The puzzle state and a hash of the next messages, to check a replayed conversation against
+        '''
+        return {
+            "puzzle": {"words": list(puzzle.words), "guesses_remaining": puzzle.guesses_remaining,
+                       "revealed_colors": list(puzzle.revealed_colors)},
+            "messages_hash": ResponseCache.key(messages),
+        }
+
+    def _start(self, puzzle: ConnectionsPuzzle, invalid_limit: int, seed: int, checkpoint: typing.Optional[dict] = None):
+        '''
+        Start the conversation, and return it with its first messages. With a checkpoint, the
+        checkpointed responses are sent to the new conversation first, which rebuilds the puzzle
+        state and message history without calling the API, and the conversation continues from
+        the turn after them. If the replay does not reach the checkpointed state (e.g. the prompts
+        or the board have changed since), the checkpoint is ignored
+        '''
+        steps = self._solve_steps(puzzle, invalid_limit=invalid_limit, seed=seed)
+        llm_messages = next(steps)
+
+        self.turn_tokens = []
+        self.call_log = []
+        self.responses = []
+
+        if checkpoint is None:
+            return steps, llm_messages
+
+        try:
+            for llm_response in checkpoint["responses"]:
+                llm_messages = steps.send(llm_response)
+        except StopIteration:
+            return self._start(puzzle, invalid_limit, seed)
+
+        if self._snapshot(puzzle, llm_messages) != {"puzzle": checkpoint["puzzle"], "messages_hash": checkpoint["messages_hash"]}:
+            return self._start(puzzle, invalid_limit, seed)
+
+        # The replayed turns were paid for before the interruption, so their telemetry is kept
+        self.turn_tokens = checkpoint["turn_tokens"]
+        self.call_log = checkpoint["call_log"]
+        self.responses = checkpoint["responses"]
+
+        return steps, llm_messages
+
+    def _save_checkpoint(self, checkpoint_store: CheckpointStore, checkpoint_key: str, puzzle: ConnectionsPuzzle, messages):
+        '''
+        Save the conversation after a turn, with the next messages to send
+        '''
+        checkpoint_store.put(checkpoint_key, dict(self._snapshot(puzzle, messages), responses=self.responses,
+                                                  turn_tokens=self.turn_tokens, call_log=self.call_log))
+
+    def solve(self,
+              puzzle: ConnectionsPuzzle,
+              invalid_limit: int = 5,
+              seed: int = 0,
+              checkpoint_store: typing.Optional[CheckpointStore] = None,
+              checkpoint_key: typing.Optional[str] = None):
+        '''
+        Attempt to solve the provided puzzle by querying the language model. With a checkpoint
+        store, the conversation is saved under `checkpoint_key` after every turn, and a saved
+        conversation is resumed from its last turn
+        '''
+        checkpoint = checkpoint_store.get(checkpoint_key) if checkpoint_store is not None else None
+
+        try:
+            steps, llm_messages = self._start(puzzle, invalid_limit, seed, checkpoint)
+            while True:
+                llm_response = self._query_openai(llm_messages)
+                self._record_turn(llm_messages, llm_response)
+
+                llm_messages = steps.send(llm_response)
+                if checkpoint_store is not None:
+                    self._save_checkpoint(checkpoint_store, checkpoint_key, puzzle, llm_messages)
+
+        except StopIteration as stop:
+            if checkpoint_store is not None:
+                checkpoint_store.delete(checkpoint_key)
+
+            return stop.value
+
+    async def solve_async(self,
+                          puzzle: ConnectionsPuzzle,
+                          invalid_limit: int = 5,
+                          seed: int = 0,
+                          checkpoint_store: typing.Optional[CheckpointStore] = None,
+                          checkpoint_key: typing.Optional[str] = None):
+        '''
+        Asynchronous version of solve, so that many puzzles can be solved concurrently on one event loop
+        '''
+        checkpoint = checkpoint_store.get(checkpoint_key) if checkpoint_store is not None else None
+
+        try:
+            steps, llm_messages = self._start(puzzle, invalid_limit, seed, checkpoint)
+            while True:
+                llm_response = await self._query_openai_async(llm_messages)
+                self._record_turn(llm_messages, llm_response)
+
+                llm_messages = steps.send(llm_response)
+                if checkpoint_store is not None:
+                    self._save_checkpoint(checkpoint_store, checkpoint_key, puzzle, llm_messages)
+
+        except StopIteration as stop:
+            if checkpoint_store is not None:
+                checkpoint_store.delete(checkpoint_key)
+
+            return stop.value
     
+    @staticmethod
+    def _start_samples(solvers: list, puzzles: typing.List[ConnectionsPuzzle], seeds: typing.List[int], invalid_limit: int):
+        '''
+        Start one conversation per seed, and return the conversations and their first messages. The
+        first messages are equal, so they are sent once, but each conversation goes on to extend
+        its own list of messages
+        '''
+        all_steps = []
+        for solver, puzzle, seed in zip(solvers, puzzles, seeds):
+            all_steps.append(solver._solve_steps(puzzle, invalid_limit=invalid_limit, seed=seed))
+            solver.turn_tokens = []
+            solver.call_log = []
+            solver.responses = []
+
+        first_messages = [next(steps) for steps in all_steps]
+        if any(llm_messages != first_messages[0] for llm_messages in first_messages):
+            raise ValueError("Sampled conversations must start with the same messages (use the same board for every seed)")
+
+        return all_steps, first_messages
+
+    @staticmethod
+    def solve_samples(solvers: list, puzzles: typing.List[ConnectionsPuzzle], seeds: typing.List[int], invalid_limit: int = 5):
+        '''
+        Solve a puzzle once per seed, with one solver and one puzzle instance per seed. The puzzles
+        must have the same board, so that every conversation starts with the same request: it is
+        sent once (with the first seed) asking for one sample per seed, and each sample then
+        continues as its own conversation. Returns the solve results of each seed
+        '''
+        all_steps, first_messages = GPTSolver._start_samples(solvers, puzzles, seeds, invalid_limit)
+
+        first_responses = solvers[0]._query_openai_samples(first_messages[0], len(seeds))
+        assert len(first_responses) == len(seeds), f"Expected {len(seeds)} samples, got {len(first_responses)}"
+        for solver in solvers[1:]:
+            solver._share_call(solvers[0].call_log[-1])
+
+        results = []
+        for solver, steps, llm_messages_i, llm_response in zip(solvers, all_steps, first_messages, first_responses):
+            try:
+                while True:
+                    solver._record_turn(llm_messages_i, llm_response)
+                    llm_messages_i = steps.send(llm_response)
+                    llm_response = solver._query_openai(llm_messages_i)
+
+            except StopIteration as stop:
+                results.append(stop.value)
+
+        return results
+
+    @staticmethod
+    async def solve_samples_async(solvers: list, puzzles: typing.List[ConnectionsPuzzle], seeds: typing.List[int], invalid_limit: int = 5):
+        '''
+        Asynchronous version of solve_samples, continuing the sampled conversations concurrently
+        '''
+        all_steps, first_messages = GPTSolver._start_samples(solvers, puzzles, seeds, invalid_limit)
+
+        first_responses = await solvers[0]._query_openai_samples_async(first_messages[0], len(seeds))
+        assert len(first_responses) == len(seeds), f"Expected {len(seeds)} samples, got {len(first_responses)}"
+        for solver in solvers[1:]:
+            solver._share_call(solvers[0].call_log[-1])
+
+        async def branch(solver, steps, llm_messages_i, llm_response):
+            try:
+                while True:
+                    solver._record_turn(llm_messages_i, llm_response)
+                    llm_messages_i = steps.send(llm_response)
+                    llm_response = await solver._query_openai_async(llm_messages_i)
+
+            except StopIteration as stop:
+                return stop.value
+
+        return await asyncio.gather(*[branch(*args) for args in zip(solvers, all_steps, first_messages, first_responses)])
+
     def reset(self):
         '''
         Reset the solver for a new puzzle
@@ -53,23 +473,32 @@ class GPTSolver():
     
 class IterativeGPTSolver(GPTSolver):
     '''
-    LLM-based solver for the Connections puzzle using an iterative approach, providing all previous message history along the way
+    LLM-based solver for the Connections puzzle using an iterative approach, providing all previous message history along the way.
+    With `compact_state`, the history is replaced by a single prompt each turn that states the rules once, followed by the
+    groups found so far, the previous guesses with the game's responses, and the remaining words, so the prompt size stays
+    bounded however long the puzzle runs
     '''
     def __init__(self,
-                 openai_client: OpenAI,
+                 openai_client: typing.Union[OpenAI, AsyncOpenAI],
                  openai_model_str: str,
                  max_openai_tokens: int = 1024,
                  openai_temperature: float = 0.0,
                  use_system_prompt: bool = False,
-                 chain_of_thought: bool = False):
+                 chain_of_thought: bool = False,
+                 rate_limiter: typing.Optional[AsyncRateLimiter] = None,
+                 response_cache: typing.Optional[ResponseCache] = None,
+                 compact_state: bool = False):
 
-        super().__init__(openai_client, openai_model_str, max_openai_tokens, openai_temperature)
+        super().__init__(openai_client, openai_model_str, max_openai_tokens, openai_temperature, rate_limiter, response_cache)
 
         # Matches to text inbetween <ANSWER> delimiters
         self.answer_regex = r"(?<=<ANSWER>)([\S\s]*?)(?=</ANSWER>)"
     
+        self.compact_state = compact_state
+
         self.prompt_mapping = {
              "INITIAL": INITIAL_PROMPT_ITERATIVE,
+             "COMPACT": COMPACT_PROMPT_ITERATIVE,
              "CORRECT": CORRECT_GUESS_PROMPT_ITERATIVE,
              "NEARLY_CORRECT": NEARLY_CORRECT_GUESS_PROMPT_ITERATIVE,
              "INCORRECT": INCORRECT_GUESS_PROMPT_ITERATIVE,
@@ -78,8 +507,27 @@ class IterativeGPTSolver(GPTSolver):
 
         self.use_system_prompt = use_system_prompt
         self.cot_injection = COT_PROMPT_ITERATIVE if chain_of_thought else ""
+
+    def _compact_messages(self, puzzle: ConnectionsPuzzle, guess_feedback: typing.List[str]):
+        '''
+        Build the single prompt that describes the current state of the puzzle in compact mode
+        '''
+        revealed_groups = [f"- {category['description']}: [{', '.join(format_word(word) for word in category['words'])}]"
+                           for category in puzzle.revealed]
+
+        prompt = self.prompt_mapping["COMPACT"].format(puzzle.words,
+                                                       "\n".join(guess_feedback) or "None yet",
+                                                       "\n".join(revealed_groups) or "None yet",
+                                                       self.cot_injection)
+
+        llm_messages = []
+        if self.use_system_prompt:
+            llm_messages.append({"role": "system", "content": SYSTEM_PROMPT})
+        llm_messages.append({"role": "user", "content": prompt})
+
+        return llm_messages
     
-    def solve(self, puzzle: ConnectionsPuzzle, invalid_limit: int = 5, seed: int = 0):
+    def _solve_steps(self, puzzle: ConnectionsPuzzle, invalid_limit: int = 5, seed: int = 0):
         '''
         Attempt to solve the provided puzzle by querying the language model
         '''
@@ -94,14 +542,18 @@ class IterativeGPTSolver(GPTSolver):
         # Messages contains the list of interleaved prompts and responses from the LLM
         llm_messages = []
 
+        # In compact mode, each previous guess and the game's response to it (instead of the message history)
+        guess_feedback = []
+
         # Reset the puzzle to obtain initial observation
         observation, done, reward = puzzle.reset()
         game_message = observation['message']
 
         # Add the initial prompt to messages
-        if self.use_system_prompt:
-            llm_messages.append({"role": "system", "content": SYSTEM_PROMPT})
-        llm_messages.append({"role": "user", "content": self.prompt_mapping["INITIAL"].format(puzzle.words, self.cot_injection)})
+        if not self.compact_state:
+            if self.use_system_prompt:
+                llm_messages.append({"role": "system", "content": SYSTEM_PROMPT})
+            llm_messages.append({"role": "user", "content": self.prompt_mapping["INITIAL"].format(puzzle.words, self.cot_injection)})
 
         done = False
         reward = 0
@@ -109,8 +561,12 @@ class IterativeGPTSolver(GPTSolver):
         # continue until we solve the puzzle, run out of guesses, or have too many invalid attempts (leads to it getting stuck in a loop)        
         while not done and invalid_count < invalid_limit:
 
+            # In compact mode the prompt is rebuilt from the puzzle state every turn
+            if self.compact_state:
+                llm_messages = self._compact_messages(puzzle, guess_feedback)
+
             # Query the LLM with the current message history and record its response
-            llm_response = self._query_openai(llm_messages)
+            llm_response = yield llm_messages
 
             # Attempt to parse the guess from the LLM response
             answer_match = re.findall(self.answer_regex, llm_response)
@@ -147,8 +603,15 @@ class IterativeGPTSolver(GPTSolver):
                 invalid_count += 1
                 guess_log.append("Failed regex parse")
 
-            # Inject info into new prompt and add to message history
-            llm_messages.append({"role": "user", "content": next_prompt.format(puzzle.words, game_message, self.cot_injection)})
+            if self.compact_state:
+                if answer_match:
+                    guess_feedback.append(f"- [{', '.join(word.strip() for word in guess)}]: {game_message}")
+                else:
+                    guess_feedback.append("- (no answer in the required format): Your answer wasn't formatted correctly.")
+
+            else:
+                # Inject info into new prompt and add to message history
+                llm_messages.append({"role": "user", "content": next_prompt.format(puzzle.words, game_message, self.cot_injection)})
             step_count += 1
 
         solved = (reward == 1)
@@ -157,15 +620,17 @@ class IterativeGPTSolver(GPTSolver):
 
 class OneShotGPTSolver(GPTSolver):
     def __init__(self,
-                 openai_client: OpenAI,
+                 openai_client: typing.Union[OpenAI, AsyncOpenAI],
                  openai_model_str: str,
                  max_openai_tokens: int = 1024,
                  openai_temperature: float = 0.0,
                  use_system_prompt: bool = False,
-                 chain_of_thought: bool = False):
+                 chain_of_thought: bool = False,
+                 rate_limiter: typing.Optional[AsyncRateLimiter] = None,
+                 response_cache: typing.Optional[ResponseCache] = None):
 
 
-        super().__init__(openai_client, openai_model_str, max_openai_tokens, openai_temperature)
+        super().__init__(openai_client, openai_model_str, max_openai_tokens, openai_temperature, rate_limiter, response_cache)
 
         self.prompt_mapping = {
              "INITIAL": INITIAL_PROMPT_ONESHOT,
@@ -179,7 +644,7 @@ class OneShotGPTSolver(GPTSolver):
         # Matches to text inbetween <ANSWER> delimiters
         self.answer_regex = r"(?<=<ANSWER>)([\S\s]*?)(?=</ANSWER>)"
 
-    def solve(self, puzzle: ConnectionsPuzzle, invalid_limit: int = 5, seed: int = 0):
+    def _solve_steps(self, puzzle: ConnectionsPuzzle, invalid_limit: int = 5, seed: int = 0):
         '''
         Attempt to solve the provided puzzle by querying the language model
         '''
@@ -214,7 +679,7 @@ class OneShotGPTSolver(GPTSolver):
         while invalid_count < invalid_limit and not done:
 
             # Query the LLM with the current message history and record its response
-            llm_response = self._query_openai(llm_messages)
+            llm_response = yield llm_messages
             llm_messages.append({"role": "assistant", "content": llm_response})
 
             # Attempt to parse the guess from the LLM response
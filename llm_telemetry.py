@@ -0,0 +1,107 @@
+import glob
+import os
+import typing
+
+import numpy as np
+from tabulate import tabulate
+
+from results_io import load_results
+
+# USD per 1000 prompt / completion tokens
+PRICES_PER_1K_TOKENS = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+}
+
+# Requests sent through the batch API are billed at this fraction of the prices above
+BATCH_PRICE_FACTOR = 0.5
+
+def call_cost(llm_name: str, prompt_tokens: int, completion_tokens: int) -> typing.Optional[float]:
+    '''
+    Return the cost of a call in USD, or None if the model's prices are unknown
+    '''
+    if llm_name not in PRICES_PER_1K_TOKENS:
+        return None
+
+    prompt_price, completion_price = PRICES_PER_1K_TOKENS[llm_name]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+def summarize_calls(results: typing.List[dict]) -> dict:
+    '''
+    Roll up the per-call telemetry (`llm_calls`) of a config's results: token totals and cost,
+    token throughput over the span of the run, latency percentiles, and retry / backoff totals.
+    Calls answered from the response cache, and samples shared from another seed's call, are
+    counted separately and are free. Calls whose response was prefetched through the batch API
+    count towards the token totals and cost (at the batch price), but not the latency or throughput
+    '''
+    calls = [call for result in results for call in result.get("llm_calls") or []]
+    api_calls = [call for call in calls if not call["cached"] and not call.get("shared") and not call.get("batched")]
+    batched_calls = [call for call in calls if call.get("batched")]
+
+    api_prompt_tokens = sum([call["prompt_tokens"] or 0 for call in api_calls])
+    api_completion_tokens = sum([call["completion_tokens"] or 0 for call in api_calls])
+    batched_prompt_tokens = sum([call["prompt_tokens"] or 0 for call in batched_calls])
+    batched_completion_tokens = sum([call["completion_tokens"] or 0 for call in batched_calls])
+    llm_name = results[0]["llm_name"] if results else None
+
+    cost = call_cost(llm_name, api_prompt_tokens, api_completion_tokens)
+    if cost is not None:
+        cost += BATCH_PRICE_FACTOR * call_cost(llm_name, batched_prompt_tokens, batched_completion_tokens)
+
+    summary = {
+        "num_results": len(results),
+        "num_calls": len(calls),
+        "num_cached": len([call for call in calls if call["cached"]]),
+        "num_shared": len([call for call in calls if call.get("shared")]),
+        "num_batched": len(batched_calls),
+        "prompt_tokens": api_prompt_tokens + batched_prompt_tokens,
+        "completion_tokens": api_completion_tokens + batched_completion_tokens,
+        "cost_usd": cost,
+        "tokens_per_s": None,
+        "latency_p50_s": None,
+        "latency_p90_s": None,
+        "latency_p99_s": None,
+        "retries": sum([call["retries"] for call in api_calls]),
+        "backoff_s": sum([call["backoff_s"] for call in api_calls]),
+        "min_ratelimit_remaining_requests": min([call["ratelimit_remaining_requests"] for call in api_calls
+                                                 if call["ratelimit_remaining_requests"] is not None], default=None),
+    }
+
+    if api_calls:
+        latencies = np.array([call["latency_s"] for call in api_calls])
+        summary["latency_p50_s"], summary["latency_p90_s"], summary["latency_p99_s"] = np.percentile(latencies, [50, 90, 99]).tolist()
+
+        # Throughput over the wall-clock span of the calls, so concurrent calls are not double counted
+        span = max([call["timestamp"] + call["latency_s"] for call in api_calls]) - min([call["timestamp"] for call in api_calls])
+        if span > 0:
+            summary["tokens_per_s"] = (api_prompt_tokens + api_completion_tokens) / span
+
+    return summary
+
+def summarize_results_dir(save_dir: str = "results") -> typing.Dict[str, dict]:
+    '''
+    Summarize the call telemetry of every LLM results file in a directory, keyed by config name
+    '''
+    summaries = {}
+    for path in sorted(glob.glob(os.path.join(save_dir, "*GPTSolver_*.jsonl"))):
+        results = load_results(path)
+        if any(result.get("llm_calls") for result in results):
+            config = os.path.basename(path).replace("_results.jsonl", "")
+            summaries[config] = summarize_calls(results)
+
+    return summaries
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the token usage, cost and latency of the LLM experiments")
+    parser.add_argument("--save-dir", type=str, default="results")
+    args = parser.parse_args()
+
+    summaries = summarize_results_dir(args.save_dir)
+    columns = ["num_calls", "num_cached", "num_shared", "num_batched", "prompt_tokens", "completion_tokens", "cost_usd", "tokens_per_s",
+               "latency_p50_s", "latency_p90_s", "latency_p99_s", "retries", "backoff_s"]
+
+    rows = [[config] + [summary[column] for column in columns] for config, summary in summaries.items()]
+    print(tabulate(rows, headers=["config"] + columns, floatfmt=".3f"))
@@ -0,0 +1,287 @@
+import ast
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import typing
+
+from puzzle import get_puzzle_store
+from rate_limit import TokenBucket
+
+class MockChatCompletions():
+    '''
+    The behaviour of the mock chat-completions server: which responses it gives, how long it takes
+    to give them, and when it rejects requests with a 429. Responses either cycle through a fixed
+    script, or are "puzzle-aware": the puzzle is recognised from the words in the prompt, and the
+    answer is a correct group with probability `accuracy` and a random one otherwise.
+
+    Args:
+        script (List[str]): Fixed responses to cycle through (None for puzzle-aware responses)
+        accuracy (float): The probability that a puzzle-aware answer is correct
+        latency_distribution (str): "constant", "uniform" or "lognormal"
+        latency_mean (float): The mean response latency, in seconds
+        latency_spread (float): The half-width (uniform) or sigma (lognormal) of the latency
+        requests_per_minute (float): Requests above this rate get a 429 (None for no limit)
+        error_rate (float): The probability that any request gets a 429 regardless of the rate
+        data_dir (str): The directory where the puzzle data is stored
+        seed (int): The seed for the random choices
+    '''
+    def __init__(self,
+                 script: typing.Optional[typing.List[str]] = None,
+                 accuracy: float = 0.5,
+                 latency_distribution: str = "constant",
+                 latency_mean: float = 0.0,
+                 latency_spread: float = 0.0,
+                 requests_per_minute: typing.Optional[float] = None,
+                 error_rate: float = 0.0,
+                 data_dir: str = "./data",
+                 seed: int = 0):
+
+        self.script = itertools.cycle(script) if script else None
+        self.accuracy = accuracy
+        self.latency_distribution = latency_distribution
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+
+        # The puzzles each word appears in, to recognise a puzzle from any of its words
+        store = get_puzzle_store(data_dir)
+        self.word_to_ids = {}
+        for id in range(1, len(store) + 1):
+            for word in store.formatted_words(id):
+                self.word_to_ids.setdefault(word, set()).add(id)
+        self.store = store
+
+        self.num_requests = 0
+        self.num_rate_limited = 0
+
+    def latency(self) -> float:
+        with self.lock:
+            if self.latency_distribution == "uniform":
+                return max(0.0, self.rng.uniform(self.latency_mean - self.latency_spread, self.latency_mean + self.latency_spread))
+
+            elif self.latency_distribution == "lognormal":
+                # Lognormal with the given mean, so that a few requests are much slower than the rest
+                if self.latency_mean <= 0:
+                    return 0.0
+                mu = math.log(self.latency_mean) - self.latency_spread ** 2 / 2
+                return self.rng.lognormvariate(mu, self.latency_spread)
+
+            return self.latency_mean
+
+    def admit(self) -> typing.Tuple[bool, dict]:
+        '''
+        Decide whether to serve a request, and return the rate limit headers to send with it
+        '''
+        with self.lock:
+            self.num_requests += 1
+            headers = {}
+
+            admitted = self.rng.random() >= self.error_rate
+            if self.request_bucket is not None:
+                if self.request_bucket.wait_time(1) > 0:
+                    admitted = False
+                elif admitted:
+                    self.request_bucket.consume(1)
+
+                headers["x-ratelimit-limit-requests"] = str(int(self.requests_per_minute))
+                headers["x-ratelimit-remaining-requests"] = str(max(0, int(self.request_bucket.level)))
+                headers["x-ratelimit-reset-requests"] = f"{self.request_bucket.wait_time(1):.3f}s"
+
+            if not admitted:
+                self.num_rate_limited += 1
+                headers["retry-after"] = "1"
+
+            return admitted, headers
+
+    @staticmethod
+    def _word_lists(text: str) -> typing.List[typing.List[str]]:
+        '''
+        Return every Python-style list of words in a prompt (the prompts show the words as a list)
+        '''
+        word_lists = []
+        for match in re.findall(r"\[[^\[\]]*\]", text):
+            try:
+                value = ast.literal_eval(match)
+            except (ValueError, SyntaxError):
+                continue
+
+            if isinstance(value, list) and value and all(isinstance(word, str) for word in value):
+                word_lists.append(value)
+
+        return word_lists
+
+    def respond(self, messages: typing.List[dict]) -> str:
+        '''
+        Return the content of the assistant's response to the conversation
+        '''
+        if self.script is not None:
+            with self.lock:
+                return next(self.script)
+
+        user_messages = [message["content"] for message in messages if message["role"] == "user"]
+        initial_words = self._word_lists(user_messages[0])
+        remaining_words = self._word_lists(user_messages[-1])
+
+        puzzle_id = self._identify(initial_words[-1]) if initial_words else None
+        if puzzle_id is None:
+            return "I'm not sure which puzzle this is."
+
+        remaining = remaining_words[-1] if remaining_words else initial_words[-1]
+        categories = self._categories(puzzle_id)
+        one_shot = "GROUP 4 NAME" in user_messages[0]
+
+        with self.lock:
+            correct = self.rng.random() < self.accuracy
+            shuffled = self.rng.sample(remaining, len(remaining))
+
+        if one_shot:
+            groups = categories if correct else [shuffled[idx:idx+4] for idx in range(0, len(shuffled), 4)]
+            lines = [f"GROUP {idx + 1}: [{', '.join(group)}]" for idx, group in enumerate(groups)]
+            return "<ANSWER>\n" + "\n".join(lines) + "\n</ANSWER>"
+
+        open_categories = [category for category in categories if set(category) <= set(remaining)]
+        group = open_categories[0] if correct and open_categories else shuffled[:4]
+
+        return f"<ANSWER> GROUP: [{', '.join(group)}] </ANSWER>"
+
+    def _identify(self, words: typing.List[str]) -> typing.Optional[int]:
+        '''
+        Return the ID of the puzzle containing all of the words, if there is exactly one
+        '''
+        ids = set.intersection(*[self.word_to_ids.get(word, set()) for word in words])
+        return ids.pop() if len(ids) == 1 else None
+
+    def _categories(self, puzzle_id: int) -> typing.List[typing.List[str]]:
+        words = self.store.formatted_words(puzzle_id)
+        return [list(words[idx:idx+4]) for idx in range(0, len(words), 4)]
+
+def _make_handler(behaviour: MockChatCompletions):
+
+    class MockChatHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: dict):
+            payload = json.dumps(body).encode("utf-8")
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}}, {})
+                return
+
+            time.sleep(behaviour.latency())
+
+            admitted, headers = behaviour.admit()
+            if not admitted:
+                self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                "code": "rate_limit_exceeded"}}, headers)
+                return
+
+            content = behaviour.respond(request["messages"])
+            prompt_tokens = sum([len(message["content"]) // 4 for message in request["messages"]])
+            completion_tokens = len(content) // 4
+
+            choices = [{"index": idx, "message": {"role": "assistant", "content": content if idx == 0 else behaviour.respond(request["messages"])},
+                        "finish_reason": "stop", "logprobs": None} for idx in range(request.get("n", 1))]
+
+            self._send_json(200, {
+                "id": f"chatcmpl-mock-{behaviour.num_requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": choices,
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            }, headers)
+
+    return MockChatHandler
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # A long listen backlog, so that bursts of concurrent connections are not dropped and retried
+    request_queue_size = 1024
+
+class MockChatServer():
+    '''
+    A local stand-in for the chat-completions API, served from a background thread. Point an
+    OpenAI client at `base_url` to use it.
+
+    Args:
+        behaviour (MockChatCompletions): How the server responds
+        host (str): The host to listen on
+        port (int): The port to listen on (0 picks a free port)
+    '''
+    def __init__(self,
+                 behaviour: typing.Optional[MockChatCompletions] = None,
+                 host: str = "127.0.0.1",
+                 port: int = 0):
+
+        self.behaviour = behaviour if behaviour is not None else MockChatCompletions()
+
+        self.server = _MockHTTPServer((host, port), _make_handler(self.behaviour))
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockChatServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local mock of the chat-completions API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--script", type=str, default=None, help="JSON file with a list of responses to cycle through")
+    parser.add_argument("--accuracy", type=float, default=0.5)
+    parser.add_argument("--latency-distribution", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--latency-mean", type=float, default=0.0, help="Mean latency in seconds")
+    parser.add_argument("--latency-spread", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    script = json.load(open(args.script, "r")) if args.script else None
+    behaviour = MockChatCompletions(script=script, accuracy=args.accuracy, latency_distribution=args.latency_distribution,
+                                    latency_mean=args.latency_mean, latency_spread=args.latency_spread,
+                                    requests_per_minute=args.requests_per_minute, error_rate=args.error_rate)
+
+    server = MockChatServer(behaviour, port=args.port)
+    print(f"Serving mock chat completions at {server.base_url}")
+    server.server.serve_forever()
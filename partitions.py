@@ -0,0 +1,347 @@
+from functools import lru_cache
+import heapq
+import itertools
+from itertools import combinations
+import math
+import os
+import time
+import typing
+
+import numpy as np
+
+from profiling import span
+
+@lru_cache(maxsize=None)
+def enumerate_groups(board_size: int = 16, group_size: int = 4) -> np.ndarray:
+    '''
+    Return every group of `group_size` word indices drawn from a board of `board_size` words, as
+    an array of shape (C(board_size, group_size), group_size). Groups are listed in the order of
+    `itertools.combinations`, so the row number of a group is its group id
+    '''
+    groups = np.array(list(combinations(range(board_size), group_size)), dtype=np.int16)
+    groups.setflags(write=False)
+
+    return groups
+
+@lru_cache(maxsize=None)
+def group_masks(board_size: int = 16, group_size: int = 4) -> np.ndarray:
+    '''
+    Return the bitmask of word indices covered by each group id
+    '''
+    groups = enumerate_groups(board_size, group_size).astype(np.int64)
+    masks = np.bitwise_or.reduce(np.left_shift(1, groups), axis=1)
+    masks.setflags(write=False)
+
+    return masks
+
+@lru_cache(maxsize=None)
+def mask_to_group_id(board_size: int = 16, group_size: int = 4) -> np.ndarray:
+    '''
+    Return a lookup table mapping a group bitmask to its group id (-1 for masks that are not groups)
+    '''
+    lookup = np.full(1 << board_size, -1, dtype=np.int32)
+    masks = group_masks(board_size, group_size)
+    lookup[masks] = np.arange(len(masks), dtype=np.int32)
+    lookup.setflags(write=False)
+
+    return lookup
+
+def _enumerate_partition_words(num_words: int, group_size: int) -> np.ndarray:
+    '''
+    Enumerate every partition of range(num_words) into groups of `group_size` words, as an array of
+    shape (num_partitions, num_words // group_size, group_size). Each partition is listed once, with
+    groups ordered by their smallest word
+    '''
+    if num_words == group_size:
+        return np.arange(group_size, dtype=np.int16).reshape(1, 1, group_size)
+
+    # The first group always contains word 0, so only the remaining members need to be chosen
+    rest = _enumerate_partition_words(num_words - group_size, group_size)
+    blocks = []
+    for others in combinations(range(1, num_words), group_size - 1):
+        first = np.array((0,) + others, dtype=np.int16)
+        remaining = np.array([idx for idx in range(num_words) if idx not in first], dtype=np.int16)
+
+        block = np.empty((len(rest), rest.shape[1] + 1, group_size), dtype=np.int16)
+        block[:, 0] = first
+        block[:, 1:] = remaining[rest]
+        blocks.append(block)
+
+    return np.concatenate(blocks)
+
+def enumerate_partitions(board_size: int = 16, group_size: int = 4) -> np.ndarray:
+    '''
+    Enumerate every way of splitting the board into groups, as an int16 array of shape
+    (num_partitions, board_size // group_size) holding the group id of each group
+    '''
+    assert board_size % group_size == 0, "Board size must be a multiple of the group size"
+
+    partition_words = _enumerate_partition_words(board_size, group_size).astype(np.int64)
+    masks = np.bitwise_or.reduce(np.left_shift(1, partition_words), axis=2)
+
+    return mask_to_group_id(board_size, group_size)[masks].astype(np.int16)
+
+def num_partitions(board_size: int = 16, group_size: int = 4) -> int:
+    '''
+    The number of distinct partitions of the board into groups
+    '''
+    num_groups = board_size // group_size
+    return math.factorial(board_size) // (math.factorial(group_size) ** num_groups * math.factorial(num_groups))
+
+def partition_index_path(data_dir: str = "./data", board_size: int = 16, group_size: int = 4) -> str:
+    '''
+    The location of the on-disk partition index for the given board
+    '''
+    return os.path.join(data_dir, f"all_guess_idxs_{board_size}_{group_size}.npy")
+
+def write_partition_index(data_dir: str = "./data", board_size: int = 16, group_size: int = 4) -> str:
+    '''
+    Enumerate every partition of the board and save it as an .npy file of int16 group ids. The file
+    is written under a temporary name and moved into place, so concurrent writers are harmless
+    '''
+    path = partition_index_path(data_dir, board_size, group_size)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        np.save(f, enumerate_partitions(board_size, group_size))
+    os.replace(tmp_path, path)
+
+    return path
+
+@lru_cache(maxsize=None)
+def load_partitions(data_dir: typing.Optional[str] = "./data", board_size: int = 16, group_size: int = 4) -> np.ndarray:
+    '''
+    Load the partition index as a read-only memory map, so every process shares a single copy in
+    the page cache. The index is generated on first use, or kept in memory if data_dir is None
+    '''
+    if data_dir is None:
+        partitions = enumerate_partitions(board_size, group_size)
+        partitions.setflags(write=False)
+        return partitions
+
+    path = partition_index_path(data_dir, board_size, group_size)
+    if not os.path.exists(path):
+        write_partition_index(data_dir, board_size, group_size)
+
+    partitions = np.load(path, mmap_mode="r")
+    assert partitions.shape == (num_partitions(board_size, group_size), board_size // group_size), \
+        f"Partition index at {path} does not match a board of {board_size} words in groups of {group_size}"
+
+    return partitions
+
+def score_groups(similarities: np.ndarray,
+                 aggregation_fn: typing.Callable = np.mean,
+                 group_size: int = 4) -> np.ndarray:
+    '''
+    Score every group on the board by aggregating the pairwise similarities between its words
+    (including each word with itself, matching the original per-group loop). The aggregation
+    function must be a NumPy reduction that accepts an `axis` argument, e.g. np.mean, np.min,
+    np.max or np.median
+    '''
+    with span("score_groups"):
+        similarities = np.asarray(similarities, dtype=np.float32)
+        groups = enumerate_groups(len(similarities), group_size)
+
+        pair_scores = similarities[groups[:, :, None], groups[:, None, :]]
+        pair_scores = pair_scores.reshape(len(groups), group_size * group_size)
+
+        return np.asarray(aggregation_fn(pair_scores, axis=1), dtype=np.float32)
+
+class PartitionScorer():
+    '''
+    Scores every partition of the board into groups in a handful of vectorized operations. The
+    C(board_size, group_size) possible groups are scored once, and each partition is stored as a
+    compact row of int16 group ids, so ranking the partitions is a single gather-and-sum followed
+    by an `argpartition` for the top-k.
+
+    Args:
+        board_size (int): The number of words on the board
+        group_size (int): The number of words in each group
+        data_dir (str): The directory of the on-disk partition index (None to keep it in memory)
+        partitions (np.ndarray): Optional precomputed array of partitions (as group ids)
+    '''
+    def __init__(self,
+                 board_size: int = 16,
+                 group_size: int = 4,
+                 data_dir: typing.Optional[str] = "./data",
+                 partitions: typing.Optional[np.ndarray] = None):
+
+        self.board_size = board_size
+        self.group_size = group_size
+
+        self.groups = enumerate_groups(board_size, group_size)
+        self.partitions = partitions if partitions is not None else load_partitions(data_dir, board_size, group_size)
+
+    def score_partitions(self, group_scores: np.ndarray) -> np.ndarray:
+        '''
+        Return the total score of every partition, given the score of every group
+        '''
+        with span("score_partitions"):
+            group_scores = np.asarray(group_scores, dtype=np.float32)
+            return group_scores[self.partitions].sum(axis=1)
+
+    def top_k(self, group_scores: np.ndarray, k: int) -> np.ndarray:
+        '''
+        Return the indices of the k highest-scoring partitions, best first
+        '''
+        scores = self.score_partitions(group_scores)
+        k = min(k, len(scores))
+
+        if k < len(scores):
+            top_idxs = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top_idxs = np.arange(len(scores))
+
+        return top_idxs[np.argsort(-scores[top_idxs], kind="stable")]
+
+    def to_words(self, partition_idx: int, words: typing.List[str]) -> typing.List[typing.List[str]]:
+        '''
+        Convert a partition index into a list of word groups
+        '''
+        return [[words[idx] for idx in self.groups[group_id]] for group_id in self.partitions[partition_idx]]
+
+class PartitionSearch():
+    '''
+    Lazy best-first (branch-and-bound) search over partitions of the board, which yields partitions
+    in descending order of total score without enumerating all of them. Search states are bitmasks
+    of the words that still need to be grouped; each state is extended with the groups that contain
+    its lowest remaining word, and ordered by the exact score so far plus an upper bound on the best
+    possible completion. Bounds and candidate groups are memoized by bitmask, since many partial
+    partitions share the same remaining words.
+
+    Args:
+        group_scores (np.ndarray): The score of every group id, e.g. from `score_groups`
+        board_size (int): The number of words on the board
+        group_size (int): The number of words in each group
+    '''
+    def __init__(self,
+                 group_scores: np.ndarray,
+                 board_size: int = 16,
+                 group_size: int = 4):
+
+        assert board_size % group_size == 0, "Board size must be a multiple of the group size"
+
+        self.board_size = board_size
+        self.group_size = group_size
+
+        self.groups = enumerate_groups(board_size, group_size)
+        self.masks = group_masks(board_size, group_size)
+        self.group_scores = np.asarray(group_scores, dtype=np.float64)
+
+        assert len(self.group_scores) == len(self.groups), "Expected one score per group"
+
+        # For every word, the ids, masks and scores of the groups containing it, best first
+        word_group_ids = np.array([np.flatnonzero((self.masks >> idx) & 1) for idx in range(board_size)])
+        order = np.argsort(-self.group_scores[word_group_ids], axis=1, kind="stable")
+        self.word_group_ids = np.take_along_axis(word_group_ids, order, axis=1)
+        self.word_group_masks = self.masks[self.word_group_ids]
+        self.word_group_scores = self.group_scores[self.word_group_ids]
+
+        self.full_mask = (1 << board_size) - 1
+        self.timed_out = False
+
+        # Maps a bitmask of remaining words to (upper bound, candidate group ids, candidate masks)
+        self._completions = {}
+
+    def _completion(self, remaining: int) -> typing.Tuple[float, np.ndarray, np.ndarray]:
+        '''
+        Return the memoized upper bound and candidate groups for the given remaining words
+        '''
+        if remaining in self._completions:
+            return self._completions[remaining]
+
+        if remaining == 0:
+            self._completions[remaining] = (0.0, None, None)
+            return self._completions[remaining]
+
+        remaining_words = [idx for idx in range(self.board_size) if remaining >> idx & 1]
+
+        # The first group in each word's score-sorted list that fits in the remaining words is
+        # the best group available to that word
+        available = (self.word_group_masks[remaining_words] & ~remaining) == 0
+        best_per_word = self.word_group_scores[remaining_words, available.argmax(axis=1)]
+
+        # Every word in a partition contributes 1 / group_size of its group's score, so the best
+        # group available to each word bounds the total from above
+        word_bound = best_per_word.sum() / self.group_size
+        num_groups_left = len(remaining_words) // self.group_size
+        bound = min(word_bound, num_groups_left * best_per_word.max())
+
+        # Only groups that contain the lowest remaining word are expanded, so each partition is
+        # reached along exactly one path
+        candidates = self.word_group_ids[remaining_words[0]][available[0]]
+
+        self._completions[remaining] = (bound, candidates, self.masks[candidates])
+        return self._completions[remaining]
+
+    def _greedy_completion(self, score: float, remaining: int,
+                           groups: typing.Tuple[int, ...]) -> typing.Tuple[float, typing.Tuple[int, ...]]:
+        '''
+        Complete a partial partition by repeatedly taking the best available group
+        '''
+        while remaining:
+            _, candidates, candidate_masks = self._completion(remaining)
+            score += self.group_scores[candidates[0]]
+            remaining &= ~int(candidate_masks[0])
+            groups = groups + (int(candidates[0]),)
+
+        return score, groups
+
+    def search(self, time_budget: typing.Optional[float] = None) -> typing.Iterator[typing.Tuple[float, typing.Tuple[int, ...]]]:
+        '''
+        Yield (score, group ids) for every partition in descending order of score. If a time
+        budget (in seconds) is given and runs out, the search stops expanding and instead greedily
+        completes the most promising partial partitions it has found so far, which are still
+        yielded lazily but are no longer guaranteed to be in exact score order
+        '''
+        start_time = time.perf_counter()
+        self.timed_out = False
+
+        bound, _, _ = self._completion(self.full_mask)
+        counter = itertools.count()
+        frontier = [(-bound, next(counter), 0.0, self.full_mask, (), True)]
+
+        while frontier:
+            _, _, score, remaining, groups, refined = heapq.heappop(frontier)
+
+            if remaining == 0:
+                yield score, groups
+                continue
+
+            if time_budget is not None and time.perf_counter() - start_time > time_budget:
+                self.timed_out = True
+                frontier.append((None, None, score, remaining, groups, refined))
+                break
+
+            bound, candidates, candidate_masks = self._completion(remaining)
+
+            # Children are pushed with their parent's bound, which is still valid for them, and only
+            # get their own (tighter) bound once they reach the top of the frontier
+            if not refined:
+                heapq.heappush(frontier, (-(score + bound), next(counter), score, remaining, groups, True))
+                continue
+
+            for group_id, group_mask in zip(candidates.tolist(), candidate_masks.tolist()):
+                heapq.heappush(frontier, (-(score + bound), next(counter), score + self.group_scores[group_id],
+                                          remaining & ~group_mask, groups + (group_id,), False))
+
+        # Out of time: the popped node goes first, followed by the rest of the frontier in order
+        if self.timed_out:
+            _, _, score, remaining, groups, _ = frontier.pop()
+            yield self._greedy_completion(score, remaining, groups)
+
+            while frontier:
+                _, _, score, remaining, groups, _ = heapq.heappop(frontier)
+                yield self._greedy_completion(score, remaining, groups)
+
+    def top_k(self, k: int, time_budget: typing.Optional[float] = None) -> typing.List[typing.Tuple[float, typing.Tuple[int, ...]]]:
+        '''
+        Return the (score, group ids) of the k best partitions found within the time budget
+        '''
+        return list(itertools.islice(self.search(time_budget), k))
+
+    def to_words(self, group_ids: typing.Tuple[int, ...], words: typing.List[str]) -> typing.List[typing.List[str]]:
+        '''
+        Convert a tuple of group ids into a list of word groups
+        '''
+        return [[words[idx] for idx in self.groups[group_id]] for group_id in group_ids]
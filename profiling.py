@@ -0,0 +1,259 @@
+import contextlib
+import contextvars
+import cProfile
+import glob
+import json
+import multiprocessing as mp
+import multiprocessing.util
+import os
+import threading
+import time
+import typing
+
+from tabulate import tabulate
+
+# Set to "1" to record timing spans and counters, or to "cprofile" to also run cProfile in every process
+PROFILE_ENV_VAR = "CONNECTIONS_PROFILE"
+PROFILE_DIR_ENV_VAR = "CONNECTIONS_PROFILE_DIR"
+
+# Shared by the processes of one run, so that their profiles are written to the same directory
+PROFILE_RUN_ENV_VAR = "CONNECTIONS_PROFILE_RUN"
+
+_enabled = False
+_cprofile = False
+_profiler = None
+
+_lock = threading.Lock()
+
+# Span name -> [count, total seconds, max seconds]
+_spans = {}
+_counters = {}
+
+# Stack of span names ("a;b;c") -> seconds spent in the innermost span itself, in the folded
+# format read by flamegraph.pl, speedscope, etc.
+_folded = {}
+
+_stack = contextvars.ContextVar("profiling_stack", default=())
+
+# Returned by `span` when profiling is off, so a disabled span costs one check and no allocation
+_NULL_SPAN = contextlib.nullcontext()
+
+class _Span():
+    __slots__ = ("name", "start", "child_time", "token")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.child_time = 0.0
+        self.token = _stack.set(_stack.get() + (self,))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+
+        stack = _stack.get()
+        _stack.reset(self.token)
+        if len(stack) > 1:
+            stack[-2].child_time += elapsed
+
+        folded_key = ";".join([span.name for span in stack])
+
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                stats = _spans[self.name] = [0, 0.0, 0.0]
+
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+            # Spans of concurrent tasks can overlap their parent, so self time is clamped at 0
+            _folded[folded_key] = _folded.get(folded_key, 0.0) + max(elapsed - self.child_time, 0.0)
+
+def is_enabled() -> bool:
+    return _enabled
+
+def span(name: str):
+    '''
+    Context manager that records the time spent in a named span, when profiling is enabled.
+    Spans can be nested, and are attributed to the spans they were opened in
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+
+    return _Span(name)
+
+def count(name: str, value: float = 1):
+    '''
+    Add to a named counter, when profiling is enabled
+    '''
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def _run_dir() -> str:
+    return os.path.join(os.environ.get(PROFILE_DIR_ENV_VAR, "profiles"), os.environ[PROFILE_RUN_ENV_VAR])
+
+def reset():
+    '''
+    Clear the spans and counters recorded so far in this process (and restart cProfile, if it is on)
+    '''
+    global _profiler
+
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _folded.clear()
+
+    if _cprofile:
+        if _profiler is not None:
+            _profiler.disable()
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def _start_process():
+    '''
+    Start recording in this process, and write its profile when it exits (including pool
+    workers, which exit through multiprocessing's finalizers rather than atexit)
+    '''
+    reset()
+    multiprocessing.util.Finalize(None, dump, exitpriority=10)
+
+def enable(output_dir: typing.Optional[str] = None, cprofile: bool = False):
+    '''
+    Turn profiling on for this process and any worker processes it starts afterwards (through
+    the environment variables, which they inherit)
+    '''
+    global _enabled, _cprofile
+
+    os.environ[PROFILE_ENV_VAR] = "cprofile" if cprofile else "1"
+    if output_dir is not None:
+        os.environ[PROFILE_DIR_ENV_VAR] = output_dir
+    os.environ.setdefault(PROFILE_RUN_ENV_VAR, time.strftime("%Y%m%d-%H%M%S"))
+
+    if not _enabled:
+        _enabled = True
+        _cprofile = cprofile
+        _start_process()
+
+def summary() -> dict:
+    '''
+    Return the spans and counters recorded in this process
+    '''
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "process": mp.current_process().name,
+            "spans": {name: {"count": stats[0], "total_s": stats[1], "max_s": stats[2]} for name, stats in _spans.items()},
+            "counters": dict(_counters),
+            "folded": dict(_folded),
+        }
+
+def dump(run_dir: typing.Optional[str] = None) -> typing.Optional[str]:
+    '''
+    Write this process's profile to the run directory: a JSON summary of the spans and counters,
+    the span stacks in the folded flamegraph format, and the cProfile stats if cProfile is on.
+    Returns the path of the summary
+    '''
+    if not _enabled:
+        return None
+
+    process_summary = summary()
+    if not process_summary["spans"] and not process_summary["counters"]:
+        return None
+
+    run_dir = run_dir or _run_dir()
+    os.makedirs(run_dir, exist_ok=True)
+
+    name = f"{process_summary['process']}-{process_summary['pid']}"
+    path = os.path.join(run_dir, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(process_summary, f, indent=2)
+
+    with open(os.path.join(run_dir, f"{name}.folded"), "w") as f:
+        for stack, seconds in process_summary["folded"].items():
+            f.write(f"{stack} {int(seconds * 1e6)}\n")
+
+    if _profiler is not None:
+        _profiler.create_stats()
+        _profiler.dump_stats(os.path.join(run_dir, f"{name}.prof"))
+
+    return path
+
+def load_run(run_dir: typing.Optional[str] = None) -> dict:
+    '''
+    Merge the profiles written by every process of a run
+    '''
+    run_dir = run_dir or _run_dir()
+
+    merged = {"num_processes": 0, "spans": {}, "counters": {}, "folded": {}}
+    for path in sorted(glob.glob(os.path.join(run_dir, "*.json"))):
+        with open(path, "r") as f:
+            process_summary = json.load(f)
+
+        merged["num_processes"] += 1
+        for name, stats in process_summary["spans"].items():
+            merged_stats = merged["spans"].setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            merged_stats["count"] += stats["count"]
+            merged_stats["total_s"] += stats["total_s"]
+            merged_stats["max_s"] = max(merged_stats["max_s"], stats["max_s"])
+
+        for name, value in process_summary["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+
+        for stack, seconds in process_summary["folded"].items():
+            merged["folded"][stack] = merged["folded"].get(stack, 0.0) + seconds
+
+    return merged
+
+def format_run(run: dict) -> str:
+    '''
+    Format a merged run profile as tables of spans (slowest first) and counters
+    '''
+    rows = [[name, stats["count"], stats["total_s"], stats["total_s"] / stats["count"] * 1000, stats["max_s"] * 1000]
+            for name, stats in sorted(run["spans"].items(), key=lambda item: -item[1]["total_s"])]
+
+    text = f"{run['num_processes']} processes\n\n"
+    text += tabulate(rows, headers=["span", "count", "total_s", "mean_ms", "max_ms"], floatfmt=".3f")
+
+    if run["counters"]:
+        text += "\n\n" + tabulate(sorted(run["counters"].items()), headers=["counter", "value"])
+
+    return text
+
+def report(run_dir: typing.Optional[str] = None) -> typing.Optional[str]:
+    '''
+    Write this process's profile, and return the summary of the whole run so far
+    '''
+    if not _enabled:
+        return None
+
+    dump(run_dir)
+    return format_run(load_run(run_dir))
+
+# Worker processes started with fork inherit the module already imported, so recording restarts
+# (with an empty profile of their own) after the fork
+multiprocessing.util.register_after_fork(_NULL_SPAN, lambda _: _start_process() if _enabled else None)
+
+if os.environ.get(PROFILE_ENV_VAR, "").lower() in ("1", "true", "cprofile"):
+    enable(cprofile=os.environ[PROFILE_ENV_VAR].lower() == "cprofile")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the timing spans recorded by every process of a profiled run")
+    parser.add_argument("run_dir", help="The run's profile directory, e.g. profiles/20240101-120000")
+    parser.add_argument("--folded", type=str, default=None, help="Also write the merged span stacks in the folded flamegraph format")
+    args = parser.parse_args()
+
+    run = load_run(args.run_dir)
+    print(format_run(run))
+
+    if args.folded is not None:
+        with open(args.folded, "w") as f:
+            for stack, seconds in sorted(run["folded"].items()):
+                f.write(f"{stack} {int(seconds * 1e6)}\n")
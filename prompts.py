@@ -37,6 +37,32 @@ Here are the starting 16 words:
 {0}
 '''
 
+COMPACT_PROMPT_ITERATIVE = '''
+I want you to solve a daily word puzzle that finds commonalities between words. There are 16 words, which form 4 groups of 4 words. Each group has some common theme that links the words. You must use each of the 16 words, and use each word only once.
+    
+Each group of 4 words are linked together in some way. The connection between words can be simple. An example of a simple connection would be "types of fish": Bass, Flounder, Salmon, Trout. Categories can also be more complex, and require abstract or lateral thinking.
+An example of this type of connection would be "things that start with FIRE": Ant, Drill, Island, Opal.
+
+Provide the one group you are most sure of as your final answer. I will enter this into the puzzle and give you feedback: I will tell you whether it is correct, incorrect, or nearly correct (3/4 words).
+Then we will continue until the puzzled is solved, or you lose.
+
+Format your final answer as:
+<ANSWER> GROUP NAME: [WORD, WORD, WORD, WORD] </ANSWER>
+
+Some rules:
+{3}- Give your final answer in the format described above (surrounded by <ANSWER> delimiters) without any additional text
+- Use the list of your previous guesses below to make sure you don't repeat any of them
+
+Groups found so far:
+{2}
+
+Your previous guesses and the responses from the game:
+{1}
+
+Here are the remaining words:
+{0}
+'''
+
 COT_PROMPT_ITERATIVE = '''
 - First, briefly summarize the rules and objective of the puzzle (in no more than 50 words)
 - Next, come up with a category to which four of the words belong and briefly explain why you think they belong to that category
@@ -1,4 +1,6 @@
 from enum import Enum
+from functools import lru_cache
+import hashlib
 import os
 import json
 import random
@@ -7,6 +9,7 @@ import typing
 
 from tabulate import tabulate
 
+from profiling import span
 from prompts import WELCOME_MESSAGE
 
 class PuzzleReponse(Enum):
@@ -15,6 +18,93 @@ class PuzzleReponse(Enum):
     NEARLY_CORRECT = 2
     CORRECT = 3
 
+COLOR_DICT = {'#df7bea': 'purple',
+              '#fbd400': 'yellow',
+              '#69e352': 'green',
+              '#5492ff': 'blue'}
+
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+def format_word(word: str) -> str:
+    '''
+    Format a word by removing punctuation and spaces, and converting it to uppercase 
+    '''
+    return word.translate(_PUNCTUATION_TABLE).strip().upper()
+
+class PuzzleStore():
+    '''
+    The parsed puzzle dataset, shared by every puzzle in the process. The data file is parsed
+    once, and the formatted words and word-to-category lookups of each puzzle are computed the
+    first time that puzzle is requested, so building a puzzle is a constant-time lookup. Use
+    `get_puzzle_store` to obtain the shared instance for a data directory.
+
+    Args:
+        data_dir (str): The directory where the puzzle data is stored
+    '''
+    def __init__(self, data_dir: str = "./data"):
+        self.data_dir = data_dir
+
+        with open(os.path.join(data_dir, "puzzle_data.json"), "r") as f:
+            self.puzzles = json.load(f)
+
+        # Identifies this version of the dataset, so that results can refer to puzzles by ID
+        self.content_hash = hashlib.sha256(json.dumps(self.puzzles, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+        self._formatted_words = {}
+        self._word_to_category = {}
+
+    def __len__(self) -> int:
+        return len(self.puzzles)
+
+    def get(self, id: int) -> dict:
+        '''
+        Return the raw data for the puzzle with the given ID (from 1 to the number of puzzles)
+        '''
+        if not 1 <= id <= len(self.puzzles):
+            raise IndexError(f"Puzzle ID {id} is out of range (1 to {len(self.puzzles)})")
+
+        return self.puzzles[id-1]
+
+    def _index(self, id: int):
+        '''
+        Compute the formatted words and word-to-category lookup for a puzzle
+        '''
+        formatted_words = []
+        word_to_category = {}
+        for category_idx, category in enumerate(self.get(id)['answers']):
+            for word in category["words"]:
+                word = format_word(word)
+                formatted_words.append(word)
+                word_to_category[word] = category_idx
+
+        self._formatted_words[id] = tuple(formatted_words)
+        self._word_to_category[id] = word_to_category
+
+    def formatted_words(self, id: int) -> typing.Tuple[str, ...]:
+        '''
+        Return the formatted words of a puzzle, in category order
+        '''
+        if id not in self._formatted_words:
+            self._index(id)
+
+        return self._formatted_words[id]
+
+    def word_to_category(self, id: int) -> typing.Dict[str, int]:
+        '''
+        Return a mapping from each formatted word of a puzzle to the index of its category
+        '''
+        if id not in self._word_to_category:
+            self._index(id)
+
+        return self._word_to_category[id]
+
+@lru_cache(maxsize=None)
+def get_puzzle_store(data_dir: str = "./data") -> PuzzleStore:
+    '''
+    Return the process-wide puzzle store for the given data directory, parsing it on first use
+    '''
+    return PuzzleStore(data_dir)
+
 class ConnectionsPuzzle():
     '''
     An instance of a "Connections" puzzle taken from the NYT archive. The puzzle
@@ -29,35 +119,30 @@ class ConnectionsPuzzle():
         num_guesses (int): The number of guesses the user is allowed to make
         all_in_one (bool): Whether the user needs to guess all categories at once
         data_dir (str): The directory where the puzzle data is stored
+        store (PuzzleStore): The puzzle store to use (defaults to the shared store for data_dir)
+        shuffle_seed (int): If set, the board is shuffled the same way on every reset (seeded from
+            both the puzzle ID and this seed, so different puzzles get different layouts)
     '''
     def __init__(self,
                  id: int,
                  num_guesses: int = 4,
                  all_in_one: bool = False,
-                 data_dir: str = "./data"):
+                 data_dir: str = "./data",
+                 store: typing.Optional[PuzzleStore] = None,
+                 shuffle_seed: typing.Optional[int] = None):
         
-        self.data = self._load_data(id, data_dir)
+        self.id = id
+        self.shuffle_seed = shuffle_seed
+        self.store = store if store is not None else get_puzzle_store(data_dir)
+        self.data = self.store.get(id)
         self.num_guesses = num_guesses
         self.all_in_one = all_in_one
 
-    def _load_data(self, id: int, data_dir: str) -> dict:
-        '''
-        Load the puzzle data from a JSON file.
-        '''
-        with open(os.path.join(data_dir, "puzzle_data.json"), "r") as f:
-            data = json.load(f)
-            
-        return data[id-1]
-    
     def _format(self, word: str) -> str:
         '''
         Format a word by removing punctuation and spaces, and converting it to uppercase 
         '''
-        word = word.translate(str.maketrans('', '', string.punctuation))
-        word = word.strip()
-        word = word.upper()
-
-        return word
+        return format_word(word)
 
     
     def render(self, observation: dict) -> str:
@@ -95,11 +180,25 @@ class ConnectionsPuzzle():
         self.guesses_remaining = self.num_guesses
         
 
-        self.words = sum([category["words"] for category in self.data['answers']], [])
-        self.words = [self._format(word) for word in self.words]
-        random.shuffle(self.words)
+        self.words = list(self.store.formatted_words(self.id))
+        if self.shuffle_seed is not None:
+            # The words are stored in category order, so a seed shared by every puzzle would give
+            # every board the same category layout
+            random.Random(f"{self.id}-{self.shuffle_seed}").shuffle(self.words)
+        else:
+            random.shuffle(self.words)
+
+        # Precompute the board position of each word and a bitmask of the positions in each
+        # category, so that checking a guess only needs bit operations
+        self.word_to_position = {word: position for position, word in enumerate(self.words)}
+        self.category_masks = [0] * len(self.data['answers'])
+        for word, category_idx in self.store.word_to_category(self.id).items():
+            self.category_masks[category_idx] |= 1 << self.word_to_position[word]
 
-        observation = {
+        self.remaining_mask = (1 << len(self.words)) - 1
+
+        # The same observation dict is updated in place and returned by every step
+        self.observation = {
             "words": self.words,
             "guesses": self.guesses,
             "revealed": self.revealed,
@@ -114,44 +213,65 @@ class ConnectionsPuzzle():
         done = False
         reward = 0
 
-        return observation, done, reward
+        return self.observation, done, reward
     
     def get_difficulty(self, category):
-        color_dict = {'#df7bea': 'purple',
-                      '#fbd400': 'yellow',
-                      '#69e352': 'green',
-                      '#5492ff': 'blue'}
         color_hex_str = category['color']
-        return color_dict[color_hex_str]
+        return COLOR_DICT[color_hex_str]
+
+    def _guess_mask(self, words: typing.List[str]) -> typing.Optional[int]:
+        '''
+        Return the bitmask of board positions for a guess of four formatted words, or None if the
+        guess is not four words that are still on the board
+        '''
+        if len(words) != 4:
+            return None
+
+        mask = 0
+        for word in words:
+            position = self.word_to_position.get(word)
+            if position is None or not (self.remaining_mask >> position) & 1:
+                return None
 
+            mask |= 1 << position
 
+        return mask
 
+    def _update_observation(self, message: str, response: PuzzleReponse) -> dict:
+        '''
+        Update the observation in place with the current puzzle state
+        '''
+        self.observation["words"] = self.words
+        self.observation["revealed"] = self.revealed
+        self.observation["revealed_colors"] = self.revealed_colors
+        self.observation["guesses_remaining"] = self.guesses_remaining
+        self.observation["message"] = message
+        self.observation["response"] = response
+
+        return self.observation
 
     def step(self, action: typing.Union[typing.List[str], typing.List[typing.List[str]]]) -> dict:
         '''
         Apply the user's action and return the updated observation
         '''
+        with span("puzzle.step"):
+            return self._step(action)
+
+    def _step(self, action: typing.Union[typing.List[str], typing.List[typing.List[str]]]) -> dict:
 
         if not self.all_in_one:
-            action = [self._format(word) for word in action]
-            valid = all([(word in self.words) for word in action]) and len(action) == 4
+            action = [format_word(word) for word in action]
+            guess_mask = self._guess_mask(action)
+            valid = guess_mask is not None
         
         else:
-            action = [[self._format(word) for word in category] for category in action]
-            valid = all([all([(word in self.words) for word in category]) and len(category) == 4 for category in action])
+            action = [[format_word(word) for word in category] for category in action]
+            guess_masks = [self._guess_mask(category) for category in action]
+            valid = all([mask is not None for mask in guess_masks])
 
         # Discard invalid actions
         if not valid:
-            observation = {
-                "words": self.words,
-                "guesses": self.guesses,
-                "revealed": self.revealed,
-                "revealed_colors": self.revealed_colors,
-                "guesses_remaining": self.guesses_remaining,
-                "all_in_one": self.all_in_one,
-                "message": "Invalid guess. Please try again.",
-                "response": PuzzleReponse.INVALID
-            }
+            observation = self._update_observation("Invalid guess. Please try again.", PuzzleReponse.INVALID)
 
             done = False
             reward = 0
@@ -160,27 +280,15 @@ class ConnectionsPuzzle():
 
         # All-in-one mode
         if self.all_in_one:
-        
-            all_match = True
-            for category in self.data['answers']:
-                formatted_category = [self._format(word) for word in category["words"]]
-
-                match = False
-                for category_guess in action:
-                    overlap = set(category_guess).intersection(set(formatted_category))
-                
-                    if len(overlap) == 4:
-                        match = True
-                        break
 
-                if not match:
-                    all_match = False
-                    break
+            # A category is matched when one of the guessed groups covers exactly its words
+            all_match = all([category_mask in guess_masks for category_mask in self.category_masks])
 
             if all_match:
                 self.revealed = self.data
                 self.revealed_colors = [self.get_difficulty(category) for category in self.data['answers']]
                 self.words = []
+                self.remaining_mask = 0
 
                 message = "Correct! You guessed all categories."
                 response = PuzzleReponse.CORRECT
@@ -197,20 +305,20 @@ class ConnectionsPuzzle():
             # Check correctness
             correct_category = None
             off_by_one = False
-            for category in self.data['answers']:
-                formatted_category = [self._format(word) for word in category["words"]]
-                overlap = set(action).intersection(set(formatted_category))
+            for category_idx, category_mask in enumerate(self.category_masks):
+                overlap = bin(guess_mask & category_mask).count("1")
                 
-                if len(overlap) == 4:
-                    correct_category = category
+                if overlap == 4:
+                    correct_category = self.data['answers'][category_idx]
                     break
                 
-                elif len(overlap) == 3:
+                elif overlap == 3:
                     off_by_one = True
 
             if correct_category is not None:
                 self.revealed.append(correct_category)
                 self.words = [word for word in self.words if word not in action]
+                self.remaining_mask &= ~guess_mask
                 self.revealed_colors.append(self.get_difficulty(correct_category))
 
                 message = f"Correct! The category was {correct_category['description']}. Diffulty: {self.get_difficulty(correct_category)}."
@@ -234,17 +342,9 @@ class ConnectionsPuzzle():
             self.revealed = self.data
             self.revealed_colors = [self.get_difficulty(category) for category in self.data['answers']]
             self.words = []
+            self.remaining_mask = 0
 
         # Update the observation
-        observation = {
-            "words": self.words,
-            "guesses": self.guesses,
-            "revealed": self.revealed,
-            "revealed_colors": self.revealed_colors,
-            "guesses_remaining": self.guesses_remaining,
-            "all_in_one": self.all_in_one,
-            "message": message,
-            "response": response
-        }
+        observation = self._update_observation(message, response)
 
         return observation, done, reward
\ No newline at end of file
@@ -0,0 +1,99 @@
+import asyncio
+import time
+import typing
+
+class TokenBucket():
+    '''
+    A token bucket that refills continuously at a fixed rate up to its capacity. The level can go
+    negative when more is used than was reserved, which delays later requests until it is repaid.
+
+    Args:
+        capacity (float): The maximum number of tokens in the bucket
+        refill_per_second (float): The rate at which tokens are added to the bucket
+    '''
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+
+        self.level = capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    def wait_time(self, amount: float) -> float:
+        '''
+        Return how many seconds until `amount` tokens are available
+        '''
+        self._refill()
+        amount = min(amount, self.capacity)
+
+        return max(0.0, (amount - self.level) / self.refill_per_second)
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+class AsyncRateLimiter():
+    '''
+    Keeps asynchronous API calls within a requests-per-minute and a tokens-per-minute budget, so
+    that requests are spread out to stay at the provider's limit rather than being retried after
+    hitting it. Callers reserve an estimate of the tokens a request will use (the prompt plus the
+    maximum completion, which is how providers count it) and settle the difference once the actual
+    usage is known. Waiters are served in arrival order.
+
+    Args:
+        requests_per_minute (float): The maximum number of requests per minute (None for no limit)
+        tokens_per_minute (float): The maximum number of tokens per minute (None for no limit)
+    '''
+    def __init__(self,
+                 requests_per_minute: typing.Optional[float] = None,
+                 tokens_per_minute: typing.Optional[float] = None):
+
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute else None
+
+        self._lock = None
+
+    async def acquire(self, estimated_tokens: float = 0):
+        '''
+        Wait until a request using the estimated number of tokens fits in the budget, and reserve it
+        '''
+        # The lock is created lazily so that it belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                wait_time = 0.0
+                if self.request_bucket is not None:
+                    wait_time = max(wait_time, self.request_bucket.wait_time(1))
+                if self.token_bucket is not None:
+                    wait_time = max(wait_time, self.token_bucket.wait_time(estimated_tokens))
+
+                if wait_time <= 0:
+                    break
+
+                await asyncio.sleep(wait_time)
+
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(estimated_tokens)
+
+    def settle(self, estimated_tokens: float, actual_tokens: float):
+        '''
+        Correct a reservation once the actual token usage of the request is known
+        '''
+        if self.token_bucket is not None:
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+
+def estimate_tokens(messages: typing.List[dict], max_completion_tokens: int = 0) -> int:
+    '''
+    Roughly estimate the tokens a chat completion request counts against the rate limit, using
+    about four characters per token for the prompt plus the maximum completion length
+    '''
+    prompt_tokens = sum([len(message["content"]) // 4 + 4 for message in messages])
+    return prompt_tokens + max_completion_tokens
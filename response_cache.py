@@ -0,0 +1,343 @@
+import asyncio
+from functools import lru_cache
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+class CacheMissError(Exception):
+    '''
+    Raised in replay mode when a request is not in the cache
+    '''
+    pass
+
+class ResponseCache():
+    '''
+    A content-addressed cache of chat completion responses stored in SQLite. Requests are keyed by
+    a hash of every argument sent to the API (model, messages, seed, max tokens and temperature),
+    so it is only meant for deterministic requests, i.e. at temperature 0. When the cache grows
+    past `max_size_bytes`, the least recently used responses are evicted. In read-only (replay)
+    mode the cache is never written and a miss raises CacheMissError, so an experiment can be
+    re-run offline from a previous run's responses.
+
+    Identical requests that are in flight at the same time (from different threads, tasks on an
+    event loop, or processes sharing the database) are merged, so only the first one is sent and
+    the others wait for it. Across processes, the first one claims the request with a pending row
+    in the database, and the others poll for its response. A claim left behind by a process that
+    died, or that is older than `pending_timeout`, is taken over.
+
+    Args:
+        path (str): The path of the SQLite database
+        max_size_bytes (int): The maximum total size of the cached responses (None for no limit)
+        read_only (bool): Whether to only replay cached responses
+        pending_timeout (float): Seconds after which another process's claim on a request is ignored
+        poll_interval (float): Seconds between checks for a request claimed by another process
+    '''
+    def __init__(self,
+                 path: str = "./data/response_cache.sqlite",
+                 max_size_bytes: typing.Optional[int] = None,
+                 read_only: bool = False,
+                 pending_timeout: float = 600.0,
+                 poll_interval: float = 0.25):
+
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.read_only = read_only
+        self.pending_timeout = pending_timeout
+        self.poll_interval = poll_interval
+
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                    "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pending (key TEXT PRIMARY KEY, pid INTEGER, started REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS batch_usage "
+                                    "(key TEXT PRIMARY KEY, prompt_tokens INTEGER, completion_tokens INTEGER)")
+            self.connection.commit()
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._in_flight_async = {}
+
+    @staticmethod
+    def key(request: dict) -> str:
+        '''
+        Return the content hash of a request
+        '''
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> typing.Optional[str]:
+        '''
+        Return the cached response for a request key, or None if it is not cached
+        '''
+        with self._lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is not None and not self.read_only:
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+
+        return row[0] if row is not None else None
+
+    def get_batch_usage(self, key: str) -> typing.Optional[dict]:
+        '''
+        Return the token usage of a cached response that was paid for through the batch API, or
+        None if the response came from an ordinary request
+        '''
+        with self._lock:
+            try:
+                row = self.connection.execute("SELECT prompt_tokens, completion_tokens FROM batch_usage WHERE key = ?",
+                                              (key,)).fetchone()
+            except sqlite3.OperationalError:
+                # A read-only cache written before batch usage was recorded
+                return None
+
+        return {"prompt_tokens": row[0], "completion_tokens": row[1]} if row is not None else None
+
+    def put(self, key: str, response: str, batch_usage: typing.Optional[dict] = None):
+        '''
+        Store the response for a request key, evicting old responses if the cache is too large.
+        For a response from the batch API, `batch_usage` holds its prompt and completion tokens
+        '''
+        if self.read_only:
+            return
+
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                    (key, response, len(response.encode("utf-8")), time.time()))
+
+            if batch_usage is not None:
+                self.connection.execute("INSERT OR REPLACE INTO batch_usage VALUES (?, ?, ?)",
+                                        (key, batch_usage["prompt_tokens"], batch_usage["completion_tokens"]))
+            else:
+                self.connection.execute("DELETE FROM batch_usage WHERE key = ?", (key,))
+
+            if self.max_size_bytes is not None:
+                self._evict()
+
+            self.connection.commit()
+
+    def _evict(self):
+        '''
+        Delete the least recently used responses until the cache fits in its size limit
+        '''
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        excess = total_size - self.max_size_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.connection.executemany("DELETE FROM batch_usage WHERE key = ?", evicted)
+
+    def _miss(self, key: str):
+        if self.read_only:
+            raise CacheMissError(f"Request {key} is not in the response cache at {self.path}")
+
+    def _claim(self, key: str) -> typing.Tuple[bool, typing.Optional[str]]:
+        '''
+        Coordinate a request with the other processes using the database. Returns (True, None) if
+        this process claimed the request and should make it, (False, response) if the response has
+        been cached in the meantime, and (False, None) if another process is still making it
+        '''
+        with self._lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                return False, row[0]
+
+            now = time.time()
+            pending = self.connection.execute("SELECT pid, started FROM pending WHERE key = ?", (key,)).fetchone()
+            if pending is not None and (now - pending[1] > self.pending_timeout or not _process_alive(pending[0])):
+                # The claiming process is gone (or stuck), so take the request over
+                self.connection.execute("DELETE FROM pending WHERE key = ? AND started = ?", (key, pending[1]))
+
+            cursor = self.connection.execute("INSERT OR IGNORE INTO pending VALUES (?, ?, ?)", (key, os.getpid(), now))
+            self.connection.commit()
+
+        return cursor.rowcount == 1, None
+
+    def _release(self, key: str):
+        '''
+        Drop this process's claim on a request, once its response is cached or the request failed
+        '''
+        with self._lock:
+            self.connection.execute("DELETE FROM pending WHERE key = ? AND pid = ?", (key, os.getpid()))
+            self.connection.commit()
+
+    def _wait_for_claim(self, key: str) -> typing.Optional[str]:
+        '''
+        Wait until this process holds the claim on a request (returning None), or until another
+        process has cached its response (returning the response)
+        '''
+        if self.read_only:
+            return None
+
+        claimed, response = self._claim(key)
+        while not claimed and response is None:
+            time.sleep(self.poll_interval)
+            claimed, response = self._claim(key)
+
+        return response
+
+    async def _wait_for_claim_async(self, key: str) -> typing.Optional[str]:
+        '''
+        Asynchronous version of _wait_for_claim, which keeps the database calls off the event loop
+        '''
+        if self.read_only:
+            return None
+
+        claimed, response = await asyncio.to_thread(self._claim, key)
+        while not claimed and response is None:
+            await asyncio.sleep(self.poll_interval)
+            claimed, response = await asyncio.to_thread(self._claim, key)
+
+        return response
+
+    def get_or_query(self, request: dict, query_fn: typing.Callable[[], str]) -> str:
+        '''
+        Return the cached response for the request, or call `query_fn` to get it and cache it.
+        Threads and processes making the same request at the same time share a single call
+        '''
+        key = self.key(request)
+
+        response = self.get(key)
+        if response is not None:
+            return response
+        self._miss(key)
+
+        with self._lock:
+            event = self._in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = self._in_flight[key] = threading.Event()
+
+        if not leader:
+            event.wait()
+            response = self.get(key)
+            if response is not None:
+                return response
+
+            # The leading request failed, so try again ourselves
+            return self.get_or_query(request, query_fn)
+
+        try:
+            response = self._wait_for_claim(key)
+            if response is None:
+                try:
+                    response = query_fn()
+                    if response is not None:
+                        self.put(key, response)
+                finally:
+                    if not self.read_only:
+                        self._release(key)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+        return response
+
+    async def get_or_query_async(self, request: dict, query_fn: typing.Callable[[], typing.Awaitable[str]]) -> str:
+        '''
+        Asynchronous version of get_or_query. Tasks and processes making the same request at the
+        same time share a single call. The database is only accessed from worker threads, so the
+        event loop never blocks on it
+        '''
+        key = self.key(request)
+
+        response = await asyncio.to_thread(self.get, key)
+        if response is not None:
+            return response
+        self._miss(key)
+
+        if key in self._in_flight_async:
+            leader_future = self._in_flight_async[key]
+            try:
+                return await asyncio.shield(leader_future)
+
+            except asyncio.CancelledError:
+                if not leader_future.cancelled():
+                    raise
+
+            except Exception:
+                pass
+
+            # The leading request failed, so try again ourselves
+            return await self.get_or_query_async(request, query_fn)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight_async[key] = future
+
+        try:
+            response = await self._wait_for_claim_async(key)
+            if response is None:
+                try:
+                    response = await query_fn()
+                    if response is not None:
+                        await asyncio.to_thread(self.put, key, response)
+                finally:
+                    if not self.read_only:
+                        await asyncio.to_thread(self._release, key)
+            future.set_result(response)
+
+        except Exception as e:
+            future.set_exception(e)
+            # Avoid "exception was never retrieved" warnings when nobody else was waiting
+            future.exception()
+            raise
+
+        except BaseException:
+            future.cancel()
+            raise
+
+        finally:
+            del self._in_flight_async[key]
+
+        return response
+
+    def close(self):
+        self.connection.close()
+
+def _process_alive(pid: int) -> bool:
+    '''
+    Whether a process on this machine is still running (assumed so where that can't be checked)
+    '''
+    if pid == os.getpid():
+        # This process only claims a request once, so its own claim is left over from a past run
+        return False
+
+    if os.name != "posix":
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+@lru_cache(maxsize=None)
+def get_response_cache(path: str = "./data/response_cache.sqlite",
+                       max_size_bytes: typing.Optional[int] = None,
+                       read_only: bool = False) -> ResponseCache:
+    '''
+    Return the response cache for the given database, shared by every solver in this process
+    (each worker process opens its own connection)
+    '''
+    return ResponseCache(path, max_size_bytes=max_size_bytes, read_only=read_only)
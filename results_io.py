@@ -0,0 +1,256 @@
+import json
+import os
+import typing
+
+from profiling import span
+from puzzle import PuzzleStore, get_puzzle_store
+
+# Version 2 results refer to their puzzle by `puzzle_id` and `dataset_hash` (the content hash of
+# the puzzle dataset) instead of embedding a copy of the puzzle in `puzzle_data`
+RESULTS_SCHEMA_VERSION = 2
+
+class ResultsWriter():
+    '''
+    Append-only results log in the JSON Lines format (one result per line). Each result is flushed
+    and fsynced as it is written, so a crash loses at most the record being written, and a
+    partially written last line is truncated away when the file is next opened (a corrupt line
+    elsewhere is skipped, without losing the results after it). The keys of the results already
+    in the file are kept in a set, so checking whether a job is done is O(1).
+
+    Args:
+        path (str): The path of the .jsonl results file
+        key_fields (Tuple[str]): The result fields that identify a job, e.g. ('puzzle_id', 'seed')
+    '''
+    def __init__(self,
+                 path: str,
+                 key_fields: typing.Tuple[str, ...] = ("puzzle_id",)):
+
+        self.path = path
+        self.key_fields = tuple(key_fields)
+
+        self.completed = set()
+        self.num_results = 0
+
+        if os.path.exists(path):
+            for result in self._recover():
+                self.completed.add(self.key(result))
+                self.num_results += 1
+
+        self.file = open(path, "a")
+
+    def _recover(self) -> typing.Iterator[dict]:
+        '''
+        Read the existing results. A missing newline or an undecodable line at the very end is a
+        torn write, and is truncated away. An undecodable line anywhere else is skipped (and left
+        in the file), so the valid results after it are kept
+        '''
+        valid_size = 0
+        with open(self.path, "rb") as f:
+            line = f.readline()
+            line_number = 1
+            while line:
+                next_line = f.readline()
+
+                try:
+                    result = json.loads(line) if line.endswith(b"\n") else None
+                except json.JSONDecodeError:
+                    result = None
+
+                if result is None and next_line:
+                    print(f"Skipping corrupt result on line {line_number} of {self.path}")
+                elif result is None:
+                    break
+                else:
+                    yield result
+
+                valid_size += len(line)
+                line, line_number = next_line, line_number + 1
+
+        if valid_size != os.path.getsize(self.path):
+            print(f"Truncating partially written result at the end of {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_size)
+
+    def key(self, result: dict) -> tuple:
+        '''
+        Return the job key of a result
+        '''
+        return tuple(result[field] for field in self.key_fields)
+
+    def __contains__(self, key: tuple) -> bool:
+        return tuple(key) in self.completed
+
+    def write(self, result: dict):
+        '''
+        Append a single result and make sure it is on disk
+        '''
+        with span("results.json_dumps"):
+            line = json.dumps(result) + "\n"
+
+        with span("results.fsync"):
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+        self.completed.add(self.key(result))
+        self.num_results += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def load_results(path: str, join_puzzles: bool = False, data_dir: str = "./data") -> typing.List[dict]:
+    '''
+    Load a results file, either in the JSON Lines format or as a single JSON array. With
+    `join_puzzles`, every result gets its `puzzle_data` (looked up in the puzzle store for
+    version 2 results), as in the older results
+    '''
+    if path.endswith(".jsonl"):
+        results = []
+        with open(path, "r") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.endswith("\n"):
+                    break
+
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping corrupt result on line {line_number} of {path}")
+
+    else:
+        with open(path, "r") as f:
+            results = json.load(f)
+
+    if join_puzzles:
+        join_puzzle_data(results, get_puzzle_store(data_dir))
+
+    return results
+
+def _matches_dataset(puzzle_data: typing.Union[dict, list], puzzle: dict) -> bool:
+    '''
+    Whether a result's embedded puzzle is the dataset's puzzle (the oldest results only embed the
+    list of categories)
+    '''
+    return puzzle_data == (puzzle if isinstance(puzzle_data, dict) else puzzle["answers"])
+
+def normalize_result(result: dict, store: PuzzleStore) -> dict:
+    '''
+    Convert a result to the version 2 schema. The embedded puzzle is dropped when it is the
+    dataset's puzzle; otherwise (the puzzle has changed since) it is kept, so nothing is lost
+    '''
+    if result.get("schema_version", 1) >= 2:
+        return result
+
+    result = dict(result)
+    puzzle_data = result.pop("puzzle_data", None)
+
+    normalized = {"schema_version": RESULTS_SCHEMA_VERSION}
+    for key, value in result.items():
+        normalized[key] = value
+        if key == "puzzle_id":
+            normalized["dataset_hash"] = store.content_hash
+
+    if puzzle_data is not None and not _matches_dataset(puzzle_data, store.get(result["puzzle_id"])):
+        normalized["puzzle_data"] = puzzle_data
+
+    return normalized
+
+def join_puzzle_data(results: typing.List[dict], store: PuzzleStore) -> typing.List[dict]:
+    '''
+    Add the puzzle data from the puzzle store to the results that refer to their puzzle by ID (in place)
+    '''
+    mismatched = 0
+    for result in results:
+        if "puzzle_data" not in result:
+            result["puzzle_data"] = store.get(result["puzzle_id"])
+            mismatched += result.get("dataset_hash") != store.content_hash
+
+    if mismatched:
+        print(f"Warning: {mismatched} results were recorded with a different version of the puzzle dataset")
+
+    return results
+
+def migrate_results(path: str, data_dir: str = "./data") -> typing.Tuple[int, int]:
+    '''
+    Rewrite a results file (.json or .jsonl) in the version 2 schema. Returns the number of
+    results and the number that had to keep their own copy of the puzzle
+    '''
+    store = get_puzzle_store(data_dir)
+    results = [normalize_result(result, store) for result in load_results(path)]
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        if path.endswith(".jsonl"):
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        else:
+            json.dump(results, f)
+    os.replace(tmp_path, path)
+
+    return len(results), sum(["puzzle_data" in result for result in results])
+
+def convert_json_to_jsonl(json_path: str, jsonl_path: typing.Optional[str] = None) -> str:
+    '''
+    Convert a results file stored as a JSON array into the JSON Lines format
+    '''
+    jsonl_path = jsonl_path or os.path.splitext(json_path)[0] + ".jsonl"
+
+    tmp_path = f"{jsonl_path}.tmp"
+    with open(tmp_path, "w") as f:
+        for result in load_results(json_path):
+            f.write(json.dumps(result) + "\n")
+    os.replace(tmp_path, jsonl_path)
+
+    return jsonl_path
+
+def convert_jsonl_to_json(jsonl_path: str, json_path: typing.Optional[str] = None) -> str:
+    '''
+    Convert a results file in the JSON Lines format into a single JSON array (e.g. for the notebooks)
+    '''
+    json_path = json_path or os.path.splitext(jsonl_path)[0] + ".json"
+
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(load_results(jsonl_path), f)
+    os.replace(tmp_path, json_path)
+
+    return json_path
+
+def open_results_writer(save_dir: str, filename: str, key_fields: typing.Tuple[str, ...]) -> ResultsWriter:
+    '''
+    Open the append-only writer for an experiment's results. If only the older JSON array version
+    of the results exists, it is converted first so that the run resumes where it left off
+    '''
+    json_path = os.path.join(save_dir, filename)
+    jsonl_path = os.path.splitext(json_path)[0] + ".jsonl"
+
+    if os.path.exists(json_path) and not os.path.exists(jsonl_path):
+        convert_json_to_jsonl(json_path, jsonl_path)
+
+    return ResultsWriter(jsonl_path, key_fields)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert results files between the JSON array and JSON Lines formats")
+    parser.add_argument("paths", nargs="+", help="Results files to convert (.json files become .jsonl, and vice versa)")
+    parser.add_argument("--migrate", action="store_true", help="Instead, rewrite the files in place in the version 2 schema")
+    parser.add_argument("--data-dir", type=str, default="./data")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if args.migrate:
+            size = os.path.getsize(path)
+            num_results, num_kept = migrate_results(path, args.data_dir)
+            print(f"{path}: migrated {num_results} results ({num_kept} kept their puzzle data), "
+                  f"{size / 1024:.0f} KB -> {os.path.getsize(path) / 1024:.0f} KB")
+
+        elif path.endswith(".jsonl"):
+            print(f"{path} -> {convert_jsonl_to_json(path)}")
+        else:
+            print(f"{path} -> {convert_json_to_jsonl(path)}")
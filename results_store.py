@@ -0,0 +1,252 @@
+import glob
+import os
+import re
+import time
+import typing
+
+import numpy as np
+from tabulate import tabulate
+
+from puzzle import COLOR_DICT, get_puzzle_store
+from results_io import load_results
+
+COLORS = ["yellow", "green", "blue", "purple"]
+
+# Config dimensions that results can be grouped and filtered by, besides the per-result `seed` and `puzzle_id`
+CONFIG_FIELDS = ["solver", "model", "chain_of_thought", "variant"]
+
+_LLM_FILENAME = re.compile(r"^(?P<solver>\w+?GPTSolver)_(?P<model>.+)_cot-(?P<cot>True|False)(?P<variant>.*?)_results(?P<suffix>.*)$")
+_BASELINE_FILENAME = re.compile(r"^(?P<solver>\w+?Baseline)_model-(?P<model>.+?)(?P<variant>_[a-z]+)?_results(?P<suffix>.*)$")
+
+def parse_results_filename(path: str) -> typing.Optional[dict]:
+    '''
+    Return the config (solver, model, chain of thought and variant, e.g. "_compact") that a results
+    file was written for, or None if the file is not a results file
+    '''
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    match = _LLM_FILENAME.match(name)
+    if match is not None:
+        return {"solver": match["solver"], "model": match["model"], "chain_of_thought": match["cot"],
+                "variant": (match["variant"] + match["suffix"]).lstrip("_")}
+
+    match = _BASELINE_FILENAME.match(name)
+    if match is not None:
+        return {"solver": match["solver"], "model": match["model"], "chain_of_thought": "",
+                "variant": ((match["variant"] or "") + match["suffix"]).lstrip("_")}
+
+    return None
+
+def _results_files(results_dir: str) -> typing.List[str]:
+    '''
+    Return the results files in a directory, preferring the .jsonl version of a file when both exist
+    '''
+    paths = {}
+    for path in sorted(glob.glob(os.path.join(results_dir, "*_results*.json*"))):
+        stem, ext = os.path.splitext(path)
+        if ext in (".json", ".jsonl") and parse_results_filename(path) is not None:
+            if ext == ".jsonl" or stem not in paths:
+                paths[stem] = path
+
+    return sorted(paths.values())
+
+class ResultsStore():
+    '''
+    Every experiment's results in columnar form: one NumPy array per field, with one row per
+    result, plus a config table (solver, model, chain of thought, variant) that rows refer to by
+    index, and a puzzle dimension table (category names and colors) indexed by puzzle ID. Built
+    once from the results files with `ingest` and saved as a single .npz file, so loading and
+    aggregating every experiment takes milliseconds.
+
+    Args:
+        columns (Dict[str, np.ndarray]): The per-result columns
+        configs (Dict[str, np.ndarray]): The config table columns
+        puzzles (Dict[str, np.ndarray]): The puzzle table columns
+        sources (Dict[str, np.ndarray]): The results files the store was built from, with their modification times
+    '''
+    def __init__(self,
+                 columns: typing.Dict[str, np.ndarray],
+                 configs: typing.Dict[str, np.ndarray],
+                 puzzles: typing.Dict[str, np.ndarray],
+                 sources: typing.Dict[str, np.ndarray]):
+
+        self.columns = columns
+        self.configs = configs
+        self.puzzles = puzzles
+        self.sources = sources
+
+    def __len__(self) -> int:
+        return len(self.columns["puzzle_id"])
+
+    @classmethod
+    def ingest(cls, results_dir: str = "results", data_dir: str = "./data") -> "ResultsStore":
+        '''
+        Build the store from every results file in a directory
+        '''
+        paths = _results_files(results_dir)
+
+        configs = {field: [] for field in CONFIG_FIELDS + ["file"]}
+        columns = {field: [] for field in ["config_idx", "puzzle_id", "seed", "num_steps", "num_invalid", "solved_overall"]
+                   + [f"solved_{color}" for color in COLORS] + [f"{color}_solved_at" for color in COLORS]}
+
+        for config_idx, path in enumerate(paths):
+            for field, value in parse_results_filename(path).items():
+                configs[field].append(value)
+            configs["file"].append(os.path.basename(path))
+
+            for result in load_results(path):
+                columns["config_idx"].append(config_idx)
+                columns["puzzle_id"].append(result["puzzle_id"])
+                columns["seed"].append(result.get("seed", -1))
+                columns["num_steps"].append(result.get("num_steps", -1))
+                columns["num_invalid"].append(result.get("num_invalid", -1))
+                columns["solved_overall"].append(result["solved_overall"])
+
+                for color in COLORS:
+                    columns[f"solved_{color}"].append(result[f"solved_{color}"])
+
+                    # Only the baselines record when each category was solved
+                    solved_at = result.get(f"{color}_solved_at")
+                    columns[f"{color}_solved_at"].append(-1 if solved_at is None else solved_at)
+
+        dtypes = {"config_idx": np.int16, "puzzle_id": np.int16, "seed": np.int16, "num_steps": np.int16, "num_invalid": np.int16}
+        columns = {field: np.array(values, dtype=dtypes.get(field, bool if field.startswith("solved") else np.int16))
+                   for field, values in columns.items()}
+        configs = {field: np.array(values, dtype=str) for field, values in configs.items()}
+
+        # Puzzle dimension table, where row i is puzzle i + 1
+        store = get_puzzle_store(data_dir)
+        puzzles = {"puzzle_id": np.arange(1, len(store) + 1, dtype=np.int16)}
+        for color in COLORS:
+            puzzles[f"{color}_category"] = np.array([next((category["description"] for category in puzzle["answers"]
+                                                           if COLOR_DICT.get(category["color"]) == color), "")
+                                                     for puzzle in store.puzzles], dtype=str)
+
+        sources = {"file": np.array(paths, dtype=str), "mtime": np.array([os.path.getmtime(path) for path in paths])}
+
+        return cls(columns, configs, puzzles, sources)
+
+    def save(self, path: str):
+        arrays = {}
+        for prefix, table in [("col", self.columns), ("config", self.configs), ("puzzle", self.puzzles), ("source", self.sources)]:
+            for field, values in table.items():
+                arrays[f"{prefix}__{field}"] = values
+
+        # np.savez adds the extension to names without it, so write to a temporary .npz and rename
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ResultsStore":
+        tables = {"col": {}, "config": {}, "puzzle": {}, "source": {}}
+        with np.load(path) as arrays:
+            for name in arrays.files:
+                prefix, field = name.split("__", 1)
+                tables[prefix][field] = arrays[name]
+
+        return cls(tables["col"], tables["config"], tables["puzzle"], tables["source"])
+
+    def is_stale(self, results_dir: str = "results") -> bool:
+        '''
+        Whether any results file has been added, removed or modified since the store was built
+        '''
+        paths = _results_files(results_dir)
+        if paths != list(self.sources["file"]):
+            return True
+
+        return any(os.path.getmtime(path) != mtime for path, mtime in zip(paths, self.sources["mtime"]))
+
+    def column(self, field: str) -> np.ndarray:
+        '''
+        Return a per-result column, including the config fields (looked up through the config table)
+        '''
+        if field in self.configs:
+            return self.configs[field][self.columns["config_idx"]]
+
+        return self.columns[field]
+
+    def solve_rates(self,
+                    by: typing.Sequence[str] = ("solver", "model", "chain_of_thought"),
+                    color: typing.Optional[str] = None,
+                    where: typing.Optional[typing.Dict[str, typing.Any]] = None) -> typing.List[dict]:
+        '''
+        Return the solve rate (of whole puzzles, or of the category of the given color) for each
+        combination of the `by` fields, over the results that match every `where` filter
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in (where or {}).items():
+            mask &= (self.column(field).astype(str) == str(value))
+
+        solved = self.columns[f"solved_{color}" if color else "solved_overall"][mask]
+
+        # Factorize each group-by field, then combine the codes into one group index
+        codes = np.zeros(mask.sum(), dtype=np.int64)
+        uniques = []
+        for field in by:
+            values, inverse = np.unique(self.column(field)[mask], return_inverse=True)
+            codes = codes * len(values) + inverse
+            uniques.append(values)
+
+        groups, group_idx = np.unique(codes, return_inverse=True)
+        counts = np.bincount(group_idx, minlength=len(groups))
+        num_solved = np.bincount(group_idx, weights=solved, minlength=len(groups))
+
+        rows = []
+        for group, count, group_solved in zip(groups, counts, num_solved):
+            row = {}
+            for field, values in reversed(list(zip(by, uniques))):
+                group, value_idx = divmod(group, len(values))
+                row[field] = values[value_idx].item()
+
+            rows.append(dict(row, n=int(count), solve_rate=group_solved / count))
+
+        return [{field: row[field] for field in list(by) + ["n", "solve_rate"]} for row in rows]
+
+def load_results_store(results_dir: str = "results",
+                       store_path: typing.Optional[str] = None,
+                       data_dir: str = "./data") -> ResultsStore:
+    '''
+    Load the columnar store of a results directory, (re)building it if any results file is newer
+    '''
+    store_path = store_path or os.path.join(results_dir, "results_store.npz")
+
+    if os.path.exists(store_path):
+        store = ResultsStore.load(store_path)
+        if not store.is_stale(results_dir):
+            return store
+
+    store = ResultsStore.ingest(results_dir, data_dir)
+    store.save(store_path)
+
+    return store
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the columnar results store and query solve rates")
+    parser.add_argument("command", choices=["ingest", "query"])
+    parser.add_argument("--results-dir", type=str, default="results")
+    parser.add_argument("--data-dir", type=str, default="./data")
+    parser.add_argument("--by", nargs="+", default=["solver", "model", "chain_of_thought"],
+                        choices=CONFIG_FIELDS + ["seed", "puzzle_id"], help="Fields to group the solve rates by")
+    parser.add_argument("--color", choices=COLORS, default=None, help="Solve rate of the category of this color (default: whole puzzles)")
+    parser.add_argument("--where", nargs="*", default=[], help="Filters of the form field=value, e.g. solver=IterativeGPTSolver")
+    args = parser.parse_args()
+
+    store_path = os.path.join(args.results_dir, "results_store.npz")
+
+    start = time.perf_counter()
+    if args.command == "ingest":
+        store = ResultsStore.ingest(args.results_dir, args.data_dir)
+        store.save(store_path)
+        print(f"Ingested {len(store)} results from {len(store.configs['file'])} files into {store_path} "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    else:
+        store = load_results_store(args.results_dir, store_path, args.data_dir)
+        where = dict(condition.split("=", 1) for condition in args.where)
+        rows = store.solve_rates(by=args.by, color=args.color, where=where)
+
+        print(tabulate([list(row.values()) for row in rows], headers=args.by + ["n", "solve_rate"], floatfmt=".3f"))
+        print(f"\n{len(store)} results queried in {(time.perf_counter() - start) * 1000:.1f}ms")
@@ -0,0 +1,67 @@
+import typing
+
+import numpy as np
+
+from results_store import ResultsStore, load_results_store
+
+def _means(keys: list, values: list) -> dict:
+    sums, counts = {}, {}
+    for key, value in zip(keys, values):
+        sums[key] = sums.get(key, 0) + value
+        counts[key] = counts.get(key, 0) + 1
+
+    return {key: sums[key] / counts[key] for key in sums}
+
+class StepEstimator():
+    '''
+    Estimates how many turns a (config, puzzle) job will take from the step counts of past
+    results: the mean for the same config and puzzle if there is one, else the mean for the
+    puzzle over every config, else the mean for the config, else a default.
+
+    Args:
+        store (ResultsStore): The past results (None to always use the default)
+        default (float): The estimate when there are no past results for the config or puzzle
+    '''
+    def __init__(self, store: typing.Optional[ResultsStore] = None, default: float = 5.0):
+        self.default = default
+
+        self.by_config_puzzle = {}
+        self.by_puzzle = {}
+        self.by_config = {}
+
+        if store is not None and len(store) > 0:
+            # Only the LLM results record their step counts
+            has_steps = store.column("num_steps") >= 0
+
+            num_steps = store.column("num_steps")[has_steps].tolist()
+            configs = list(zip(store.column("solver")[has_steps].tolist(), store.column("model")[has_steps].tolist(),
+                               store.column("chain_of_thought")[has_steps].tolist()))
+            puzzle_ids = store.column("puzzle_id")[has_steps].tolist()
+
+            self.by_config_puzzle = _means([(*config, puzzle_id) for config, puzzle_id in zip(configs, puzzle_ids)], num_steps)
+            self.by_puzzle = _means(puzzle_ids, num_steps)
+            self.by_config = _means(configs, num_steps)
+
+    @classmethod
+    def from_results(cls, results_dir: str = "results", default: float = 5.0) -> "StepEstimator":
+        return cls(load_results_store(results_dir), default)
+
+    def estimate(self, solver: str, model: str, chain_of_thought: bool, puzzle_id: int) -> float:
+        config = (solver, model, str(chain_of_thought))
+
+        if (*config, puzzle_id) in self.by_config_puzzle:
+            return self.by_config_puzzle[(*config, puzzle_id)]
+        if puzzle_id in self.by_puzzle:
+            return self.by_puzzle[puzzle_id]
+
+        return self.by_config.get(config, self.default)
+
+def longest_first(jobs: list, expected_cost: typing.Callable[[typing.Any], float]) -> list:
+    '''
+    Order jobs by decreasing expected cost, so that the longest jobs start first and the end of a
+    run is not held up by a few long jobs started last (longest-processing-time-first scheduling)
+    '''
+    costs = np.array([expected_cost(job) for job in jobs])
+    order = np.argsort(-costs, kind="stable")
+
+    return [jobs[idx] for idx in order]
@@ -1,34 +1,90 @@
-from itertools import combinations
 import os
-import pickle
 import typing
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
 
+from checkpoint_store import CheckpointStore, get_checkpoint_store
+from profiling import span
 from puzzle import ConnectionsPuzzle
 from llm_model import IterativeGPTSolver, OneShotGPTSolver
+from partitions import write_partition_index
+from rate_limit import AsyncRateLimiter
+from response_cache import ResponseCache, get_response_cache
+from results_io import RESULTS_SCHEMA_VERSION
 
-def solve_puzzle(puzzle_id_and_seed: typing.Tuple[int, int],
-                 solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
-                 llm_name: str,
-                 chain_of_thought: bool = False,
-                 num_guesses: int = 5,
-                 invalid_limit: int = 5):
-    
+def get_openai_key(required: bool = True) -> str:
     openai_key = (os.environ.get("OPENAI_TOKEN") or os.environ.get("OPENAI_API_KEY"))
     if openai_key is None:
+        if not required:
+            # Replaying cached responses never reaches the API
+            return "replay-only"
+
         raise ValueError("Error: OPENAI_TOKEN/OPENAI_API_KEY environment variable is not set")
 
-    openai_client = OpenAI(api_key=openai_key)
-    
-    solver = solver_type(openai_client, llm_name, chain_of_thought=chain_of_thought)
+    return openai_key
 
-    puzzle_id, seed = puzzle_id_and_seed
-    all_in_one = isinstance(solver, OneShotGPTSolver)
-    puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one)
-    
-    solved, invalid_count, step_count, guess_log, messages = solver.solve(puzzle, invalid_limit=invalid_limit, seed=seed)
+def make_openai_client(api_key: str,
+                       max_connections: int = 16,
+                       max_keepalive_connections: typing.Optional[int] = None,
+                       keepalive_expiry: float = 60.0,
+                       timeout: float = 120.0,
+                       connect_timeout: float = 10.0,
+                       async_client: bool = False,
+                       **client_kwargs) -> typing.Union[OpenAI, AsyncOpenAI]:
+    '''
+    Create an OpenAI (or AsyncOpenAI) client with its own HTTP connection pool. Idle connections
+    are kept alive for `keepalive_expiry` seconds, so a client that is reused across requests
+    only pays for the connection and TLS handshake once. Any other keyword arguments (e.g.
+    base_url, max_retries) are passed on to the client
+    '''
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive_connections or max_connections,
+                          keepalive_expiry=keepalive_expiry)
+    http_timeout = httpx.Timeout(timeout, connect=connect_timeout)
+
+    if async_client:
+        return AsyncOpenAI(api_key=api_key, timeout=http_timeout,
+                           http_client=DefaultAsyncHttpxClient(limits=limits, timeout=http_timeout), **client_kwargs)
 
+    return OpenAI(api_key=api_key, timeout=http_timeout,
+                  http_client=DefaultHttpxClient(limits=limits, timeout=http_timeout), **client_kwargs)
+
+# Client held by each worker process, so every puzzle the worker solves reuses its connections
+_worker_client = None
+
+def init_worker(replay_only: bool = False, client_kwargs: typing.Optional[dict] = None):
+    '''
+    Pool initializer that creates the OpenAI client used by this worker for the rest of its life
+    '''
+    global _worker_client
+
+    _worker_client = make_openai_client(get_openai_key(required=not replay_only), **(client_kwargs or {}))
+
+def get_worker_client(replay_only: bool = False) -> OpenAI:
+    '''
+    Return this process's OpenAI client, creating it with the default settings if the process
+    was not started with `init_worker` (e.g. when running without a pool)
+    '''
+    if _worker_client is None:
+        init_worker(replay_only)
+
+    return _worker_client
+
+def make_results_dict(solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                      llm_name: str,
+                      chain_of_thought: bool,
+                      puzzle: ConnectionsPuzzle,
+                      seed: int,
+                      solved: bool,
+                      invalid_count: int,
+                      step_count: int,
+                      turn_tokens: typing.Optional[typing.List[dict]] = None,
+                      compact_state: bool = False,
+                      llm_calls: typing.Optional[typing.List[dict]] = None) -> dict:
+    '''
+    Collect the results of an LLM solver's attempt at a puzzle
+    '''
     solved_overall = solved
     solved_yellow = 'yellow' in puzzle.revealed_colors
     solved_green = 'green' in puzzle.revealed_colors
@@ -39,8 +95,9 @@ def solve_puzzle(puzzle_id_and_seed: typing.Tuple[int, int],
         'solver': solver_type.__name__,
         'llm_name': llm_name,
         'chain_of_thought': chain_of_thought,
-        'puzzle_id': puzzle_id,
-        'puzzle_data': puzzle.data,
+        'schema_version': RESULTS_SCHEMA_VERSION,
+        'puzzle_id': puzzle.id,
+        'dataset_hash': puzzle.store.content_hash,
         'seed': seed,
         'solved_overall': solved_overall,
         'solved_yellow': solved_yellow,
@@ -49,32 +106,184 @@ def solve_puzzle(puzzle_id_and_seed: typing.Tuple[int, int],
         'solved_purple': solved_purple,
         'num_steps': step_count,
         'num_invalid': invalid_count,
-        'guesses': puzzle.guesses
+        'guesses': puzzle.guesses,
+        'compact_state': compact_state,
+        'turn_tokens': turn_tokens,
+        'llm_calls': llm_calls
     }
     
     return results_dict
 
-def enumerate_all_guesses():
-    all_guess_idxs = set()
+def _checkpoint_key(solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                    llm_name: str,
+                    chain_of_thought: bool,
+                    compact_state: bool,
+                    puzzle_id: int,
+                    seed: int,
+                    num_guesses: int,
+                    invalid_limit: int) -> str:
+    '''
+    Return the key that a conversation is checkpointed under
+    '''
+    return CheckpointStore.key({"solver": solver_type.__name__, "llm_name": llm_name, "chain_of_thought": chain_of_thought,
+                                "compact_state": compact_state, "puzzle_id": puzzle_id, "seed": seed,
+                                "num_guesses": num_guesses, "invalid_limit": invalid_limit})
+
+def solve_puzzle(puzzle_id_and_seed: typing.Tuple[int, int],
+                 solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                 llm_name: str,
+                 chain_of_thought: bool = False,
+                 num_guesses: int = 5,
+                 invalid_limit: int = 5,
+                 response_cache_path: typing.Optional[str] = None,
+                 response_cache_max_bytes: typing.Optional[int] = None,
+                 replay_only: bool = False,
+                 openai_client: typing.Optional[OpenAI] = None,
+                 compact_state: bool = False,
+                 checkpoint_path: typing.Optional[str] = None):
+    
+    if openai_client is None:
+        openai_client = get_worker_client(replay_only)
+
+    response_cache = None
+    if response_cache_path is not None:
+        response_cache = get_response_cache(response_cache_path, response_cache_max_bytes, read_only=replay_only)
+    
+    solver_kwargs = {"compact_state": True} if compact_state else {}
+    solver = solver_type(openai_client, llm_name, chain_of_thought=chain_of_thought, response_cache=response_cache, **solver_kwargs)
+
+    puzzle_id, seed = puzzle_id_and_seed
+    all_in_one = isinstance(solver, OneShotGPTSolver)
+    # The board order depends only on the seed, so repeated runs send identical (cacheable) requests
+    puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=seed)
+    
+    # With a checkpoint store, an interrupted conversation continues from its last finished turn
+    checkpoint_store, checkpoint_key = None, None
+    if checkpoint_path is not None:
+        checkpoint_store = get_checkpoint_store(checkpoint_path)
+        checkpoint_key = _checkpoint_key(solver_type, llm_name, chain_of_thought, compact_state, puzzle_id, seed,
+                                         num_guesses, invalid_limit)
+
+    with span("llm.solve"):
+        solved, invalid_count, step_count, guess_log, messages = solver.solve(puzzle, invalid_limit=invalid_limit, seed=seed,
+                                                                              checkpoint_store=checkpoint_store,
+                                                                              checkpoint_key=checkpoint_key)
+
+    return make_results_dict(solver_type, llm_name, chain_of_thought, puzzle, seed, solved, invalid_count, step_count,
+                             turn_tokens=solver.turn_tokens, compact_state=compact_state, llm_calls=solver.call_log)
+
+async def solve_puzzle_async(puzzle_id_and_seed: typing.Tuple[int, int],
+                             solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                             openai_client: AsyncOpenAI,
+                             llm_name: str,
+                             chain_of_thought: bool = False,
+                             num_guesses: int = 5,
+                             invalid_limit: int = 5,
+                             rate_limiter: typing.Optional[AsyncRateLimiter] = None,
+                             response_cache: typing.Optional[ResponseCache] = None,
+                             compact_state: bool = False,
+                             checkpoint_store: typing.Optional[CheckpointStore] = None):
+    '''
+    Asynchronous version of solve_puzzle, sharing one AsyncOpenAI client (and rate limiter,
+    response cache and checkpoint store) across puzzles
+    '''
+    solver_kwargs = {"compact_state": True} if compact_state else {}
+    solver = solver_type(openai_client, llm_name, chain_of_thought=chain_of_thought, rate_limiter=rate_limiter,
+                         response_cache=response_cache, **solver_kwargs)
+
+    puzzle_id, seed = puzzle_id_and_seed
+    all_in_one = isinstance(solver, OneShotGPTSolver)
+    # The board order depends only on the seed, so repeated runs send identical (cacheable) requests
+    puzzle = ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=seed)
+    
+    checkpoint_key = None
+    if checkpoint_store is not None:
+        checkpoint_key = _checkpoint_key(solver_type, llm_name, chain_of_thought, compact_state, puzzle_id, seed,
+                                         num_guesses, invalid_limit)
+
+    with span("llm.solve"):
+        solved, invalid_count, step_count, guess_log, messages = await solver.solve_async(puzzle, invalid_limit=invalid_limit, seed=seed,
+                                                                                          checkpoint_store=checkpoint_store,
+                                                                                          checkpoint_key=checkpoint_key)
+
+    return make_results_dict(solver_type, llm_name, chain_of_thought, puzzle, seed, solved, invalid_count, step_count,
+                             turn_tokens=solver.turn_tokens, compact_state=compact_state, llm_calls=solver.call_log)
+
+def solve_puzzle_samples(puzzle_id_and_seeds: typing.Tuple[int, typing.Tuple[int, ...]],
+                         solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                         llm_name: str,
+                         chain_of_thought: bool = False,
+                         num_guesses: int = 5,
+                         invalid_limit: int = 5,
+                         response_cache_path: typing.Optional[str] = None,
+                         response_cache_max_bytes: typing.Optional[int] = None,
+                         replay_only: bool = False,
+                         openai_client: typing.Optional[OpenAI] = None,
+                         compact_state: bool = False,
+                         shuffle_seed: int = 0) -> typing.List[dict]:
+    '''
+    Solve a puzzle for several seeds at once: the first turn is a single request for one sample per
+    seed, and each sample then continues as its own conversation. Every seed sees the same board
+    (shuffled with `shuffle_seed`), so that the first request is shared. Returns one result per seed
+    '''
+    if openai_client is None:
+        openai_client = get_worker_client(replay_only)
+
+    response_cache = None
+    if response_cache_path is not None:
+        response_cache = get_response_cache(response_cache_path, response_cache_max_bytes, read_only=replay_only)
+
+    puzzle_id, seeds = puzzle_id_and_seeds
+    all_in_one = solver_type == OneShotGPTSolver
+    solver_kwargs = {"compact_state": True} if compact_state else {}
+
+    solvers = [solver_type(openai_client, llm_name, chain_of_thought=chain_of_thought, response_cache=response_cache, **solver_kwargs)
+               for _ in seeds]
+    puzzles = [ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=shuffle_seed)
+               for _ in seeds]
+
+    solve_results = solver_type.solve_samples(solvers, puzzles, list(seeds), invalid_limit=invalid_limit)
+
+    return [make_results_dict(solver_type, llm_name, chain_of_thought, puzzle, seed, solved, invalid_count, step_count,
+                              turn_tokens=solver.turn_tokens, compact_state=compact_state, llm_calls=solver.call_log)
+            for solver, puzzle, seed, (solved, invalid_count, step_count, guess_log, messages)
+            in zip(solvers, puzzles, seeds, solve_results)]
 
-    indices = list(range(16))
-    for group_1 in combinations(indices, 4):
-        remaining_1 = [idx for idx in indices if idx not in group_1]
-        for group_2 in combinations(remaining_1, 4):
-            remaining_2 = [idx for idx in remaining_1 if idx not in group_2]
-            for group_3 in combinations(remaining_2, 4):
-                group_4 = tuple([idx for idx in remaining_2 if idx not in group_3])
+async def solve_puzzle_samples_async(puzzle_id_and_seeds: typing.Tuple[int, typing.Tuple[int, ...]],
+                                     solver_type: typing.Union[IterativeGPTSolver, OneShotGPTSolver],
+                                     openai_client: AsyncOpenAI,
+                                     llm_name: str,
+                                     chain_of_thought: bool = False,
+                                     num_guesses: int = 5,
+                                     invalid_limit: int = 5,
+                                     rate_limiter: typing.Optional[AsyncRateLimiter] = None,
+                                     response_cache: typing.Optional[ResponseCache] = None,
+                                     compact_state: bool = False,
+                                     shuffle_seed: int = 0) -> typing.List[dict]:
+    '''
+    Asynchronous version of solve_puzzle_samples
+    '''
+    puzzle_id, seeds = puzzle_id_and_seeds
+    all_in_one = solver_type == OneShotGPTSolver
+    solver_kwargs = {"compact_state": True} if compact_state else {}
 
-                guess_idxs = tuple(sorted((group_1, group_2, group_3, group_4)))
+    solvers = [solver_type(openai_client, llm_name, chain_of_thought=chain_of_thought, rate_limiter=rate_limiter,
+                           response_cache=response_cache, **solver_kwargs) for _ in seeds]
+    puzzles = [ConnectionsPuzzle(id=puzzle_id, num_guesses=num_guesses, all_in_one=all_in_one, shuffle_seed=shuffle_seed)
+               for _ in seeds]
 
-                if guess_idxs not in all_guess_idxs:
-                    all_guess_idxs.add(guess_idxs)
+    solve_results = await solver_type.solve_samples_async(solvers, puzzles, list(seeds), invalid_limit=invalid_limit)
 
-    all_guess_idxs = list(all_guess_idxs)
+    return [make_results_dict(solver_type, llm_name, chain_of_thought, puzzle, seed, solved, invalid_count, step_count,
+                              turn_tokens=solver.turn_tokens, compact_state=compact_state, llm_calls=solver.call_log)
+            for solver, puzzle, seed, (solved, invalid_count, step_count, guess_log, messages)
+            in zip(solvers, puzzles, seeds, solve_results)]
 
-    # Save all_guess_idxs
-    with open("./data/all_guess_idxs.pkl", "wb") as f:
-        pickle.dump(all_guess_idxs, f)
+def enumerate_all_guesses(data_dir: str = "./data"):
+    '''
+    Write the index of every partition of the 16 words into 4 groups, used by ClustersBaseline
+    '''
+    return write_partition_index(data_dir)
 
 
 def get_difficulty_color(color_hex):
@@ -0,0 +1,191 @@
+import typing
+
+import numpy as np
+
+from puzzle import PuzzleReponse, PuzzleStore, COLOR_DICT, format_word, get_puzzle_store
+
+# Number of set bits in every 16-bit mask, for counting overlaps between guesses and categories
+_POPCOUNT = np.array([bin(mask).count("1") for mask in range(1 << 16)], dtype=np.int8)
+
+class VectorConnectionsEnv():
+    '''
+    A batch of "Connections" puzzles stepped together, with the state of every puzzle held in NumPy
+    arrays. Guesses are given as board positions rather than words: an (N, 4) array of positions in
+    the iterative mode, or an (N, 4, 4) array in the all-in-one mode. The responses and rewards
+    follow the same rules as `ConnectionsPuzzle.step`. Puzzles that are already done ignore their
+    guesses and respond with INVALID.
+
+    Args:
+        ids (List[int]): The puzzle IDs to include in the batch
+        num_guesses (int): The number of incorrect guesses allowed for each puzzle
+        all_in_one (bool): Whether all categories need to be guessed at once
+        data_dir (str): The directory where the puzzle data is stored
+        store (PuzzleStore): The puzzle store to use (defaults to the shared store for data_dir)
+        seed (int): The seed used to shuffle the boards
+    '''
+    def __init__(self,
+                 ids: typing.List[int],
+                 num_guesses: int = 4,
+                 all_in_one: bool = False,
+                 data_dir: str = "./data",
+                 store: typing.Optional[PuzzleStore] = None,
+                 seed: typing.Optional[int] = None):
+
+        self.ids = list(ids)
+        self.num_puzzles = len(self.ids)
+        self.num_guesses = num_guesses
+        self.all_in_one = all_in_one
+        self.store = store if store is not None else get_puzzle_store(data_dir)
+        self.rng = np.random.default_rng(seed)
+
+        # Words are identified by their index into a vocabulary shared by the batch
+        self.vocabulary = []
+        self.word_to_id = {}
+
+        unshuffled_word_ids = np.zeros((self.num_puzzles, 16), dtype=np.int32)
+        unshuffled_category_ids = np.zeros((self.num_puzzles, 16), dtype=np.int8)
+        self.category_colors = []
+
+        for puzzle_idx, id in enumerate(self.ids):
+            word_to_category = self.store.word_to_category(id)
+
+            for position, word in enumerate(self.store.formatted_words(id)):
+                if word not in self.word_to_id:
+                    self.word_to_id[word] = len(self.vocabulary)
+                    self.vocabulary.append(word)
+
+                unshuffled_word_ids[puzzle_idx, position] = self.word_to_id[word]
+                unshuffled_category_ids[puzzle_idx, position] = word_to_category[word]
+
+            self.category_colors.append([COLOR_DICT[category['color']] for category in self.store.get(id)['answers']])
+
+        self.unshuffled_word_ids = unshuffled_word_ids
+        self.unshuffled_category_ids = unshuffled_category_ids
+
+    def reset(self, shuffle: bool = True) -> typing.Tuple[dict, np.ndarray, np.ndarray]:
+        '''
+        Reset every puzzle (with a freshly shuffled board) and return the initial observation
+        '''
+        if shuffle:
+            permutations = np.argsort(self.rng.random((self.num_puzzles, 16)), axis=1)
+        else:
+            permutations = np.tile(np.arange(16), (self.num_puzzles, 1))
+
+        self.word_ids = np.take_along_axis(self.unshuffled_word_ids, permutations, axis=1)
+        self.category_ids = np.take_along_axis(self.unshuffled_category_ids, permutations, axis=1)
+
+        position_bits = np.left_shift(1, np.arange(16, dtype=np.int32))
+        self.category_masks = np.stack([((self.category_ids == category_idx) * position_bits).sum(axis=1)
+                                        for category_idx in range(4)], axis=1).astype(np.int32)
+
+        self.revealed_mask = np.zeros(self.num_puzzles, dtype=np.int32)
+        self.revealed_categories = np.zeros((self.num_puzzles, 4), dtype=bool)
+        self.guesses_remaining = np.full(self.num_puzzles, self.num_guesses, dtype=np.int32)
+        self.done = np.zeros(self.num_puzzles, dtype=bool)
+        self.rewards = np.zeros(self.num_puzzles, dtype=np.int32)
+
+        return self.observation, self.done.copy(), self.rewards.copy()
+
+    @property
+    def observation(self) -> dict:
+        '''
+        The batched puzzle state, exposing what `ConnectionsPuzzle`'s observation does: the board,
+        the revealed groups and the remaining guesses. The categories of the unrevealed words
+        (`category_ids` and `category_masks`) stay private to the env
+        '''
+        return {
+            "word_ids": self.word_ids.copy(),
+            "revealed_mask": self.revealed_mask.copy(),
+            "revealed_categories": self.revealed_categories.copy(),
+            "guesses_remaining": self.guesses_remaining.copy(),
+            "done": self.done.copy(),
+            "all_in_one": self.all_in_one,
+        }
+
+    def _guess_masks(self, positions: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        '''
+        Return the bitmask of each guessed group and whether the group is valid, i.e. only uses
+        positions that are on the board and not yet revealed
+        '''
+        in_range = (positions >= 0) & (positions < 16)
+        bits = np.where(in_range, np.left_shift(1, np.clip(positions, 0, 15)), 0).astype(np.int32)
+
+        masks = np.bitwise_or.reduce(bits, axis=-1)
+        revealed = self.revealed_mask.reshape((-1,) + (1,) * (masks.ndim - 1))
+        valid = in_range.all(axis=-1) & ((masks & revealed) == 0)
+
+        return masks, valid
+
+    def step(self, actions: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Apply a batch of guesses and return the response code (a PuzzleReponse value), done flag
+        and reward of every puzzle
+        '''
+        actions = np.asarray(actions)
+        expected_shape = (self.num_puzzles, 4, 4) if self.all_in_one else (self.num_puzzles, 4)
+        assert actions.shape == expected_shape, f"Expected guesses of shape {expected_shape}, got {actions.shape}"
+
+        masks, valid = self._guess_masks(actions)
+        if self.all_in_one:
+            valid = valid.all(axis=1)
+
+        active = ~self.done & valid
+        responses = np.full(self.num_puzzles, PuzzleReponse.INVALID.value, dtype=np.int8)
+
+        if self.all_in_one:
+            # Every category must be covered exactly by one of the guessed groups
+            matches = (masks[:, :, None] == self.category_masks[:, None, :]).any(axis=1)
+            correct = active & matches.all(axis=1)
+            incorrect = active & ~correct
+
+            self.revealed_categories[correct] = True
+            self.revealed_mask[correct] = 0xFFFF
+
+            responses[correct] = PuzzleReponse.CORRECT.value
+            responses[incorrect] = PuzzleReponse.INCORRECT.value
+            self.guesses_remaining[incorrect] -= 1
+
+        else:
+            overlaps = _POPCOUNT[masks[:, None] & self.category_masks]
+            is_correct = active[:, None] & (overlaps == 4)
+            correct = is_correct.any(axis=1)
+            nearly_correct = active & ~correct & (overlaps == 3).any(axis=1)
+            incorrect = active & ~correct & ~nearly_correct
+
+            self.revealed_categories |= is_correct
+            self.revealed_mask[correct] |= masks[correct]
+
+            responses[correct] = PuzzleReponse.CORRECT.value
+            responses[nearly_correct] = PuzzleReponse.NEARLY_CORRECT.value
+            responses[incorrect] = PuzzleReponse.INCORRECT.value
+            self.guesses_remaining[nearly_correct | incorrect] -= 1
+
+        # Done when at least 3 categories have been revealed, since the last group is guaranteed
+        solved = self.revealed_categories.sum(axis=1) >= 3
+        self.revealed_categories[solved] = True
+        self.revealed_mask[solved] = 0xFFFF
+
+        self.done |= active & ((self.guesses_remaining == 0) | solved)
+        self.rewards = solved.astype(np.int32)
+
+        return responses, self.done.copy(), self.rewards.copy()
+
+    def words(self, puzzle_idx: int) -> typing.List[str]:
+        '''
+        Return the words still on the board of a puzzle, in board order
+        '''
+        return [self.vocabulary[word_id] for position, word_id in enumerate(self.word_ids[puzzle_idx])
+                if not (self.revealed_mask[puzzle_idx] >> position) & 1]
+
+    def revealed_colors(self, puzzle_idx: int) -> typing.List[str]:
+        '''
+        Return the colors of the categories revealed so far in a puzzle, in category order
+        '''
+        return [color for color, revealed in zip(self.category_colors[puzzle_idx], self.revealed_categories[puzzle_idx]) if revealed]
+
+    def positions(self, puzzle_idx: int, words: typing.List[str]) -> typing.List[int]:
+        '''
+        Convert a guess given as words into board positions for a puzzle (-1 for unknown words)
+        '''
+        board = {self.vocabulary[word_id]: position for position, word_id in enumerate(self.word_ids[puzzle_idx])}
+        return [board.get(format_word(word), -1) for word in words]